@@ -41,7 +41,9 @@ def run(root, experiments=None, obs_type=None, shear_type=None, seed=10, steps=N
         shear_value = None,
         shear_angle = None,
         public_dir='public', truth_dir='truth', preload=False, nproc=-1,
-        gal_pairs=True):
+        gal_pairs=True, defer_catalog_check=False, catalog_types=None, image_nproc=1,
+        package_nproc=1, optical_psf_cache_size=None, optical_psf_cache_tol=None,
+        resume=False, report=None):
     """Top-level driver for GREAT3 simulation code.
 
     This driver parses the input parameters to decide what work must be done.  Here are the
@@ -126,19 +128,71 @@ def run(root, experiments=None, obs_type=None, shear_type=None, seed=10, steps=N
                              placed.
     @param[in] preload       Preload the RealGalaxyCatalog images to speed up generation of large
                              numbers of real galaxies? [default=False]  Note that for parametric
-                             galaxy branches, the catalog is never preloaded.
+                             galaxy branches, the catalog is never preloaded.  If it is not
+                             preloaded, images are read when needed and a limited number of them
+                             are kept in memory.
     @param[in] nproc         How many processes to use in the config file.  [default = -1, which
                              means that GalSim will automatically decide on a value to use]
     @param[in] gal_pairs     For constant shear branches, should it use 90 degree rotated pairs to
                              cancel out shape noise, or not?  This option is ignored for variable
                              shear branches. [default: True]
+    @param[in] defer_catalog_check  Skip the check for NaN and Inf values when writing each catalog,
+                             and instead check all catalogs for the chosen subfields at once in the
+                             'packages' step.  When running the steps separately, this should be
+                             set for all of them. [default: False]
+    @param[in] catalog_types A dict of {dataset-name: format-name} choosing a format other than FITS
+                             for some catalogs; the only other format is currently 'npy', which is
+                             memory-mapped when read.  For example, {'subfield_catalog': 'npy'}.
+                             The epoch, star and star test catalogs must be FITS if the 'config'
+                             step is used, since GalSim reads them.  When running the steps
+                             separately, this should be the same for all of them. [default: None]
     @param[in] draw_psf_src  Fits file containing psf population as multiple hdus
                              Or base filename of sequentially numbered fits files, where e.g.,
                              psf.fits means psf_1.fits ... psf_n.fits.  Directory must be writable.
     @param[in] shear_value   Shear value for constant shear experiments
     @param[in] shear_angle   Shear angle in degrees for constant shear experiments
+    @param[in] image_nproc   How many processes to use to draw each image in the 'gal_images' and
+                             'psf_images' steps.  A value <= 0 means one process per CPU.
+                             [default: 1]
+    @param[in] package_nproc How many branches to package at once in the 'packages' step.  The
+                             tarballs are compressed by a single pool with as many threads as the
+                             processes used for the image steps (see `image_nproc`). [default: 1]
+    @param[in] optical_psf_cache_size  For variable PSF branches, how many galsim.OpticalPSF objects
+                             to keep so that they can be reused by objects with the same
+                             aberrations.  [default: None, for the default of
+                             great3sims.psf.VariablePSFBuilder, which is 200]
+    @param[in] optical_psf_cache_tol  For variable PSF branches, the tolerance in waves to which the
+                             optical PSF aberrations are rounded before looking them up in the
+                             cache.  With the default of 0, objects almost never share an
+                             OpticalPSF, since the aberrations vary continuously across each tile.
+                             For the ground branches, 0.05 lets about a third of the objects reuse
+                             a cached OpticalPSF, and 0.1 about two thirds, at the cost of changing
+                             each aberration by up to half the tolerance.  Since this changes the
+                             PSFs, it should be the same for all steps.  [default: None, for the
+                             default of great3sims.psf.VariablePSFBuilder, which is 0]
+    @param[in] resume        Skip the work that is already up to date?  Each step is split into
+                             tasks (one per subfield and epoch, where appropriate), and the tasks
+                             that are done are recorded in a manifest in each branch directory,
+                             along with the sizes and modification times of the files they read and
+                             wrote.  A task is skipped if it was done with the same options and none
+                             of those files has changed since, so an interrupted run can be
+                             restarted with the same arguments and resume=True to pick up where it
+                             stopped.  Only the options that change the outputs are compared (the
+                             metaparameter options, gal_pairs, optical_psf_cache_tol, preload for
+                             the config files, the input directories and the subfield range where
+                             relevant), and the input data files themselves are not checked, so this
+                             should not be used after changing the code or input data.  Every task
+                             is still recorded when this is False.  [default: False]
+    @param[in] report        Name of a YAML file in which to write a report of the wall time, CPU
+                             time, peak memory and number of objects for each task (labelled by
+                             branch, step, subfield and epoch) and for the main methods of the
+                             builders called by each task, along with a summary of the totals for
+                             each step and method.  See instrument.py.  [default: None, for no
+                             report]
     """
     import sys
+    import great3sims.tasks
+    import great3sims.instrument
 
     # Select experiments based on keywords, or do all of them if no experiment was specified.
     if experiments is None:
@@ -176,17 +230,47 @@ def run(root, experiments=None, obs_type=None, shear_type=None, seed=10, steps=N
                   builders[experiment](root, obs_type, shear_type,
                                        gal_dir, ps_dir, opt_psf_dir, atmos_ps_dir, public_dir,
                                        draw_psf_src, shear_value, shear_angle,
-                                       truth_dir, preload, nproc, gal_pairs))
+                                       truth_dir, preload, nproc, gal_pairs,
+                                       defer_catalog_check, catalog_types,
+                                       image_nproc=image_nproc,
+                                       optical_psf_cache_size=optical_psf_cache_size,
+                                       optical_psf_cache_tol=optical_psf_cache_tol))
                         for experiment in experiments
                         for obs_type in obs_types
                         for shear_type in shear_types ]
 
+    # Check the catalog formats before doing any work, rather than after the catalogs are written.
+    if 'config' in steps:
+        for experiment, obs_type, shear_type, builder in branches:
+            builder.mapper.checkConfigCatalogTypes()
+
+    if report is None:
+        run_report = None
+    else:
+        run_report = great3sims.instrument.RunReport()
+        for experiment, obs_type, shear_type, builder in branches:
+            run_report.instrument(builder)
+
+    def run_step(builder, step, **kwds):
+        # Do the tasks for one step of one branch, skipping those that are up to date.  Returns the
+        # number of tasks that were skipped.
+        manifest = great3sims.tasks.TaskManifest(builder.mapper.full_dir)
+        tasks = builder.getTasks(step, subfield_min, subfield_max, **kwds)
+        try:
+            return great3sims.tasks.runTasks(tasks, manifest, resume=resume, report=run_report,
+                                             branch=builder.mapper.dir)
+        except:
+            # Keep the report of what was done before the error.
+            if run_report is not None:
+                run_report.write(report)
+            raise
+
     # Now actually do the requested work for each step of the process.
     if 'metaparameters' in steps:
         for experiment, obs_type, shear_type, builder in branches:
             print "Generating metaparameters for %s / %s / %s" % (experiment, obs_type, shear_type)
-            builder.writeParameters(seed)
-            if subfield_min>0 or subfield_max<constants.n_subfields-1:
+            n_skipped = run_step(builder, 'metaparameters', seed=seed)
+            if n_skipped == 0 and (subfield_min>0 or subfield_max<constants.n_subfields-1):
                 import warnings
                 warnings.warn('Regenerating metaparameters for all subfields,' +
                               ' not just the chosen subset')
@@ -194,30 +278,18 @@ def run(root, experiments=None, obs_type=None, shear_type=None, seed=10, steps=N
     if 'catalogs' in steps:
         for experiment, obs_type, shear_type, builder in branches:
             print "Generating catalogs for %s / %s / %s" % (experiment, obs_type, shear_type)
-            for subfield_index in xrange(subfield_min, subfield_max+1):
-                sys.stdout.write('\r')
-                sys.stdout.write("  subfield %d" % subfield_index)
-                sys.stdout.flush()
-                builder.writeSubfieldCatalog(subfield_index)
-                for epoch_index in xrange(builder.n_epochs):
-                    builder.writeEpochCatalog(subfield_index, epoch_index)
-            builder.writeStarTestCatalog(subfield_min, subfield_max)
+            run_step(builder, 'catalogs')
             sys.stderr.write("\n")
 
     if 'config' in steps:
         for experiment, obs_type, shear_type, builder in branches:
             print "Generating config files for %s / %s / %s" % (experiment, obs_type, shear_type)
-            builder.writeConfig(experiment, obs_type, shear_type, subfield_min, subfield_max)
+            run_step(builder, 'config')
 
     if 'gal_images' in steps:
         for experiment, obs_type, shear_type, builder in branches:
             print "Generating galaxy images for %s / %s / %s" % (experiment, obs_type, shear_type)
-            for subfield_index in xrange(subfield_min, subfield_max+1):
-                for epoch_index in xrange(builder.n_epochs):
-                    sys.stdout.write('\r')
-                    sys.stdout.write("  subfield %d / epoch %d" % (subfield_index, epoch_index))
-                    sys.stdout.flush()
-                    builder.writeGalImage(subfield_index, epoch_index)
+            run_step(builder, 'gal_images')
             sys.stderr.write("\n")
             if hasattr(builder.galaxy_builder,'rgc'):
                 builder.galaxy_builder.rgc.close()
@@ -225,28 +297,35 @@ def run(root, experiments=None, obs_type=None, shear_type=None, seed=10, steps=N
     if 'psf_images' in steps:
         for experiment, obs_type, shear_type, builder in branches:
             print "Generating PSF images for %s / %s / %s" % (experiment, obs_type, shear_type)
-            for subfield_index in xrange(subfield_min, subfield_max+1):
-                for epoch_index in xrange(builder.n_epochs):
-                    sys.stdout.write('\r')
-                    sys.stdout.write("  subfield %d / epoch %d" % (subfield_index, epoch_index))
-                    sys.stdout.flush()
-                    builder.writePSFImage(subfield_index, epoch_index)
+            run_step(builder, 'psf_images')
             sys.stderr.write("\n")
 
     if 'star_params' in steps:
         for experiment, obs_type, shear_type, builder in branches:
             print "Measuring star parameters for %s / %s / %s" % (experiment, obs_type, shear_type)
-            for subfield_index in xrange(subfield_min, subfield_max+1):
-                for epoch_index in xrange(builder.n_epochs):
-                    sys.stdout.write('\r')
-                    sys.stdout.write("  subfield %d / epoch %d" % (subfield_index, epoch_index))
-                    sys.stdout.flush()
-                    builder.writeStarParameters(subfield_index, epoch_index)
+            run_step(builder, 'star_params')
             sys.stderr.write("\n")
 
-    if 'packages' in steps:
-        for experiment, obs_type, shear_type, builder in branches:
+    if 'packages' in steps and branches:
+        import multiprocessing.pool
+        # Packaging is mostly reading files and compressing them, both of which release the GIL, so
+        # the branches are packaged by threads, sharing one pool of threads for compression.
+        compress_pool = multiprocessing.pool.ThreadPool(branches[0][3]._getImageNproc(None))
+        def package(branch):
+            experiment, obs_type, shear_type, builder = branch
             print "Packaging data for %s / %s / %s" % (experiment, obs_type, shear_type)
-            builder.packagePublic(subfield_min, subfield_max)
-            builder.packageTruth(subfield_min, subfield_max)
+            run_step(builder, 'packages', compress_pool=compress_pool)
             sys.stderr.write("\n")
+        if package_nproc > 1 and len(branches) > 1:
+            package_pool = multiprocessing.pool.ThreadPool(min(package_nproc, len(branches)))
+            package_pool.map(package, branches, chunksize=1)
+            package_pool.close()
+            package_pool.join()
+        else:
+            for branch in branches:
+                package(branch)
+        compress_pool.close()
+        compress_pool.join()
+
+    if run_report is not None:
+        run_report.write(report)
@@ -38,8 +38,73 @@ import great3sims.psf
 import great3sims.noise
 import great3sims.shear
 import great3sims.galaxies
+import great3sims.packaging
 from . import constants
 
+# When images are drawn with a pool of processes, the worker functions below need the builder, the
+# epoch information, and the image to draw into.  These are not easily pickled (e.g., the
+# RealGalaxyCatalog holds open FITS files), so instead of passing them with every task, we store
+# them here before the pool is created and let the forked worker processes inherit them.
+_pool_state = None
+
+def _makeSharedImage(nx, ny, scale):
+    """Make a galsim.ImageF with origin (0,0) whose pixels live in shared memory, so that postage
+    stamps drawn into it by the worker processes of an image drawing pool are seen directly by the
+    parent process without any copying."""
+    import ctypes
+    import multiprocessing.sharedctypes
+    shared_buffer = multiprocessing.sharedctypes.RawArray(ctypes.c_float, nx * ny)
+    array = numpy.frombuffer(shared_buffer, dtype=numpy.float32).reshape(ny, nx)
+    image = galsim.ImageViewF(array, scale=scale)
+    image.setOrigin(0,0)
+    return image
+
+def _getRowBlocks(n_objects, n_per_row, nproc):
+    """Split the indices [0, n_objects) of a catalog whose postage stamps are laid out in rows of
+    `n_per_row` objects into blocks of complete rows.  We use a few blocks per process so that the
+    load stays balanced when some rows are slower than others.
+
+    @return a list of (index_min, index_max) tuples.
+    """
+    n_rows = (n_objects + n_per_row - 1) / n_per_row
+    rows_per_block = max(1, n_rows / (4*nproc))
+    return [ (row * n_per_row, min((row + rows_per_block) * n_per_row, n_objects))
+             for row in xrange(0, n_rows, rows_per_block) ]
+
+def _initImagePoolWorker():
+    """Initialization for each worker process in the image drawing pool."""
+    builder = _pool_state[0]
+    # The RealGalaxyCatalog keeps its FITS files open unless everything was preloaded.  Those file
+    # handles are shared with the parent process after the fork, so close them in the worker; they
+    # will be reopened (privately) the first time that a RealGalaxy is made.
+    galaxy_builder = builder.galaxy_builder
+    if hasattr(galaxy_builder, 'rgc') and not galaxy_builder.preload:
+        galaxy_builder.rgc.close()
+
+def _drawImageBlock(block):
+    """Worker function for the image drawing pool: draw the objects with catalog indices in
+    [block[0], block[1]) directly into the shared image."""
+    builder, draw_func, epoch_parameters, catalog, image = _pool_state
+    draw_func(epoch_parameters, catalog, image, block[0], block[1])
+
+def _drawImagePool(builder, draw_func, epoch_parameters, catalog, image, blocks, nproc):
+    """Use a pool of `nproc` processes to call `draw_func` (one of the SimBuilder._draw*Stamps()
+    methods) for each of the `blocks` of catalog indices.  The `image` must have been made by
+    _makeSharedImage(), since the workers draw into it directly."""
+    import multiprocessing
+    global _pool_state
+    _pool_state = (builder, draw_func, epoch_parameters, catalog, image)
+    pool = multiprocessing.Pool(min(nproc, len(blocks)), _initImagePoolWorker)
+    try:
+        pool.map(_drawImageBlock, blocks, chunksize=1)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        _pool_state = None
+
 class SimBuilder(object):
 
     # Per-experiment parameters; should be overridden by per-experiment subclasses (see customize())
@@ -67,7 +132,9 @@ class SimBuilder(object):
         return cls
 
     def __init__(self, root, obs_type, shear_type, gal_dir, ps_dir, opt_psf_dir, atmos_ps_dir,
-                 public_dir, draw_psf_src, shear_value, shear_angle, truth_dir, preload=False, nproc=-1, gal_pairs=True):
+                 public_dir, draw_psf_src, shear_value, shear_angle, truth_dir, preload=False, nproc=-1, gal_pairs=True,
+                 defer_catalog_check=False, catalog_types=None, image_nproc=1,
+                 optical_psf_cache_size=None, optical_psf_cache_tol=None):
         """Initialize a builder for the given `obs_type` and `shear_type`.
 
         @param[in] root         Root directory for generated files.
@@ -87,6 +154,22 @@ class SimBuilder(object):
         @param[in] gal_pairs    For constant shear branches, should it use 90 degree rotated pairs
                                 to cancel out shape noise, or not?  This option is ignored for
                                 variable shear branches. [default: True]
+        @param[in] defer_catalog_check  Skip the check for NaN and Inf values when writing each
+                                catalog; they should be checked with checkCatalogs() before
+                                packaging instead. [default: False]
+        @param[in] catalog_types  A dict of {dataset-name: format-name} choosing a format other than
+                                FITS for some catalogs, e.g., {'subfield_catalog': 'npy'}; see
+                                great3sims.mapper.Mapper. [default: None]
+        @param[in] image_nproc  How many processes to use when drawing images within this script
+                                (see writeGalImage() and writePSFImage()).  A value <= 0 means to
+                                use as many as there are CPUs.  [default = 1]
+        @param[in] optical_psf_cache_size  For variable PSF branches, how many galsim.OpticalPSF
+                                objects to keep for reuse; see great3sims.psf.VariablePSFBuilder.
+                                [default: None, which uses the VariablePSFBuilder default]
+        @param[in] optical_psf_cache_tol  For variable PSF branches, the tolerance in waves to which
+                                the optical PSF aberrations are rounded so that nearby objects can
+                                share an OpticalPSF; see great3sims.psf.VariablePSFBuilder.
+                                [default: None, which uses the VariablePSFBuilder default]
         @param[in] draw_psf_src Draw psf from a distribution?
         @param[in] shear_value  Value for constant shear experiments
         @param[in] shear_angle  Angle for constant shear experiments
@@ -108,7 +191,9 @@ class SimBuilder(object):
                                                       shear_type=self.shear_type,
                                                       opt_psf_dir=opt_psf_dir,
                                                       atmos_ps_dir=atmos_ps_dir,
-                                                      draw_psf_src=draw_psf_src)
+                                                      draw_psf_src=draw_psf_src,
+                                                      optical_psf_cache_size=optical_psf_cache_size,
+                                                      optical_psf_cache_tol=optical_psf_cache_tol)
         self.shear_builder = great3sims.shear.makeBuilder(shear_type=shear_type, obs_type=obs_type,
                                                           multiepoch=self.multiepoch, ps_dir=ps_dir,
                                                           shear_value=shear_value, shear_angle=shear_angle)
@@ -125,10 +210,17 @@ class SimBuilder(object):
         # We also initialize a mapper, which assists with i/o for this branch.  It knows how to make
         # directory and file names depending on the branch, and what types of files need to be
         # output for that branch.
-        self.mapper = great3sims.mapper.Mapper(root, self.experiment, obs_type, shear_type)
+        self.mapper = great3sims.mapper.Mapper(root, self.experiment, obs_type, shear_type,
+                                               check_catalogs=not defer_catalog_check,
+                                               catalog_types=catalog_types)
         # And store some additional necessary information.
         self.n_epochs = constants.n_epochs if self.multiepoch else 1
         self.nproc = nproc
+        self.image_nproc = image_nproc
+        self.gal_pairs = gal_pairs
+        # The directories of input data, which are recorded with the Tasks that read them.
+        self.input_dirs = {"gal_dir": gal_dir, "ps_dir": ps_dir, "opt_psf_dir": opt_psf_dir,
+                           "atmos_ps_dir": atmos_ps_dir}
 
     def writeParameters(self, seed):
         """Generate and write the metaparameters of the builder.
@@ -473,9 +565,8 @@ class SimBuilder(object):
                     record['x'] = (record['xmin'] + record['xmax']) / 2
                     record['y'] = (record['ymin'] + record['ymax']) / 2
                     # Here are some numbers that we'll only compute if it's the first epoch.  Since
-                    # we want to represent the same star population in each epoch, we store them in
-                    # the cache after generating the first epoch, and read from the cache if it's
-                    # not the first epoch.
+                    # we want to represent the same star population in each epoch, later epochs
+                    # copy them from the star catalog for the first epoch.
                     if epoch_index == 0:
                         record['xshift'] = sx
                         record['yshift'] = sy
@@ -498,18 +589,10 @@ class SimBuilder(object):
                         # S/N distribution should be similar.
                         record['star_snr'] = dist_deviate()
                     index += 1
-            if epoch_index == 0:
-                self.cached_xshift = star_catalog['xshift']
-                self.cached_yshift = star_catalog['yshift']
-                self.cached_x_field_true_deg = star_catalog['x_field_true_deg']
-                self.cached_y_field_true_deg = star_catalog['y_field_true_deg']
-                self.cached_star_snr = star_catalog['star_snr']
-            else:
-                star_catalog['xshift'] = self.cached_xshift
-                star_catalog['yshift'] = self.cached_yshift
-                star_catalog['x_field_true_deg'] = self.cached_x_field_true_deg
-                star_catalog['y_field_true_deg'] = self.cached_y_field_true_deg
-                star_catalog['star_snr'] = self.cached_star_snr
+            if epoch_index > 0:
+                self._copyFirstEpochStars(star_catalog, subfield_index,
+                                          ('xshift', 'yshift', 'x_field_true_deg',
+                                           'y_field_true_deg', 'star_snr'))
 
         else:
             # For constant PSF branches, the star catalog generation is much simpler.
@@ -527,10 +610,10 @@ class SimBuilder(object):
                     record["index"] = index
                     record["x"] = (record["xmin"] + record["xmax"]) / 2
                     record["y"] = (record["ymin"] + record["ymax"]) / 2
-                    # Here are some numbers that we will save in a cache, only computing for the
-                    # first epoch in a field, so as to preserve the random subpixel shifts between
-                    # stars in the starfield.  This way simple coaddition will work for all stars in
-                    # one of the constant PSF starfields.
+                    # Here are some numbers that we only compute for the first epoch in a field
+                    # (later epochs copy them from its star catalog), so as to preserve the random
+                    # subpixel shifts between stars in the starfield.  This way simple coaddition
+                    # will work for all stars in one of the constant PSF starfields.
                     if epoch_index == 0:
                         if index > 0:
                             sx = (2.0*rng() - 1.0) * constants.centroid_shift_max
@@ -541,12 +624,8 @@ class SimBuilder(object):
                             record["xshift"] = 0
                             record["yshift"] = 0
                     index += 1
-            if epoch_index == 0:
-                self.cached_xshift = star_catalog['xshift']
-                self.cached_yshift = star_catalog['yshift']
-            else:
-                star_catalog['xshift'] = self.cached_xshift
-                star_catalog['yshift'] = self.cached_yshift
+            if epoch_index > 0:
+                self._copyFirstEpochStars(star_catalog, subfield_index, ('xshift', 'yshift'))
         # Given the basic catalog information generated above, make the catalog of PSF parameters
         # (e.g., optical PSF and atmospheric PSF parameters) for each star.
         self.psf_builder.generateCatalog(rng, star_catalog, epoch_parameters,
@@ -554,6 +633,17 @@ class SimBuilder(object):
         # Write the star catalog to file in the appropriate location and format.
         self.mapper.write(star_catalog, "star_catalog", epoch_parameters)
 
+    def _copyFirstEpochStars(self, star_catalog, subfield_index, names):
+        """Copy the named columns of the star catalog for the first epoch of a subfield (which
+        must already have been written) into the star catalog for a later epoch, so that every epoch
+        has the same star population.  These are read from disk rather than kept from the first
+        epoch, so that any epoch of any subfield can be made on its own.
+        """
+        first_catalog = self.mapper.read('star_catalog', subfield_index=subfield_index,
+                                         epoch_index=0)
+        for name in names:
+            star_catalog[name] = first_catalog[name]
+
     def writeStarTestCatalog(self, subfield_min, subfield_max):
         """Given a range of subfield and epoch indices, write a test catalog for generating star
         images to check for oddities.  We want a small set of objects (suitable for eyeballing)
@@ -613,6 +703,10 @@ class SimBuilder(object):
         """This function writes yaml-style config files that can be used by GalSim to automatically
         generate the galaxy, star, and test images for this branch and range of subfields."""
 
+        # GalSim reads the epoch, star and star test catalogs when using these config files, and it
+        # can only read them as FITS.
+        self.mapper.checkConfigCatalogTypes()
+
         # Build the dictionary, which we'll output with yaml.dump()
         # We start with the PSF dict, which has much in common with the gal dict.
         # After we write that out, we'll change what has to change and add the gal field.
@@ -859,27 +953,64 @@ class SimBuilder(object):
             yaml.dump(d, f, indent=4, Dumper=Dumper)
 
 
-    def writeGalImage(self, subfield_index, epoch_index):
+    def writeGalImage(self, subfield_index, epoch_index, nproc=None):
         """This method builds and writes the galaxy images for a given subfield and epoch to disk.
         It was not used for generation of the GREAT3 simulations, since the GalSim config interface
         allows for the work done here to be parallelized much more.  However, for testing and
         generation of small images this method can be useful.
+
+        If more than one process is requested, the epoch catalog is split into blocks of stamp rows
+        that are drawn by a pool of worker processes directly into a full image held in shared
+        memory.  Each object uses the same random seed as in the serial case, so the resulting
+        image is identical.
+
+        @param[in] nproc   How many processes to use for drawing the postage stamps.  A value <= 0
+                           means to use as many as there are CPUs.  [default = None, which means to
+                           use the `image_nproc` value that was given to the constructor]
         """
         # Read in the epoch parameters and catalog.
         epoch_parameters = self.mapper.read("epoch_parameters", subfield_index=subfield_index,
                                             epoch_index=epoch_index)
         epoch_catalog = self.mapper.read("epoch_catalog", epoch_parameters)
-        seed = epoch_parameters["noise_seed"]
 
         # Define basic numbers like pixel scale and size of postage stamps.
         pixel_scale = constants.pixel_scale[self.obs_type][self.multiepoch]
         xsize = constants.xsize[self.obs_type][self.multiepoch]
         ysize = constants.ysize[self.obs_type][self.multiepoch]
 
-        # Set up the full image on which to place the postage stamps.
-        galaxy_image = galsim.ImageF(constants.ncols * xsize, constants.nrows * ysize,
-                                     scale=pixel_scale)
-        galaxy_image.setOrigin(0,0)
+        nproc = self._getImageNproc(nproc)
+        if nproc == 1:
+            # Set up the full image on which to place the postage stamps.
+            galaxy_image = galsim.ImageF(constants.ncols * xsize, constants.nrows * ysize,
+                                         scale=pixel_scale)
+            galaxy_image.setOrigin(0,0)
+            self._drawGalaxyStamps(epoch_parameters, epoch_catalog, galaxy_image,
+                                   0, len(epoch_catalog))
+        else:
+            # The full image is in shared memory, and the worker processes draw blocks of complete
+            # rows of postage stamps directly into it.
+            galaxy_image = _makeSharedImage(constants.ncols * xsize, constants.nrows * ysize,
+                                            pixel_scale)
+            blocks = _getRowBlocks(len(epoch_catalog), constants.ncols, nproc)
+            _drawImagePool(self, self._drawGalaxyStamps, epoch_parameters, epoch_catalog,
+                           galaxy_image, blocks, nproc)
+
+        # Write the entire big image to the appropriate file, as determined by the mapper.
+        self.mapper.write(galaxy_image, "image", epoch_parameters)
+
+    def _drawGalaxyStamps(self, epoch_parameters, epoch_catalog, image, index_min, index_max):
+        """Draw the galaxies with catalog indices in [index_min, index_max) into their postage
+        stamps on `image`, which must contain the bounds of all of these stamps.
+
+        The random seed for each object is the epoch `noise_seed` plus the index of the object in
+        the catalog, so that the result does not depend on how the catalog is split up.
+        """
+        seed = epoch_parameters["noise_seed"] + index_min
+
+        # Define basic numbers like pixel scale and size of postage stamps.
+        pixel_scale = constants.pixel_scale[self.obs_type][self.multiepoch]
+        xsize = constants.xsize[self.obs_type][self.multiepoch]
+        ysize = constants.ysize[self.obs_type][self.multiepoch]
 
         # Define the maximum sizes for padding RealGalaxy objects with noise.  This is necessary for
         # 'real_galaxy' and 'full' branches.
@@ -899,8 +1030,8 @@ class SimBuilder(object):
         # We'll make a cache for the PSF object, since in constant PSF branches the PSF is the same
         # for all galaxies.  This way, we only build the PSF object once.
         cached_psf_obj = None
-        # Loop over the objects in the galaxy catalog for this epoch.
-        for record in epoch_catalog:
+        # Loop over the requested objects in the galaxy catalog for this epoch.
+        for record in epoch_catalog[index_min:index_max]:
             # Make the RNG.
             rng = galsim.UniformDeviate(seed)
             seed = seed + 1
@@ -933,7 +1064,7 @@ class SimBuilder(object):
                 xmin=int(record['xmin']), ymin=int(record['ymin']),
                 xmax=int(record['xmax']), ymax=int(record['ymax']),
             )
-            stamp = galaxy_image.subImage(bbox)
+            stamp = image.subImage(bbox)
             # Draw into the postage stamp.
             final.draw(stamp, normalization='f', dx=pixel_scale, offset=offset)
 
@@ -1003,46 +1134,84 @@ class SimBuilder(object):
             # Now, actually add the noise to this postage stamp.
             self.noise_builder.addNoise(rng, epoch_parameters['noise'], stamp, current_var)
 
-        # Write the entire big image to the appropriate file, as determined by the mapper.
-        self.mapper.write(galaxy_image, "image", epoch_parameters)
-
-
-    def writePSFImage(self, subfield_index, epoch_index):
+    def _getImageNproc(self, nproc):
+        """Decide how many processes to use when drawing images within this script, given the
+        `nproc` argument to writeGalImage() or writePSFImage()."""
+        if nproc is None:
+            nproc = self.image_nproc
+        if nproc <= 0:
+            import multiprocessing
+            try:
+                nproc = multiprocessing.cpu_count()
+            except NotImplementedError:
+                nproc = 1
+        return nproc
+
+
+    def writePSFImage(self, subfield_index, epoch_index, nproc=None):
         """This method builds and writes the star field images for a particular subfield and epoch
         to disk.  It was not used for generation of the GREAT3 simulations, since the GalSim config
         interface allows for the work done here to be parallelized much more.  However, for testing
         and generation of small images this method can be useful.
+
+        As for writeGalImage(), the star field can be drawn by a pool of processes that write
+        directly into a shared image, with identical results to the serial case.
+
+        @param[in] nproc   How many processes to use for drawing the postage stamps.  A value <= 0
+                           means to use as many as there are CPUs.  [default = None, which means to
+                           use the `image_nproc` value that was given to the constructor]
         """
         # Read in the epoch parameters and star catalog.
         epoch_parameters = self.mapper.read("epoch_parameters", subfield_index=subfield_index,
                                             epoch_index=epoch_index)
         star_catalog = self.mapper.read("star_catalog", epoch_parameters)
-        seed = epoch_parameters["noise_seed"]
 
         # Define basic numbers like pixel scale and size of postage stamps.
         pixel_scale = constants.pixel_scale[self.obs_type][self.multiepoch]
         xsize = constants.xsize[self.obs_type][self.multiepoch]
         ysize = constants.ysize[self.obs_type][self.multiepoch]
-        # Make a galsim.Pixel representing the top-hat pixel.
-        pixel = galsim.Pixel(pixel_scale)
 
-        # Set up the image for the star field.  Its size depends on whether this is a constant PSF
-        # or variable PSF branch.
+        # The size of the image for the star field depends on whether this is a constant PSF or
+        # variable PSF branch.
         if self.variable_psf:
             n_star_linear = epoch_parameters["psf"]["n_star_linear"]
-            star_image = galsim.ImageF(n_star_linear * xsize,
-                                       n_star_linear * ysize,
-                                       scale=pixel_scale)
+            n_star_x = n_star_linear
+            n_star_y = n_star_linear
+        else:
+            n_star_x = constants.nx_constpsf
+            n_star_y = constants.ny_constpsf
+
+        nproc = self._getImageNproc(nproc)
+        if nproc == 1:
+            # Set up the image for the star field.
+            star_image = galsim.ImageF(n_star_x * xsize, n_star_y * ysize, scale=pixel_scale)
+            star_image.setOrigin(0, 0)
+            self._drawStarStamps(epoch_parameters, star_catalog, star_image,
+                                 0, len(star_catalog))
         else:
-            star_image = galsim.ImageF(constants.nx_constpsf * xsize,
-                                       constants.ny_constpsf * ysize,
-                                       scale=pixel_scale)
-        star_image.setOrigin(0, 0)
+            star_image = _makeSharedImage(n_star_x * xsize, n_star_y * ysize, pixel_scale)
+            blocks = _getRowBlocks(len(star_catalog), n_star_x, nproc)
+            _drawImagePool(self, self._drawStarStamps, epoch_parameters, star_catalog,
+                           star_image, blocks, nproc)
+
+        # Write the entire star field image to file.
+        self.mapper.write(star_image, "starfield_image", epoch_parameters)
+
+    def _drawStarStamps(self, epoch_parameters, star_catalog, image, index_min, index_max):
+        """Draw the stars with catalog indices in [index_min, index_max) into their postage stamps
+        on `image`.  As in _drawGalaxyStamps(), the random seed for each object depends only on its
+        index in the catalog.
+        """
+        seed = epoch_parameters["noise_seed"] + index_min
+
+        # Make a galsim.Pixel representing the top-hat pixel.
+        pixel_scale = constants.pixel_scale[self.obs_type][self.multiepoch]
+        pixel = galsim.Pixel(pixel_scale)
 
         # Set up a cache for the galsim.GSObject corresponding to this star.  This is useful for
         # constant PSF branches, for which the star is the same in each star image (just shifted).
         cached_psf_obj = None
-        for record in star_catalog:
+        for record in star_catalog[index_min:index_max]:
             rng = galsim.UniformDeviate(seed)
             seed = seed + 1
 
@@ -1051,7 +1220,7 @@ class SimBuilder(object):
                 xmin=int(record['xmin']), ymin=int(record['ymin']),
                 xmax=int(record['xmax']), ymax=int(record['ymax']),
             )
-            stamp = star_image.subImage(bbox)
+            stamp = image.subImage(bbox)
 
             # Build PSF (or take cached value if possible).
             if not self.variable_psf:
@@ -1075,9 +1244,6 @@ class SimBuilder(object):
                 self.noise_builder.addStarImageNoise(
                     rng, epoch_parameters['noise'], record['star_snr'], stamp)
 
-        # Write the entire star field image to file.
-        self.mapper.write(star_image, "starfield_image", epoch_parameters)
-
     def writeStarParameters(self, subfield_index, epoch_index):
         """This method writes out a dict for the PSF shapes needed for metric calculation.  The
         metric calculation for constant shear requires us to know the direction of PSF anisotropy,
@@ -1163,11 +1329,179 @@ class SimBuilder(object):
         # Write the results to the appropriate file using the mapper.
         self.mapper.write(starshape_parameters, "starshape_parameters", starshape_parameters)
 
-    def packagePublic(self, subfield_min, subfield_max):
+    def checkCatalogs(self, subfield_min, subfield_max):
+        """Check the subfield, epoch and star catalogs for a range of subfields for NaN and Inf
+        values, raising a RuntimeError that lists all bad catalogs, columns and rows.  This is
+        meant to be used before packaging when the check was deferred while writing the catalogs.
+
+        @param[in] subfield_min  Minimum subfield index to check.
+        @param[in] subfield_max  Maximum subfield index to check.
+        """
+        subfield_ids = [{"subfield_index": subfield_index}
+                        for subfield_index in xrange(subfield_min, subfield_max+1)]
+        epoch_ids = [{"subfield_index": subfield_index, "epoch_index": epoch_index}
+                     for subfield_index in xrange(subfield_min, subfield_max+1)
+                     for epoch_index in xrange(self.n_epochs)]
+        errors = []
+        for dataset, data_ids in [("subfield_catalog", subfield_ids),
+                                  ("epoch_catalog", epoch_ids),
+                                  ("star_catalog", epoch_ids)]:
+            try:
+                self.mapper.checkCatalogs(dataset, data_ids)
+            except RuntimeError as err:
+                errors.append(str(err))
+        if errors:
+            raise RuntimeError("\n".join(errors))
+
+    def writePackages(self, subfield_min, subfield_max, compress_pool=None):
+        """Write the public and truth tarballs for a range of subfields, first checking the catalogs
+        for NaN and Inf values if that was not done when writing them.  See packagePublic() and
+        packageTruth() for the meaning of the arguments.
+        """
+        if not self.mapper.check_catalogs:
+            self.checkCatalogs(subfield_min, subfield_max)
+        self.packagePublic(subfield_min, subfield_max, compress_pool=compress_pool)
+        self.packageTruth(subfield_min, subfield_max, compress_pool=compress_pool)
+
+    def getTasks(self, step, subfield_min, subfield_max, seed=None, compress_pool=None):
+        """Split one of the steps of great3sims.run() into Tasks (see tasks.py), in the order in
+        which they should be done, with the files each of them reads and writes.
+
+        @param[in] step           Name of the step, one of 'metaparameters', 'catalogs', 'config',
+                                  'gal_images', 'psf_images', 'star_params', 'packages'.
+        @param[in] subfield_min   Minimum subfield index.
+        @param[in] subfield_max   Maximum subfield index.
+        @param[in] seed           Random number seed, for the 'metaparameters' step.
+        @param[in] compress_pool  Thread pool for the 'packages' step; see packagePublic().
+
+        @return a list of great3sims.tasks.Task instances.
+        """
+        from great3sims.tasks import Task
+        path = self.mapper.getPath
+        subfield_range = xrange(subfield_min, subfield_max+1)
+        epoch_range = xrange(self.n_epochs)
+        range_params = {"subfield_min": subfield_min, "subfield_max": subfield_max}
+        # Options that change what the catalogs and images look like, other than those recorded in
+        # the metaparameters (which are inputs of the later steps), and the input data directories.
+        # Options that only change how quickly the work is done (e.g., preload and image_nproc) are
+        # left out.
+        catalog_params = dict(self.input_dirs, gal_pairs=self.gal_pairs)
+        image_params = dict(self.input_dirs,
+                            optical_psf_cache_tol=getattr(self.psf_builder,
+                                                          "optical_psf_cache_tol", None))
+        n_subfields_per_field = constants.n_subfields_per_field[self.shear_type][self.variable_psf]
+
+        if step == 'metaparameters':
+            # The metaparameters are always generated for all subfields at once.
+            outputs = [path('parameters')]
+            outputs.extend(path('field_parameters', field_index=field_index)
+                           for field_index in xrange(constants.n_subfields / n_subfields_per_field))
+            for subfield_index in xrange(constants.n_subfields):
+                outputs.append(path('subfield_parameters', subfield_index=subfield_index))
+                outputs.extend(path('epoch_parameters', subfield_index=subfield_index,
+                                    epoch_index=epoch_index) for epoch_index in epoch_range)
+            params = {"seed": seed, "shear_value": self.shear_value,
+                      "shear_angle": self.shear_angle, "draw_psf_src": self.draw_psf_src}
+            return [Task(step, None, None, self.writeParameters, (seed,), outputs=outputs,
+                         params=params)]
+
+        tasks = []
+        if step == 'catalogs':
+            for subfield_index in subfield_range:
+                field_index = subfield_index / n_subfields_per_field
+                inputs = [path('subfield_parameters', subfield_index=subfield_index),
+                          path('field_parameters', field_index=field_index)]
+                tasks.append(Task(step, subfield_index, None, self.writeSubfieldCatalog,
+                                  (subfield_index,), inputs=inputs,
+                                  outputs=[path('subfield_catalog', subfield_index=subfield_index)],
+                                  params=catalog_params))
+                for epoch_index in epoch_range:
+                    data_id = {"subfield_index": subfield_index, "epoch_index": epoch_index}
+                    inputs = [path('epoch_parameters', data_id), path('subfield_catalog', data_id)]
+                    if epoch_index > 0:
+                        # Later epochs copy the star positions and S/N from the first one.
+                        inputs.append(path('star_catalog', subfield_index=subfield_index,
+                                           epoch_index=0))
+                    tasks.append(Task(step, subfield_index, epoch_index, self.writeEpochCatalog,
+                                      (subfield_index, epoch_index), inputs=inputs,
+                                      outputs=[path('epoch_catalog', data_id),
+                                               path('star_catalog', data_id)],
+                                      params=catalog_params))
+            inputs = [path(dataset, subfield_index=subfield_index, epoch_index=epoch_index)
+                      for subfield_index in subfield_range for epoch_index in epoch_range
+                      for dataset in ('epoch_parameters', 'star_catalog')]
+            tasks.append(Task(step, None, None, self.writeStarTestCatalog,
+                              (subfield_min, subfield_max), inputs=inputs,
+                              outputs=[path('star_test_catalog')], params=range_params))
+        elif step == 'config':
+            letters = self.experiment[0] + self.obs_type[0] + self.shear_type[0]
+            outputs = [os.path.join(self.mapper.root, letters + suffix)
+                       for suffix in ('_psf.yaml', '.yaml', '_star_test.yaml')]
+            # The config files refer to the catalogs that GalSim will read, so they are inputs here
+            # (for the config files to be rewritten if the catalogs are), as is the preload option,
+            # which is written into the config files.
+            inputs = [path(dataset, subfield_index=subfield_index, epoch_index=epoch_index)
+                      for subfield_index in subfield_range for epoch_index in epoch_range
+                      for dataset in ('epoch_parameters', 'epoch_catalog', 'star_catalog')]
+            inputs.append(path('star_test_catalog'))
+            params = dict(range_params, nproc=self.nproc, preload=self.preload, **self.input_dirs)
+            tasks.append(Task(step, None, None, self.writeConfig,
+                              (self.experiment, self.obs_type, self.shear_type, subfield_min,
+                               subfield_max), inputs=inputs, outputs=outputs, params=params))
+        elif step in ('gal_images', 'psf_images', 'star_params'):
+            func, inputs, outputs = {
+                'gal_images': (self.writeGalImage, ['epoch_parameters', 'epoch_catalog'],
+                               ['image']),
+                'psf_images': (self.writePSFImage, ['epoch_parameters', 'star_catalog'],
+                               ['starfield_image']),
+                'star_params': (self.writeStarParameters,
+                                ['epoch_parameters', 'star_catalog', 'starfield_image'],
+                                ['starshape_parameters'])
+            }[step]
+            for subfield_index in subfield_range:
+                for epoch_index in epoch_range:
+                    data_id = {"subfield_index": subfield_index, "epoch_index": epoch_index}
+                    tasks.append(Task(step, subfield_index, epoch_index, func,
+                                      (subfield_index, epoch_index),
+                                      inputs=[path(dataset, data_id) for dataset in inputs],
+                                      outputs=[path(dataset, data_id) for dataset in outputs],
+                                      params=image_params))
+        elif step == 'packages':
+            # The star test images are only made by GalSim from the config files, and are packaged
+            # if they exist.
+            inputs = [path('parameters'), path('star_test_catalog'),
+                      path('star_test_images') + '.fits']
+            for subfield_index in subfield_range:
+                inputs.extend(path(dataset, subfield_index=subfield_index)
+                              for dataset in ('subfield_parameters', 'subfield_catalog'))
+                for epoch_index in epoch_range:
+                    data_id = {"subfield_index": subfield_index, "epoch_index": epoch_index}
+                    inputs.extend(path(dataset, data_id)
+                                  for dataset in ('epoch_parameters', 'epoch_catalog',
+                                                  'star_catalog', 'image', 'starfield_image'))
+                    if self.shear_type == "constant":
+                        inputs.append(path('starshape_parameters', data_id))
+            tarball_name = self.experiment+'-'+self.obs_type+'-'+self.shear_type+'.tar.gz'
+            outputs = [os.path.join(self.public_dir, tarball_name),
+                       os.path.join(self.truth_dir, tarball_name)]
+            tasks.append(Task(step, None, None, self.writePackages,
+                              (subfield_min, subfield_max, compress_pool), inputs=inputs,
+                              outputs=outputs, params=range_params))
+        else:
+            raise ValueError("Unknown step '%s'" % step)
+        return tasks
+
+    def packagePublic(self, subfield_min, subfield_max, compress_pool=None):
         """This method packages up the public outputs (no truth values) into a single big tarfile
-        for this branch.  We can choose to use a subset of the subfields if we wish."""
+        for this branch.  We can choose to use a subset of the subfields if we wish.
+
+        The images are streamed into the tarfile straight from the branch directory, and only the
+        (small) public catalogs and parameter files are written out, to a scratch directory, before
+        being added.  The tarfile is compressed in blocks by the thread pool `compress_pool`, which
+        may be shared with other branches being packaged at the same time; if None, a pool with as
+        many threads as processes used to draw images (see _getImageNproc()) is used."""
         import shutil
-        import tarfile
+        import tempfile
 
         # First, do some basic calculations related to the deep fields.  If they are included in the
         # range of requested subfields, i.e., (subfield_min, ..., subfield_max), then things are
@@ -1187,28 +1521,48 @@ class SimBuilder(object):
             warnings.warn(deep_warning)
             subfield_max = max_deep_subfield
 
-        # Define the output directory (and create if necessary).  Use a mapper for this.
-        public_mapper = great3sims.mapper.Mapper(self.public_dir, self.experiment, self.obs_type,
-                                                 self.shear_type)
-        # Also define an absolute path to the root directory structure, because we're going to be
-        # moving around, so self.mapper (which uses relative path) won't work.
-        root_rel_mapper = great3sims.mapper.Mapper(os.path.abspath(self.mapper.root),
-                                                   self.experiment, self.obs_type, self.shear_type)
+        # Define the output directory (and create if necessary), and a scratch directory within it
+        # into which the public catalogs and parameter files are written before being packaged.
+        # Use a mapper for the latter.
+        if not os.path.exists(self.public_dir):
+            os.makedirs(self.public_dir)
+        scratch_dir = tempfile.mkdtemp(dir=self.public_dir)
+        sub_mapper = great3sims.mapper.Mapper(scratch_dir, self.experiment, self.obs_type,
+                                              self.shear_type)
 
         # Zipping / tarring.  Open tarfile at the start, then add the files as they are created.
+        # The names of the files in the tarfile start with experiment/obs_type/shear_type/, not
+        # with public_dir/, since otherwise when untarred they end up in public_dir/public_dir/...
+        # which is kind of silly.
         tarfile_name = os.path.join(self.public_dir,
                                     self.experiment+'-'+self.obs_type+'-'+self.shear_type+'.tar.gz')
-        tar = tarfile.open(tarfile_name, "w:gz")
-
-        # Now we want to move into public_dir.  The reason for this is that we don't want the files
-        # in public_dir that go into the tarfile to have public_dir/ at the start of their paths,
-        # otherwise when untarred they end up in public_dir/public_dir/... which is kind of silly.
-        saved_path = os.getcwd()
-        os.chdir(self.public_dir)
-        sub_mapper = great3sims.mapper.Mapper('.', self.experiment, self.obs_type, self.shear_type)
+        pool = self._getCompressPool(compress_pool)
+        # If anything goes wrong, the incomplete tarfile is deleted rather than left to look like a
+        # finished one.  Either way, the pool (if made here) and the scratch directory are cleaned
+        # up, just keeping the tarfiles.
+        tar = None
+        try:
+            tar = great3sims.packaging.TarballWriter(tarfile_name, pool=pool)
+            self._addPublicFiles(tar, sub_mapper, subfield_min, subfield_max, n_reg_subfields)
+            tar.close()
+            tar = None
+        finally:
+            if tar is not None:
+                tar.abort()
+            if pool is not compress_pool:
+                pool.close()
+                pool.join()
+            shutil.rmtree(scratch_dir)
+
+    def _addPublicFiles(self, tar, sub_mapper, subfield_min, subfield_max, n_reg_subfields):
+        """Add the public files for subfields [subfield_min, subfield_max] to the tarfile `tar` being
+        written by packagePublic(), writing the catalogs and parameter files into the directory of
+        `sub_mapper` first.  `n_reg_subfields` is the number of subfields that are not deep
+        fields."""
+        max_reg_subfield = n_reg_subfields - 1
         for subfield_index in xrange(subfield_min, subfield_max+1):
             # Loop over galaxy and star field images for the defined set of subfields and epochs,
-            # and copy over without modification of any sort.
+            # and add them without modification of any sort.
             tmp_dict = {"subfield_index" : subfield_index}
             if subfield_index > max_reg_subfield:
                     tmp_dict["deep_subfield_index"] = subfield_index - n_reg_subfields
@@ -1216,18 +1570,14 @@ class SimBuilder(object):
             for epoch_index in xrange(self.n_epochs):
                 tmp_dict["epoch_index"] = epoch_index
                 if subfield_index <= max_reg_subfield:
-                    outfile = root_rel_mapper.copyTo(sub_mapper, 'image', tmp_dict)
-                    tar.add(outfile)
-                    outfile = root_rel_mapper.copyTo(sub_mapper, 'starfield_image', tmp_dict)
-                    tar.add(outfile)
+                    self._packageDataset(tar, sub_mapper, 'image', tmp_dict)
+                    self._packageDataset(tar, sub_mapper, 'starfield_image', tmp_dict)
                 else:
-                    outfile = root_rel_mapper.copyTo(sub_mapper, 'image', tmp_dict,
+                    self._packageDataset(tar, sub_mapper, 'image', tmp_dict,
                         new_template = "deep_image-%(deep_subfield_index)03d-%(epoch_index)1d.fits")
-                    tar.add(outfile)
-                    outfile = root_rel_mapper.copyTo(sub_mapper, 'starfield_image', tmp_dict,
+                    self._packageDataset(tar, sub_mapper, 'starfield_image', tmp_dict,
                         new_template = \
                              "deep_starfield_image-%(deep_subfield_index)03d-%(epoch_index)1d.fits")
-                    tar.add(outfile)
 
             # Loop over galaxy catalogs for each subfield, and copy only the information we want to
             # be public.  For now, let's stick with 'x', 'y', 'ID'.  We could consider giving the
@@ -1251,39 +1601,39 @@ class SimBuilder(object):
                 tmp_dict = {"subfield_index" : subfield_index}
                 if self.variable_psf:
                     tmp_dict["epoch_index"] = 0
-                    outfile = root_rel_mapper.mergeSub(sub_mapper, 'subfield_catalog',
-                                                      'epoch_catalog', tmp_dict, gal_use_cols,
-                                                      gal_epoch_use_cols,
-                                                      new_template =
-                                                      "galaxy_catalog-%(subfield_index)03d")
+                    outfile = self.mapper.mergeSub(sub_mapper, 'subfield_catalog',
+                                                  'epoch_catalog', tmp_dict, gal_use_cols,
+                                                  gal_epoch_use_cols,
+                                                  new_template =
+                                                  "galaxy_catalog-%(subfield_index)03d")
                 else:
-                    outfile = root_rel_mapper.copySub(sub_mapper, 'subfield_catalog', tmp_dict,
-                                                      gal_use_cols,
-                                                      new_template =
-                                                      "galaxy_catalog-%(subfield_index)03d")
+                    outfile = self.mapper.copySub(sub_mapper, 'subfield_catalog', tmp_dict,
+                                                  gal_use_cols,
+                                                  new_template =
+                                                  "galaxy_catalog-%(subfield_index)03d")
             else:
                 tmp_dict["deep_subfield_index"] = subfield_index - n_reg_subfields
                 if self.variable_psf:
                     tmp_dict["epoch_index"] = 0
-                    outfile = root_rel_mapper.mergeSub(sub_mapper, 'subfield_catalog',
-                                                      'epoch_catalog', tmp_dict, gal_use_cols,
-                                                      gal_epoch_use_cols,
-                                                      new_template =
-                                                      "deep_galaxy_catalog-%(subfield_index)03d")
+                    outfile = self.mapper.mergeSub(sub_mapper, 'subfield_catalog',
+                                                  'epoch_catalog', tmp_dict, gal_use_cols,
+                                                  gal_epoch_use_cols,
+                                                  new_template =
+                                                  "deep_galaxy_catalog-%(subfield_index)03d")
                 else:
                     # If this line is not in an 'else' statement, then it will simply overwrite the
                     # correct FITS catalog with one that lacks some important columns that are
                     # necessary for variable PSF experiments!  Oops.  And then those incorrect
                     # catalogs will be converted to the text versions, which will also be wrong.
-                    outfile = root_rel_mapper.copySub(sub_mapper, 'subfield_catalog', tmp_dict,
-                                                      gal_use_cols,
-                                                      new_template =
-                                                      "deep_galaxy_catalog-%(deep_subfield_index)03d")
-            tar.add(outfile)
+                    outfile = self.mapper.copySub(sub_mapper, 'subfield_catalog', tmp_dict,
+                                                  gal_use_cols,
+                                                  new_template =
+                                                  "deep_galaxy_catalog-%(deep_subfield_index)03d")
             # ... and also copy to text file that gets added to the tarball.
             outfile_no_ext = os.path.splitext(outfile)[0]
             great3sims.mapper.fitsToTextCatalog(outfile_no_ext)
-            tar.add(outfile_no_ext + '.txt')
+            self._packageFile(tar, sub_mapper, outfile)
+            self._packageFile(tar, sub_mapper, outfile_no_ext + '.txt')
 
             # Loop over star catalogs, and copy only the information that we want to be public.  For
             # constant PSF branches, this is just 'x' and 'y'.  For variable PSF branches, we want
@@ -1298,28 +1648,28 @@ class SimBuilder(object):
                 star_use_cols = [('x', int), ('y', int)]
             if subfield_index <= max_reg_subfield:
                 tmp_dict = {"subfield_index" : subfield_index, "epoch_index" : 0}
-                outfile = root_rel_mapper.copySub(
+                outfile = self.mapper.copySub(
                     sub_mapper, 'star_catalog', tmp_dict, star_use_cols,
                     new_template="star_catalog-%(subfield_index)03d")
             else:
                 tmp_dict["deep_subfield_index"] = subfield_index - n_reg_subfields
                 tmp_dict["epoch_index"] = 0
-                outfile = root_rel_mapper.copySub(
+                outfile = self.mapper.copySub(
                     sub_mapper, 'star_catalog', tmp_dict, star_use_cols,
                     new_template="deep_star_catalog-%(deep_subfield_index)03d")
             # ... and also copy to text file that gets added to the tarball.
             outfile_no_ext = os.path.splitext(outfile)[0]
             great3sims.mapper.fitsToTextCatalog(outfile_no_ext)
-            tar.add(outfile)
-            tar.add(outfile_no_ext+'.txt')
+            self._packageFile(tar, sub_mapper, outfile)
+            self._packageFile(tar, sub_mapper, outfile_no_ext+'.txt')
 
             # We can also give some overall information about subfield offsets.  For now, we use the
             # subfield_parameters file, extract subfield_offset [which currently is in units of
             # separation between galaxies in the grid], convert that to degrees, and output that as
             # a yaml file and a text file.  This is redundant, but since the files are tiny it
             # doesn't seem like a big issue to support both formats.
-            template, reader, writer = root_rel_mapper.mappings['subfield_parameters']
-            in_path = os.path.join(root_rel_mapper.full_dir, template % tmp_dict)
+            template, reader, writer = self.mapper.mappings['subfield_parameters']
+            in_path = os.path.join(self.mapper.full_dir, template % tmp_dict)
             subfield_params = great3sims.mapper.readDict(in_path)
             mult_val = constants.image_size_deg / constants.nrows
             offset_parameters = {
@@ -1333,8 +1683,8 @@ class SimBuilder(object):
             outfile = os.path.join(sub_mapper.full_dir, template % tmp_dict)
             great3sims.mapper.writeDict(offset_parameters, outfile)
             great3sims.mapper.writeDict(offset_parameters, outfile, type='txt')
-            tar.add(outfile + '.yaml')
-            tar.add(outfile + '.txt')
+            self._packageFile(tar, sub_mapper, outfile + '.yaml')
+            self._packageFile(tar, sub_mapper, outfile + '.txt')
 
             # Finally, for each epoch, we need to give information about the size of the dithering
             # with respect to the first epoch.  For the sake of having a consistent data format for
@@ -1345,8 +1695,8 @@ class SimBuilder(object):
             # txt format.
             for epoch_index in xrange(self.n_epochs):
                 tmp_dict["epoch_index"] = epoch_index
-                template, reader, writer = root_rel_mapper.mappings['epoch_parameters']
-                in_path = os.path.join(root_rel_mapper.full_dir, template % tmp_dict)
+                template, reader, writer = self.mapper.mappings['epoch_parameters']
+                in_path = os.path.join(self.mapper.full_dir, template % tmp_dict)
                 epoch_params = great3sims.mapper.readDict(in_path)
                 dither_parameters = {
                     "xdither_pixels": epoch_params['xdither'],
@@ -1359,23 +1709,19 @@ class SimBuilder(object):
                 outfile = os.path.join(sub_mapper.full_dir, template % tmp_dict)
                 great3sims.mapper.writeDict(dither_parameters, outfile)
                 great3sims.mapper.writeDict(dither_parameters, outfile, type='txt')
-                tar.add(outfile + '.yaml')
-                tar.add(outfile + '.txt')
-
-        # Close the tarfile.  Now that we're done with it, we can go back to our original working
-        # directory.
-        tar.close()
-        os.chdir(saved_path)
+                self._packageFile(tar, sub_mapper, outfile + '.yaml')
+                self._packageFile(tar, sub_mapper, outfile + '.txt')
 
-        # Delete the files / dirs, just keep the tarfiles.
-        shutil.rmtree(public_mapper.full_dir)
-
-    def packageTruth(self, subfield_min, subfield_max):
+    def packageTruth(self, subfield_min, subfield_max, compress_pool=None):
         """This method packages up the true shear values and PSF ellipticities for metric
-        calculations.
+        calculations.  The tarfile is written in the same way as in packagePublic().
+
+        Along with the YAML and text files, the tarfile includes a great3sims.mapper.ParameterStore
+        holding all of the dicts that are packaged, which metrics/evaluate.py reads instead of the
+        YAML files when it is present.
         """
         import shutil
-        import tarfile
+        import tempfile
 
         # First, do some basic calculations related to the deep fields.  If they are included in the
         # range of requested subfields, i.e., (subfield_min, ..., subfield_max), then emit a warning
@@ -1388,39 +1734,62 @@ class SimBuilder(object):
             warnings.warn(deep_warning)
             subfield_max = n_reg_subfields - 1
 
-        # Define the output directory (and create if necessary).  Use a mapper for this.
-        truth_mapper = great3sims.mapper.Mapper(self.truth_dir, self.experiment, self.obs_type,
-                                                self.shear_type)
-        # Also define an absolute path to the root directory structure, because we're going to be
-        # moving around, so self.mapper (which uses relative path) won't work.
-        root_rel_mapper = great3sims.mapper.Mapper(os.path.abspath(self.mapper.root),
-                                                   self.experiment, self.obs_type, self.shear_type)
+        # Define the output directory (and create if necessary), and a scratch directory within it
+        # into which the truth catalogs and parameter files are written before being packaged.
+        # Use a mapper for the latter.
+        if not os.path.exists(self.truth_dir):
+            os.makedirs(self.truth_dir)
+        scratch_dir = tempfile.mkdtemp(dir=self.truth_dir)
+        sub_mapper = great3sims.mapper.Mapper(scratch_dir, self.experiment, self.obs_type,
+                                              self.shear_type)
 
         # Zipping / tarring.  Open tarfile at the start, then add the files as they are created.
+        # The names of the files in the tarfile start with experiment/obs_type/shear_type/, not
+        # with truth_dir/, since otherwise when untarred they end up in truth_dir/truth_dir/...
+        # which is kind of silly.
         tarfile_name = os.path.join(self.truth_dir,
                                     self.experiment+'-'+self.obs_type+'-'+self.shear_type+'.tar.gz')
-        tar = tarfile.open(tarfile_name, "w:gz")
-
-        # Now we want to move into truth_dir.  The reason for this is that we don't want the files
-        # in truth_dir that go into the tarfile to have truth_dir/ at the start of their paths,
-        # otherwise when untarred they end up in truth_dir/truth_dir/... which is kind of silly.
-        saved_path = os.getcwd()
-        os.chdir(self.truth_dir)
-        sub_mapper = great3sims.mapper.Mapper('.', self.experiment, self.obs_type, self.shear_type)
-
-        # First, we copy over the star test catalog and images.
+        pool = self._getCompressPool(compress_pool)
+        # If anything goes wrong, the incomplete tarfile is deleted rather than left to look like a
+        # finished one.  Either way, the pool (if made here) and the scratch directory are cleaned
+        # up, just keeping the tarfiles.
+        tar = None
+        try:
+            tar = great3sims.packaging.TarballWriter(tarfile_name, pool=pool)
+            self._addTruthFiles(tar, sub_mapper, subfield_min, subfield_max)
+            tar.close()
+            tar = None
+        finally:
+            if tar is not None:
+                tar.abort()
+            if pool is not compress_pool:
+                pool.close()
+                pool.join()
+            shutil.rmtree(scratch_dir)
+
+    def _addTruthFiles(self, tar, sub_mapper, subfield_min, subfield_max):
+        """Add the truth files for subfields [subfield_min, subfield_max] to the tarfile `tar` being
+        written by packageTruth(), writing them into the directory of `sub_mapper` first."""
+        # Each dict that is packaged is also added to a ParameterStore, which is packaged last.
+        store = great3sims.mapper.ParameterStore(sub_mapper.full_dir, create=True)
+
+        # First, we add the star test catalog and images.
         # Make the old, new target filenames for the star test catalog:
-        template, reader, writer = root_rel_mapper.mappings['star_test_catalog']
-        infile = os.path.join(root_rel_mapper.full_dir, template % {}) + '.fits'
-        outfile = os.path.join(sub_mapper.full_dir, template % {}) + '.fits'
-        shutil.copy2(infile, outfile)
-        tar.add(outfile)
-        template, reader, writer = root_rel_mapper.mappings['star_test_images']
-        infile = os.path.join(root_rel_mapper.full_dir, template % {}) + '.fits'
+        # The catalog in the tarball is always FITS, so convert it if it was written in another format.
+        template, reader, writer = self.mapper.mappings['star_test_catalog']
         outfile = os.path.join(sub_mapper.full_dir, template % {}) + '.fits'
+        if self.mapper.catalog_types.get('star_test_catalog', 'fits') == 'fits':
+            infile = os.path.join(self.mapper.full_dir, template % {}) + '.fits'
+            self._packageFile(tar, sub_mapper, infile, remove=False)
+        else:
+            import pyfits
+            star_test_catalog = reader(os.path.join(self.mapper.full_dir, template % {}))
+            pyfits.writeto(outfile, numpy.asarray(star_test_catalog), clobber = True)
+            self._packageFile(tar, sub_mapper, outfile)
+        template, reader, writer = self.mapper.mappings['star_test_images']
+        infile = os.path.join(self.mapper.full_dir, template % {}) + '.fits'
         if os.path.exists(infile):
-            shutil.copy2(infile, outfile)
-            tar.add(outfile)
+            self._packageFile(tar, sub_mapper, infile, remove=False)
 
         # Now do all the per-subfield stuff.
         for subfield_index in xrange(subfield_min, subfield_max+1):
@@ -1431,11 +1800,11 @@ class SimBuilder(object):
             if self.shear_type == 'variable':
                 use_cols = [('ID', int), ('g1', float), ('g2', float),
                             ('g1_intrinsic', float), ('g2_intrinsic', float)]
-                outfile = root_rel_mapper.copySub(sub_mapper, 'subfield_catalog', tmp_dict,
-                                                  use_cols,
-                                                  new_template =
-                                                  "galaxy_catalog-%(subfield_index)03d")
-                tar.add(outfile)
+                outfile = self.mapper.copySub(sub_mapper, 'subfield_catalog', tmp_dict,
+                                              use_cols,
+                                              new_template =
+                                              "galaxy_catalog-%(subfield_index)03d")
+                self._packageFile(tar, sub_mapper, outfile)
 
                 # We can also give some overall information about subfield offsets.  This is
                 # necessary for variable shear sims in order to convert the positions in each
@@ -1444,8 +1813,8 @@ class SimBuilder(object):
                 # galaxies in the grid], convert that to degrees, and output that as a yaml file and
                 # a text file.  This is redundant, but since the files are tiny it doesn't seem like
                 # a big issue to support both formats.
-                template, reader, writer = root_rel_mapper.mappings['subfield_parameters']
-                in_path = os.path.join(root_rel_mapper.full_dir, template % tmp_dict)
+                template, reader, writer = self.mapper.mappings['subfield_parameters']
+                in_path = os.path.join(self.mapper.full_dir, template % tmp_dict)
                 subfield_params = great3sims.mapper.readDict(in_path)
                 mult_val = constants.image_size_deg / constants.nrows
                 offset_parameters = {
@@ -1456,13 +1825,14 @@ class SimBuilder(object):
                 outfile = os.path.join(sub_mapper.full_dir, template % tmp_dict)
                 great3sims.mapper.writeDict(offset_parameters, outfile)
                 great3sims.mapper.writeDict(offset_parameters, outfile, type='txt')
-                tar.add(outfile + '.yaml')
-                tar.add(outfile + '.txt')
+                store.write(offset_parameters, "subfield_offset", tmp_dict)
+                self._packageFile(tar, sub_mapper, outfile + '.yaml')
+                self._packageFile(tar, sub_mapper, outfile + '.txt')
 
             else:
                 # If constant shear, then take the subfield g1, g2 and write as yaml/text.
-                template, reader, writer = root_rel_mapper.mappings['subfield_parameters']
-                in_path = os.path.join(root_rel_mapper.full_dir, template % tmp_dict)
+                template, reader, writer = self.mapper.mappings['subfield_parameters']
+                in_path = os.path.join(self.mapper.full_dir, template % tmp_dict)
                 subfield_params = great3sims.mapper.readDict(in_path)
                 shear_params = {
                     "g1": subfield_params['shear']['g1'],
@@ -1472,8 +1842,9 @@ class SimBuilder(object):
                 outfile = os.path.join(sub_mapper.full_dir, template % tmp_dict)
                 great3sims.mapper.writeDict(shear_params, outfile)
                 great3sims.mapper.writeDict(shear_params, outfile, type='txt')
-                tar.add(outfile + '.yaml')
-                tar.add(outfile + '.txt')
+                store.write(shear_params, "shear_params", tmp_dict)
+                self._packageFile(tar, sub_mapper, outfile + '.yaml')
+                self._packageFile(tar, sub_mapper, outfile + '.txt')
 
                 # If this branch has constant shear, then we need the PSF (star) shape parameters.
                 if self.shear_type == "constant":
@@ -1481,22 +1852,45 @@ class SimBuilder(object):
                     # copyTo() because we want to write as .txt in addition to .yaml
                     for epoch_index in xrange(self.n_epochs):
                         tmp_dict["epoch_index"] = epoch_index
-                        template, reader, writer = root_rel_mapper.mappings['starshape_parameters']
-                        in_path = os.path.join(root_rel_mapper.full_dir, template % tmp_dict)
+                        template, reader, writer = self.mapper.mappings['starshape_parameters']
+                        in_path = os.path.join(self.mapper.full_dir, template % tmp_dict)
                         starshape_params = great3sims.mapper.readDict(in_path)
                         outfile = os.path.join(sub_mapper.full_dir, template % tmp_dict)
                         great3sims.mapper.writeDict(starshape_params, outfile)
                         great3sims.mapper.writeDict(starshape_params, outfile, type='txt')
-                        tar.add(outfile + '.yaml')
-                        tar.add(outfile + '.txt')
-
-        # Close the tarfile.  Now that we're done with it, we can go back to our original working
-        # directory.
-        tar.close()
-        os.chdir(saved_path)
-
-        # Delete the files / dirs, just keep the tarfiles.
-        shutil.rmtree(truth_mapper.full_dir)
+                        store.write(starshape_params, "starshape_parameters", tmp_dict)
+                        self._packageFile(tar, sub_mapper, outfile + '.yaml')
+                        self._packageFile(tar, sub_mapper, outfile + '.txt')
+
+        store.save()
+        self._packageFile(tar, sub_mapper, store.path + ".p")
+
+    def _getCompressPool(self, compress_pool):
+        """Decide which thread pool to use to compress a tarfile, given the `compress_pool`
+        argument to packagePublic() or packageTruth().  A new pool is made if it is None, which the
+        caller should close when done."""
+        if compress_pool is not None:
+            return compress_pool
+        import multiprocessing.pool
+        return multiprocessing.pool.ThreadPool(self._getImageNproc(None))
+
+    def _packageFile(self, tar, sub_mapper, path, remove=True):
+        """Add the file `path` to a tarfile being written by packagePublic() or packageTruth(),
+        under the name it would have in the directory of `sub_mapper`, relative to its root.  By
+        default the file is then deleted, since it was only written in order to be packaged."""
+        arcname = os.path.join(os.curdir, sub_mapper.dir, os.path.basename(path))
+        tar.add(path, arcname, remove=remove)
+
+    def _packageDataset(self, tar, sub_mapper, dataset, data_id, new_template=None):
+        """Add a dataset from this branch to a tarfile being written by packagePublic(), under the
+        name that Mapper.copyTo() would give to a copy of it in the directory of `sub_mapper`, but
+        without making that copy."""
+        template, reader, writer = self.mapper.mappings[dataset]
+        if new_template is None:
+            new_template = template
+        infile = os.path.join(self.mapper.full_dir, template % data_id)
+        arcname = os.path.join(os.curdir, sub_mapper.dir, new_template % data_id)
+        tar.add(infile, arcname)
 
     def generateSubfieldOffsets(self, rng, n_subfields_per_field, subfield_grid_subsampling):
         """A utility to decide about the offsets between subfields in a field.
@@ -156,7 +156,224 @@ _gammafn._a = ( 1.00000000000000000000, 0.57721566490153286061, -0.6558780715202
                0.00000000000000122678, -0.00000000000000011813, 0.00000000000000000119,
                0.00000000000000000141, -0.00000000000000000023, 0.00000000000000000002
              )
- 
+
+def _splineWeights(x_arr, x):
+    """Return the weights w for which np.dot(f, w) is the value at `x` of the natural cubic spline
+    through the points (x_arr, f), for any f.  This is the default interpolant of
+    galsim.LookupTable, so it can be used to evaluate many tables with the same `x_arr` at once.
+
+    @param[in] x_arr   The tabulated x values, in increasing order.
+    @param[in] x       The value at which to interpolate, within the range of x_arr.
+    """
+    n = len(x_arr)
+    h = np.diff(x_arr)
+    # The second derivatives at the interior points depend linearly on f; the natural spline has
+    # zero second derivative at the end points.  Row i of d2 gives the weights for the second
+    # derivative at x_arr[i].
+    d2 = np.zeros((n, n))
+    if n > 2:
+        a_mat = np.zeros((n-2, n-2))
+        b_mat = np.zeros((n-2, n))
+        for i in range(1, n-1):
+            a_mat[i-1, i-1] = 2.*(h[i-1]+h[i])
+            if i > 1:
+                a_mat[i-1, i-2] = h[i-1]
+            if i < n-2:
+                a_mat[i-1, i] = h[i]
+            b_mat[i-1, i-1] = 6./h[i-1]
+            b_mat[i-1, i] = -6./h[i-1] - 6./h[i]
+            b_mat[i-1, i+1] = 6./h[i]
+        d2[1:n-1] = np.linalg.solve(a_mat, b_mat)
+
+    # Find the interval containing x, and combine the weights for its two end points.
+    k = min(max(np.searchsorted(x_arr, x) - 1, 0), n-2)
+    b = (x - x_arr[k]) / h[k]
+    a = 1. - b
+    w = ((a**3-a)*d2[k] + (b**3-b)*d2[k+1]) * h[k]**2 / 6.
+    w[k] += a
+    w[k+1] += b
+    return w
+
+def _interpolateTable(x_arr, table, x, f_log=False):
+    """Interpolate each row of a 2-d (n_objects x n_x) array of values tabulated at `x_arr` to the
+    value `x`, returning a 1-d array of length n_objects.  This gives the same results as making a
+    galsim.LookupTable for each row and evaluating them one at a time.
+
+    @param[in] x_arr   The tabulated x values, in increasing order.
+    @param[in] table   The 2-d array of tabulated values.
+    @param[in] x       The value at which to interpolate, within the range of x_arr.
+    @param[in] f_log   Interpolate in log(f) rather than f? [default = False]
+    """
+    w = _splineWeights(x_arr, x)
+    if f_log:
+        return np.exp(np.dot(np.log(table), w))
+    else:
+        return np.dot(table, w)
+
+class COSMOSCatalogStore(object):
+    """A class that gives column-by-column access to the FITS tables that describe the COSMOS
+    training sample (fits, shapes, selection flags, etc.).
+
+    The tables are memory-mapped rather than read into memory with pyfits.getdata(), and only the
+    columns that are requested get copied out of them, so the memory used depends on the number of
+    columns that a branch actually needs rather than the size of the tables.  Each column is copied
+    into a native byte-order array the first time that it is requested, and that array is returned
+    for later requests.
+    """
+    def __init__(self, gal_dir):
+        """Construct for the catalogs in a given directory.
+
+        @param[in] gal_dir     Directory with galaxy catalog information.
+        """
+        self.gal_dir = gal_dir
+        self.columns = {}
+        self.hdu_lists = {}
+
+    def getColumn(self, file_name, column):
+        """Return a column from the table in the first extension of a FITS file.
+
+        @param[in] file_name   Name of the FITS file, relative to the galaxy catalog directory.
+        @param[in] column      Name of the column to return.
+        """
+        key = (file_name, column)
+        if key not in self.columns:
+            if file_name not in self.hdu_lists:
+                self.hdu_lists[file_name] = pyfits.open(os.path.join(self.gal_dir, file_name),
+                                                        memmap=True)
+            data = self.hdu_lists[file_name][1].data.field(column)
+            self.columns[key] = data.astype(data.dtype.newbyteorder('='))
+        return self.columns[key]
+
+    def close(self):
+        """Close the memory-mapped FITS files.  Columns that were already requested are kept, and
+        files are reopened if further columns are requested."""
+        for hdu_list in self.hdu_lists.values():
+            hdu_list.close()
+        self.hdu_lists = {}
+
+def _readImageHDU(hdu_list, hdu):
+    """Return a float64 copy of the image in a given HDU of an open pyfits HDUList.
+
+    The image is read through the public ImageHDU.section interface, which reads from the file
+    without keeping a reference to the data in the HDU, so the only copy in memory is the one that
+    is returned.  Versions of pyfits without ImageHDU.section fall back to the HDU data, which then
+    stays in memory (along with the rest of the file) until the HDUList is closed.
+    """
+    image_hdu = hdu_list[hdu]
+    if hasattr(image_hdu, 'section'):
+        data = image_hdu.section[:, :]
+    else:
+        data = image_hdu.data
+    return np.array(data, dtype=np.float64, order='C')
+
+class PagedRealGalaxyCatalog(galsim.RealGalaxyCatalog):
+    """A galsim.RealGalaxyCatalog that reads the galaxy and PSF images on demand from
+    memory-mapped FITS files, and keeps the most recently used images in memory up to some maximum
+    number of bytes.
+
+    The base class either preloads every image file, or keeps each file open once it has been used,
+    in which case every image that was read from it stays in memory until the catalog is closed.
+    Here the memory used for images is bounded by `max_bytes`, so realistic galaxy branches can be
+    simulated without the memory needed to preload the whole training sample.
+
+    Only the public attributes of galsim.RealGalaxyCatalog that describe where each image is stored
+    are used.  If the installed version of GalSim does not have them, a warning is printed and the
+    images are read by the base class instead.
+    """
+    # Attributes of galsim.RealGalaxyCatalog that are needed to read the images here.
+    required_attributes = ("image_dir", "gal_file_name", "gal_hdu", "PSF_file_name", "PSF_hdu",
+                           "nobjects")
+
+    def __init__(self, file_name, dir=None, max_bytes=512*1024**2):
+        """Construct for a given catalog file.
+
+        @param[in] file_name   Name of the RealGalaxyCatalog file.
+        @param[in] dir         Directory with the RealGalaxyCatalog file and images.
+        @param[in] max_bytes   Maximum number of bytes of images to keep in memory.
+                               [default = 512 MB]
+        """
+        galsim.RealGalaxyCatalog.__init__(self, file_name, dir=dir, preload=False)
+        missing = [name for name in self.required_attributes if not hasattr(self, name)]
+        self.paged = not missing
+        if missing:
+            import warnings
+            warnings.warn("galsim.RealGalaxyCatalog has no attribute(s) %s; galaxy and PSF images "
+                          "will not be paged." % ", ".join(missing))
+        self.max_bytes = max_bytes
+        self.image_files = {}
+        self.clearStampCache()
+
+    def clearStampCache(self):
+        """Empty the cache of galaxy and PSF images, and reset its hit / miss statistics."""
+        import collections
+        self.stamp_cache = collections.OrderedDict()
+        self.stamp_cache_bytes = 0
+        self.stamp_cache_hits = 0
+        self.stamp_cache_misses = 0
+
+    def getStampCacheStats(self):
+        """Return a dict with the number of cache hits and misses for galaxy and PSF images, the
+        number of images in the cache, and the number of bytes that they use."""
+        return {"hits": self.stamp_cache_hits,
+                "misses": self.stamp_cache_misses,
+                "size": len(self.stamp_cache),
+                "bytes": self.stamp_cache_bytes}
+
+    def getStamp(self, file_name, hdu):
+        """Return the image in a given HDU of a given file as a float64 NumPy array, reading it from
+        the file if it is not in the cache.
+
+        @param[in] file_name   Name of the image file, relative to the image directory.
+        @param[in] hdu         Index of the HDU with the image.
+        """
+        key = (file_name, hdu)
+        if key in self.stamp_cache:
+            self.stamp_cache_hits += 1
+            array = self.stamp_cache.pop(key)
+            self.stamp_cache[key] = array
+            return array
+        self.stamp_cache_misses += 1
+
+        # The files are kept open so we don't have to read all of the headers before the HDU
+        # that we want every time.
+        if file_name not in self.image_files:
+            self.image_files[file_name] = pyfits.open(os.path.join(self.image_dir, file_name),
+                                                      memmap=True)
+        array = _readImageHDU(self.image_files[file_name], hdu)
+
+        self.stamp_cache[key] = array
+        self.stamp_cache_bytes += array.nbytes
+        while self.stamp_cache_bytes > self.max_bytes and len(self.stamp_cache) > 1:
+            _, old_array = self.stamp_cache.popitem(last=False)
+            self.stamp_cache_bytes -= old_array.nbytes
+        return array
+
+    def getGal(self, i):
+        """Returns the galaxy at index `i` as an ImageViewD object."""
+        if not self.paged:
+            return galsim.RealGalaxyCatalog.getGal(self, i)
+        if i >= self.nobjects:
+            raise IndexError(
+                'index %d given to getGal is out of range (0..%d)'%(i,self.nobjects-1))
+        return galsim.ImageViewD(self.getStamp(self.gal_file_name[i], self.gal_hdu[i]))
+
+    def getPSF(self, i):
+        """Returns the PSF at index `i` as an ImageViewD object."""
+        if not self.paged:
+            return galsim.RealGalaxyCatalog.getPSF(self, i)
+        if i >= self.nobjects:
+            raise IndexError(
+                'index %d given to getPSF is out of range (0..%d)'%(i,self.nobjects-1))
+        return galsim.ImageViewD(self.getStamp(self.PSF_file_name[i], self.PSF_hdu[i]))
+
+    def close(self):
+        """Close the image files.  The cached images are kept, and files are reopened if further
+        images are needed."""
+        for hdu_list in self.image_files.values():
+            hdu_list.close()
+        self.image_files = {}
+        galsim.RealGalaxyCatalog.close(self)
+
 class COSMOSGalaxyBuilder(GalaxyBuilder):
     """A GalaxyBuilder subclass for making COSMOS-based galaxies.  It uses keyword arguments to
     decide whether to use a parametric version of a particular galaxy, or the real HST image.
@@ -195,6 +412,9 @@ class COSMOSGalaxyBuilder(GalaxyBuilder):
     # variable shear case.
     kmin_factor = 1
     kmax_factor = 16
+    # Unless the RealGalaxyCatalog is preloaded, its galaxy and PSF images are read on demand, and
+    # at most this many bytes of them are kept in memory at once (see PagedRealGalaxyCatalog).
+    max_stamp_bytes = 512*1024**2
 
     def __init__(self, real_galaxy, obs_type, shear_type, multiepoch, gal_dir, preload, gal_pairs):
         """Construct for this type of branch.
@@ -210,6 +430,8 @@ class COSMOSGalaxyBuilder(GalaxyBuilder):
         else:
             self.preload = False
         self.gal_pairs = gal_pairs
+        # Column-by-column access to the catalogs that describe the training sample.
+        self.catalog_store = COSMOSCatalogStore(gal_dir)
 
     def generateSubfieldParameters(self, rng, subfield_index):
         # At this point, we only want to generate schema.  Everything else happens when making the
@@ -229,11 +451,21 @@ class COSMOSGalaxyBuilder(GalaxyBuilder):
                         ("cosmos_ident", int), ("g1_intrinsic", float), ("g2_intrinsic", float)]
         return dict(schema=gal_schema, subfield_index=subfield_index)
 
+    def makeRealGalaxyCatalog(self):
+        """Return the galsim.RealGalaxyCatalog for the COSMOS training sample.  If the images are
+        not to be preloaded, they are read on demand by a PagedRealGalaxyCatalog that keeps at most
+        self.max_stamp_bytes of them in memory."""
+        if self.preload:
+            return galsim.RealGalaxyCatalog(self.rgc_file, dir=self.gal_dir, preload=True)
+        else:
+            return PagedRealGalaxyCatalog(self.rgc_file, dir=self.gal_dir,
+                                          max_bytes=self.max_stamp_bytes)
+
     def generateCatalog(self, rng, catalog, parameters, variance, noise_mult, seeing=None):
         # Set up basic selection.
         # For space, the resolution and other selection criteria are one-dimensional arrays.
-        # For ground, they are lists of galsim.LookupTables that can be used to interpolate to our
-        # value of FWHM.  However, we should watch out for the min / max values of FWHM, so let's
+        # For ground, they are 2-d (n_objects x n_fwhm) arrays that can be used to interpolate to
+        # our value of FWHM.  However, we should watch out for the min / max values of FWHM, so let's
         # check for those first.
         if self.obs_type == "ground":
             tmp_seeing = seeing
@@ -250,94 +482,81 @@ class COSMOSGalaxyBuilder(GalaxyBuilder):
         # we're generating for this branch), then do so now, and save it for later calls of
         # generateCatalog():
         if not hasattr(self,'rgc'):
-            # Read in RealGalaxyCatalog, fits.
-            self.rgc = galsim.RealGalaxyCatalog(self.rgc_file, dir=self.gal_dir,
-                                                preload=self.preload)
-            self.fit_catalog = pyfits.getdata(os.path.join(self.gal_dir, self.rgc_fits_file))
-
-            # Read in precomputed shapes file, to use for B-mode shape noise and for overall
-            # selection.
-            self.shapes_catalog = pyfits.getdata(os.path.join(self.gal_dir,
-                                                              self.rgc_shapes_file))
-
-            # Read in basic selection flags.
-            self.selection_catalog = pyfits.getdata(os.path.join(self.gal_dir, self.rgc_sel_file))
+            # Read in RealGalaxyCatalog.  The other catalogs are read column by column from
+            # memory-mapped files, only when those columns are needed.
+            self.rgc = self.makeRealGalaxyCatalog()
+            store = self.catalog_store
+
             # This vector is just a predetermined choice of whether to use bulgefit or sersicfit.
-            self.use_bulgefit = self.selection_catalog.field('use_bulgefit')[:,0]
+            self.use_bulgefit = store.getColumn(self.rgc_sel_file, 'use_bulgefit')[:,0]
 
             # Read in selection flags based on the images:
             # Note: technically this isn't necessary for parametric fit branches, but in reality
             # these remove objects that we probably don't want in either place (e.g., too-low
             # surface brightness objects that show up as UFOs) and keep object selection consistent.
-            self.im_selection_catalog = pyfits.getdata(os.path.join(self.gal_dir,
-                                                                    self.rgc_im_sel_file))
             # Get the S/N in the original image, measured with an elliptical Gaussian filter
             # function.
-            self.original_sn = self.im_selection_catalog.field('sn_ellip_gauss')
-            # If it's a ground-based catalog, set up LookupTables to interpolate the minimum
-            # variance post-whitening between FWHM values.  It is important to maintain consistency
-            # between the FWHM values used for the precomputation of minimum variances and the
-            # `fwhm_arr` that we build here.  The FWHM values that were used are specified as
+            self.original_sn = store.getColumn(self.rgc_im_sel_file, 'sn_ellip_gauss')
+            # If it's a ground-based catalog, keep a table of the minimum variance post-whitening for
+            # each object at each FWHM value, to interpolate between FWHM values.  It is important
+            # to maintain consistency between the FWHM values used for the precomputation of minimum
+            # variances and the `fwhm_arr` that we use for interpolation in this function (see
+            # below).  The FWHM values that were used are specified as
             # command-line arguments to the run_props.py script in inputs/galdata/; to see which
             # arguments were used and therefore FWHM values adopted, see the files pbs_props*.sh in
             # that directory.
+            min_var_white = store.getColumn(self.rgc_im_sel_file, 'min_var_white')
             if self.obs_type == "ground":
-                fwhm_arr = self.min_ground_fwhm + self.ground_dfwhm*np.arange(self.ground_nfwhm)
-                self.noise_min_var = []
-                for obj in self.im_selection_catalog:
-                    tmp_min_var = obj.field('min_var_white')[2:]
-                    self.noise_min_var.append(galsim.LookupTable(fwhm_arr,tmp_min_var,f_log=True))
+                self.noise_min_var = min_var_white[:,2:]
             # Otherwise, for space, save a single set of results depending on whether it's single
             # epoch (smaller pixels) or multiepoch (bigger pixels).
             else:
                 # Note, if we wanted to use the actual minimum variances post-whitening on a
                 # per-experiment basis, we'd do
                 # if self.multiepoch:
-                #    self.noise_min_var = self.im_selection_catalog.field('min_var_white')[:,1]
+                #    self.noise_min_var = min_var_white[:,1]
                 # else:
-                #    self.noise_min_var = self.im_selection_catalog.field('min_var_white')[:,0]
+                #    self.noise_min_var = min_var_white[:,0]
                 # However, this would result in different minimum variances and galaxy selection for
                 # single vs. multiepoch because the pixel scales are different for space sims for
                 # the two cases.  So, we just use the single-epoch minimum variances, which are
                 # higher, eliminating more objects from the sample.  This is conservative for the
                 # multiepoch sims, but it means the selection is consistent for the two cases, which
                 # will be helpful in interpreting results.
-                self.noise_min_var = self.im_selection_catalog.field('min_var_white')[:,0]
+                self.noise_min_var = min_var_white[:,0]
 
             # Read in catalog that tells us how the galaxy magnitude from Claire's fits differs from
             # that in the actual COSMOS catalog.  This can be used to exclude total screwiness,
             # objects overly affected by blends, and other junk.
-            dmag_catalog = pyfits.getdata(os.path.join(self.gal_dir, self.rgc_dmag_file))
-            self.dmag = dmag_catalog.field('delta_mag')
+            self.dmag = store.getColumn(self.rgc_dmag_file, 'delta_mag')
 
             # Read in the catalog that tells us which galaxies might have masking issues that make
             # the postage stamps too funky to use.
-            mask_catalog = pyfits.getdata(os.path.join(self.gal_dir, self.rgc_mask_file))
             self.average_mask_adjacent_pixel_count = \
-                mask_catalog['average_mask_adjacent_pixel_count']
-            self.peak_image_pixel_count = mask_catalog['peak_image_pixel_count']
+                store.getColumn(self.rgc_mask_file, 'average_mask_adjacent_pixel_count')
+            self.peak_image_pixel_count = \
+                store.getColumn(self.rgc_mask_file, 'peak_image_pixel_count').copy()
             self.peak_image_pixel_count[self.peak_image_pixel_count == 0.] = 1.e-4
-            self.min_mask_dist_pixels = mask_catalog['min_mask_dist_pixels']
+            self.min_mask_dist_pixels = store.getColumn(self.rgc_mask_file, 'min_mask_dist_pixels')
 
-            # If this is a ground-based calculation, then set up LookupTables to interpolate
-            # max_variance and resolutions between FWHM values.
+            # If this is a ground-based calculation, then keep tables of max_variance and
+            # resolutions to interpolate between FWHM values.  Objects for which the max_variance
+            # failed at any FWHM get the failure value at all FWHM.
+            max_var = store.getColumn(self.rgc_sel_file, 'max_var')
+            sel_flux_frac = store.getColumn(self.rgc_sel_file, 'flux_frac')
+            sel_resolution = store.getColumn(self.rgc_sel_file, 'resolution')
             if self.obs_type == "ground":
-                self.noise_max_var = []
-                self.flux_frac = []
-                self.resolution = []
-                for obj in self.selection_catalog:
-                    tmp_max_var = obj.field('max_var')[1:]
-                    if np.any(tmp_max_var < self.noise_fail_val):
-                        tmp_max_var = np.zeros_like(tmp_max_var) + self.noise_fail_val
-                    self.noise_max_var.append(galsim.LookupTable(fwhm_arr,tmp_max_var,f_log=True))
-                    self.flux_frac.append(galsim.LookupTable(fwhm_arr,obj.field('flux_frac')[1:]))
-                    self.resolution.append(galsim.LookupTable(fwhm_arr,obj.field('resolution')[1:]))
+                self.noise_max_var = max_var[:,1:].copy()
+                self.noise_max_var[np.any(self.noise_max_var < self.noise_fail_val, axis=1)] = \
+                    self.noise_fail_val
+                self.flux_frac = sel_flux_frac[:,1:]
+                self.resolution = sel_resolution[:,1:]
             # But if it's a space-based catalog, then just have arrays for each of the selection 
             # flags.
             else:
-                self.noise_max_var = self.selection_catalog.field('max_var')[:,0]
-                self.flux_frac = self.selection_catalog.field('flux_frac')[:,0]
-                self.resolution = self.selection_catalog.field('resolution')[:,0]
+                self.noise_max_var = max_var[:,0]
+                self.flux_frac = sel_flux_frac[:,0]
+                self.resolution = sel_resolution[:,0]
  
         # First we set up the quantities that we need to apply basic selection, and that depend on
         # the type of simulation (ground / space, and ground-based seeing):
@@ -352,15 +571,11 @@ class COSMOSGalaxyBuilder(GalaxyBuilder):
             resolution = self.resolution
             noise_min_var = self.noise_min_var
         else:
-            noise_max_var = np.zeros(self.rgc.nobjects)
-            flux_frac = np.zeros(self.rgc.nobjects)
-            resolution = np.zeros(self.rgc.nobjects)
-            noise_min_var = np.zeros(self.rgc.nobjects)
-            for gal_ind in range(self.rgc.nobjects):
-                noise_max_var[gal_ind] = self.noise_max_var[gal_ind](tmp_seeing)
-                flux_frac[gal_ind] = self.flux_frac[gal_ind](tmp_seeing)
-                resolution[gal_ind] = self.resolution[gal_ind](tmp_seeing)
-                noise_min_var[gal_ind] = self.noise_min_var[gal_ind](tmp_seeing)
+            fwhm_arr = self.min_ground_fwhm + self.ground_dfwhm*np.arange(self.ground_nfwhm)
+            noise_max_var = _interpolateTable(fwhm_arr, self.noise_max_var, tmp_seeing, f_log=True)
+            flux_frac = _interpolateTable(fwhm_arr, self.flux_frac, tmp_seeing)
+            resolution = _interpolateTable(fwhm_arr, self.resolution, tmp_seeing)
+            noise_min_var = _interpolateTable(fwhm_arr, self.noise_min_var, tmp_seeing, f_log=True)
 
         # We need to estimate approximate S/N values for each object, by comparing with a
         # precalculated noise variance for S/N=20 that comes from using the fits.  Some of the
@@ -402,8 +617,9 @@ class COSMOSGalaxyBuilder(GalaxyBuilder):
         # center than 11 pixels (0.33").  And we exclude objects whose nearest masked pixel has a
         # flux brighter than 0.2 * the brightest unmasked pixel.  
         # The `mask_cond` array is True for all objects that are not excluded.
-        e1 = self.shapes_catalog.field('e1')
-        e2 = self.shapes_catalog.field('e2')
+        # Precomputed shapes are used for B-mode shape noise and for overall selection.
+        e1 = self.catalog_store.getColumn(self.rgc_shapes_file, 'e1')
+        e2 = self.catalog_store.getColumn(self.rgc_shapes_file, 'e2')
         e_test = np.sqrt(e1**2 + e2**2)
         mask_cond = np.logical_or.reduce(
             [self.min_mask_dist_pixels > 11,
@@ -411,14 +627,14 @@ class COSMOSGalaxyBuilder(GalaxyBuilder):
              ])
         # Impose alllll of the above conditions on the catalog.
         cond = np.logical_and.reduce(
-            [self.selection_catalog.field('to_use') == 1,
+            [self.catalog_store.getColumn(self.rgc_sel_file, 'to_use') == 1,
              np.abs(self.dmag) < 0.8,
              flux_frac >= self.min_flux_frac,
              resolution >= self.min_resolution,
              approx_sn_gal >= self.sn_min,
              approx_sn_gal <= self.sn_max,
              noise_max_var > self.noise_fail_val,
-             self.shapes_catalog.field('do_meas') > -0.5,
+             self.catalog_store.getColumn(self.rgc_shapes_file, 'do_meas') > -0.5,
              e_test < 1.,
              self.original_sn >= 20.,
              noise_min_var <= 0.96*variance*constants.deep_variance_mult,
@@ -467,8 +683,8 @@ class COSMOSGalaxyBuilder(GalaxyBuilder):
         rot_angle = np.zeros(constants.nrows*constants.ncols)
         # However, we first get some basic information about the galaxies which will be necessary
         # for tests of shape noise cancellation, whether for constant or variable shear.
-        e1 = self.shapes_catalog.field('e1')
-        e2 = self.shapes_catalog.field('e2')
+        e1 = self.catalog_store.getColumn(self.rgc_shapes_file, 'e1')
+        e2 = self.catalog_store.getColumn(self.rgc_shapes_file, 'e2')
         emag = np.sqrt(e1**2 + e2**2)
         ephi = 0.5 * np.arctan2(e2, e1)
         # Only do e->g conversion for those with |e|<1; those that violate that condition should
@@ -598,11 +814,10 @@ class COSMOSGalaxyBuilder(GalaxyBuilder):
             # Match |g| between real galaxies and B-mode shape noise field according to ranking.
             ind_sorted_gmag_b = np.argsort(gmag_b.flatten())
             ind_sorted_gmag = np.argsort(gmag[use_indices.astype(int)].flatten())
-            sorted_gmag_dict = {}
-            for ind in range(constants.nrows * constants.ncols):
-                sorted_gmag_dict[ind_sorted_gmag_b[ind]] = use_indices[ind_sorted_gmag[ind]]
-            sorted_use_indices = np.array([sorted_gmag_dict[ind] 
-                                           for ind in range(constants.nrows*constants.ncols)])
+            # The galaxy with the k-th smallest |g| goes to the position with the k-th smallest |g|
+            # in the B-mode shape noise field.
+            sorted_use_indices = np.zeros(constants.nrows*constants.ncols)
+            sorted_use_indices[ind_sorted_gmag_b] = use_indices[ind_sorted_gmag]
             # Get the rotation angles right, once we've done the matching.
             target_beta = gphi_b.flatten()
             actual_beta = ephi[sorted_use_indices.astype(int)]
@@ -619,124 +834,125 @@ class COSMOSGalaxyBuilder(GalaxyBuilder):
         # Now that we know which galaxies to use in which order, and with what rotation angles, we
         # will populate the catalog.  The next bit of code depends quite a bit on whether it is a
         # real_galaxy or parametric galaxy experiment.  This is also where we specify flux and size
-        # rescalings to mimic the deeper I<25 sample.
-        ind = 0
-        for record in catalog:
-
-            # Save COSMOS ID and intrinsic shape information, regardless of whether this is a real
-            # galaxy or a parametric one.
-            record["cosmos_ident"] = self.fit_catalog[all_indices[ind]].field('ident')
-            if self.shear_type == "variable":
-                final_g = galsim.Shear(g = gmag[all_indices[ind]],
-                                       beta=target_beta[ind]*galsim.radians)
-            else:
-                final_g = galsim.Shear(
-                    g = gmag[all_indices[ind]],
-                    beta=(ephi[all_indices[ind]]+rot_angle[ind])*galsim.radians
-                    )
-            record["g1_intrinsic"] = final_g.g1
-            record["g2_intrinsic"] = final_g.g2
-
-            # Now specialize to save the appropriate info for real galaxies or parametric ones.
-            if self.real_galaxy:
-                record["gal_sn"] = approx_sn_gal[all_indices[ind]]
-                record["rot_angle_radians"] = rot_angle[ind]
-                record["size_rescale"] = self.size_rescale
-                record["flux_rescale"] = 1. / n_epochs
-            else:
-                # Information that we will save for parametric galaxies depends on whether we use 1-
-                # or 2-component fits.
-                if self.use_bulgefit[all_indices[ind]] == 1.:
-                    params = self.fit_catalog[all_indices[ind]].field('bulgefit')
-
-                    (fit_disk_flux, fit_disk_hlr, fit_disk_n, fit_disk_q, _, _, _, fit_disk_beta,
-                     fit_bulge_flux, fit_bulge_hlr, fit_bulge_n, fit_bulge_q, _, _, _,
-                     fit_bulge_beta) = params
-
-                    bulge_q = fit_bulge_q
-
-                    # Fit files store position angles as radians.
-                    bulge_beta = fit_bulge_beta*galsim.radians + rot_angle[ind]*galsim.radians
-                    # Half-light radii in files need several corrections:
-                    #    (1) They are in pixels, so we multiply by 0.03" (the coadded pixel scale)
-                    #        to get arcsec.
-                    #    (2) We are rescaling the galaxy sizes by self.size_rescale in order to
-                    #        mimic a fainter galaxy sample in which galaxies are naturally smaller,
-                    #        as described in the handbook.
-                    #    (3) The files give the half-light radius along the major axis, but for
-                    #        GalSim we want the azimuthally-averaged half-light radius, so we
-                    #        multiply by sqrt(q)=sqrt(b/a).
-                    bulge_hlr = 0.03*self.size_rescale*np.sqrt(bulge_q)*fit_bulge_hlr
-
-                    # Fluxes in the files require several corrections:
-                    #    (1) The "flux" values are actually surface brightness at the half-light
-                    #        radius along the major axis.  Thus we need to integrate the
-                    #        surface-brightness profile to get the total flux, which introduces
-                    #        2*pi*(half-light radius)^2 * some Sersic n-dependent fudge factors
-                    #        (Gamma functions, etc.).  The 3.607 in the line below is the Sersic
-                    #        n-dependent factor for n=4.  Note that the full expression is given in
-                    #        the lines of code below for the Sersic-fit profiles.
-                    #    (2) The division by self.size_rescale**2 is just to correct for the fact
-                    #        that the bulge half-light radii have already been decreased by this
-                    #        factor, but that factor wasn't in the original fit profiles and hence
-                    #        should not go into the flux calculation.
-                    #    (3) The division by 0.03**2 is because the fits assumed the images
-                    #        were flux when really they were surface brightness, so the fluxes from
-                    #        the fit outputs are too low by 0.03**2.
-                    bulge_flux = \
-                        2.0*np.pi*3.607*(bulge_hlr**2)*fit_bulge_flux/self.size_rescale**2/(0.03**2) 
-
-                    disk_q = fit_disk_q
-                    disk_beta = fit_disk_beta*galsim.radians + rot_angle[ind]*galsim.radians
-                    disk_hlr = 0.03*self.size_rescale*np.sqrt(disk_q)*fit_disk_hlr # arcsec
-                    # Here the 1.901 is the Sersic n-dependent factor described above, but for n=1.
-                    disk_flux = \
-                        2.0*np.pi*1.901*(disk_hlr**2)*fit_disk_flux/self.size_rescale**2/(0.03**2)
-
-                    record["gal_sn"] = approx_sn_gal[all_indices[ind]]
-                    bulge_frac = bulge_flux / (bulge_flux + disk_flux)
-                    record["bulge_n"] = 4.0
-                    record["bulge_hlr"] = bulge_hlr
-                    record["bulge_q"] = bulge_q
-                    record["bulge_beta_radians"] = bulge_beta/galsim.radians
-                    record["bulge_flux"] = bulge_flux / n_epochs
-                    record["disk_hlr"] = disk_hlr
-                    record["disk_q"] = disk_q
-                    record["disk_beta_radians"] = disk_beta/galsim.radians
-                    record["disk_flux"] = disk_flux / n_epochs
-                else:
-                    # Make a single Sersic model instead
-                    params = self.fit_catalog[all_indices[ind]].field('sersicfit')
-                    (fit_gal_flux, fit_gal_hlr, fit_gal_n, fit_gal_q, _, _, _, fit_gal_beta) = \
-                        params
-
-                    gal_n = fit_gal_n
-                    # Fudge this if it is at the edge of the allowed n values.  Now that GalSim #325
-                    # and #449 allow Sersic n in the range 0.3<=n<=6, the only problem is that the
-                    # fits occasionally go as low as n=0.2.
-                    if gal_n < 0.3: gal_n = 0.3
-                    gal_q = fit_gal_q
-                    gal_beta = fit_gal_beta*galsim.radians + rot_angle[ind]*galsim.radians
-                    gal_hlr = 0.03*self.size_rescale*np.sqrt(gal_q)*fit_gal_hlr
-                    # Below is the calculation of the full Sersic n-dependent quantity that goes
-                    # into the conversion from surface brightness to flux, which here we're calling
-                    # 'prefactor'.  In the n=4 and n=1 cases above, this was precomputed, but here
-                    # we have to calculate for each value of n.
-                    tmp_ser = galsim.Sersic(gal_n, half_light_radius=1.)
-                    gal_bn = (1./tmp_ser.getScaleRadius())**(1./gal_n)
-                    prefactor = gal_n * _gammafn(2.*gal_n) * math.exp(gal_bn) / (gal_bn**(2.*gal_n))
-                    gal_flux = 2.*np.pi*prefactor*(gal_hlr**2)*fit_gal_flux/self.size_rescale**2/0.03**2
-                    record["gal_sn"] = approx_sn_gal[all_indices[ind]]
-                    record["bulge_n"] = gal_n
-                    record["bulge_hlr"] = gal_hlr
-                    record["bulge_q"] = gal_q
-                    record["bulge_beta_radians"] = gal_beta/galsim.radians
-                    record["bulge_flux"] = gal_flux / n_epochs
-                    record["disk_hlr"] = 1.0
-                    record["disk_q"] = 1.0
-                    record["disk_beta_radians"] = 0.0
-                    record["disk_flux"] = 0.0
-            ind += 1
+        # rescalings to mimic the deeper I<25 sample.  All columns are filled at once for all
+        # objects.
+        all_indices = all_indices.astype(int)
+
+        # Save COSMOS ID and intrinsic shape information, regardless of whether this is a real
+        # galaxy or a parametric one.  The intrinsic shear has magnitude gmag and position angle
+        # beta, so (g1, g2) = gmag * (cos 2 beta, sin 2 beta).
+        catalog["cosmos_ident"] = self.catalog_store.getColumn(self.rgc_fits_file,
+                                                               'ident')[all_indices]
+        if self.shear_type == "variable":
+            final_beta = target_beta
+        else:
+            final_beta = ephi[all_indices] + rot_angle
+        catalog["g1_intrinsic"] = gmag[all_indices] * np.cos(2.*final_beta)
+        catalog["g2_intrinsic"] = gmag[all_indices] * np.sin(2.*final_beta)
+        catalog["gal_sn"] = approx_sn_gal[all_indices]
+
+        # Now specialize to save the appropriate info for real galaxies or parametric ones.
+        if self.real_galaxy:
+            catalog["rot_angle_radians"] = rot_angle
+            catalog["size_rescale"] = self.size_rescale
+            catalog["flux_rescale"] = 1. / n_epochs
+        else:
+            # Information that we will save for parametric galaxies depends on whether we use 1-
+            # or 2-component fits.  Only the parametric branches need the fit parameters.
+            use_bulge = self.use_bulgefit[all_indices] == 1.
+            use_sersic = ~use_bulge
+
+            params = self.catalog_store.getColumn(
+                self.rgc_fits_file, 'bulgefit')[all_indices[use_bulge]].astype(np.float64)
+            fit_disk_flux, fit_disk_hlr, fit_disk_q, fit_disk_beta = params[:,[0,1,3,7]].T
+            fit_bulge_flux, fit_bulge_hlr, fit_bulge_q, fit_bulge_beta = params[:,[8,9,11,15]].T
+
+            bulge_q = fit_bulge_q
+            # Fit files store position angles as radians.
+            bulge_beta = fit_bulge_beta + rot_angle[use_bulge]
+            # Half-light radii in files need several corrections:
+            #    (1) They are in pixels, so we multiply by 0.03" (the coadded pixel scale)
+            #        to get arcsec.
+            #    (2) We are rescaling the galaxy sizes by self.size_rescale in order to
+            #        mimic a fainter galaxy sample in which galaxies are naturally smaller,
+            #        as described in the handbook.
+            #    (3) The files give the half-light radius along the major axis, but for
+            #        GalSim we want the azimuthally-averaged half-light radius, so we
+            #        multiply by sqrt(q)=sqrt(b/a).
+            bulge_hlr = 0.03*self.size_rescale*np.sqrt(bulge_q)*fit_bulge_hlr
+
+            # Fluxes in the files require several corrections:
+            #    (1) The "flux" values are actually surface brightness at the half-light
+            #        radius along the major axis.  Thus we need to integrate the
+            #        surface-brightness profile to get the total flux, which introduces
+            #        2*pi*(half-light radius)^2 * some Sersic n-dependent fudge factors
+            #        (Gamma functions, etc.).  The 3.607 in the line below is the Sersic
+            #        n-dependent factor for n=4.  Note that the full expression is given in
+            #        the lines of code below for the Sersic-fit profiles.
+            #    (2) The division by self.size_rescale**2 is just to correct for the fact
+            #        that the bulge half-light radii have already been decreased by this
+            #        factor, but that factor wasn't in the original fit profiles and hence
+            #        should not go into the flux calculation.
+            #    (3) The division by 0.03**2 is because the fits assumed the images
+            #        were flux when really they were surface brightness, so the fluxes from
+            #        the fit outputs are too low by 0.03**2.
+            bulge_flux = \
+                2.0*np.pi*3.607*(bulge_hlr**2)*fit_bulge_flux/self.size_rescale**2/(0.03**2) 
+
+            disk_q = fit_disk_q
+            disk_beta = fit_disk_beta + rot_angle[use_bulge]
+            disk_hlr = 0.03*self.size_rescale*np.sqrt(disk_q)*fit_disk_hlr # arcsec
+            # Here the 1.901 is the Sersic n-dependent factor described above, but for n=1.
+            disk_flux = \
+                2.0*np.pi*1.901*(disk_hlr**2)*fit_disk_flux/self.size_rescale**2/(0.03**2)
+
+            catalog["bulge_n"][use_bulge] = 4.0
+            catalog["bulge_hlr"][use_bulge] = bulge_hlr
+            catalog["bulge_q"][use_bulge] = bulge_q
+            catalog["bulge_beta_radians"][use_bulge] = bulge_beta
+            catalog["bulge_flux"][use_bulge] = bulge_flux / n_epochs
+            catalog["disk_hlr"][use_bulge] = disk_hlr
+            catalog["disk_q"][use_bulge] = disk_q
+            catalog["disk_beta_radians"][use_bulge] = disk_beta
+            catalog["disk_flux"][use_bulge] = disk_flux / n_epochs
+
+            # Make a single Sersic model for the rest.
+            params = self.catalog_store.getColumn(
+                self.rgc_fits_file, 'sersicfit')[all_indices[use_sersic]].astype(np.float64)
+            fit_gal_flux, fit_gal_hlr, fit_gal_n, fit_gal_q, fit_gal_beta = \
+                params[:,[0,1,2,3,7]].T
+
+            # Fudge this if it is at the edge of the allowed n values.  Now that GalSim #325
+            # and #449 allow Sersic n in the range 0.3<=n<=6, the only problem is that the
+            # fits occasionally go as low as n=0.2.
+            gal_n = np.maximum(fit_gal_n, 0.3)
+            gal_q = fit_gal_q
+            gal_beta = fit_gal_beta + rot_angle[use_sersic]
+            gal_hlr = 0.03*self.size_rescale*np.sqrt(gal_q)*fit_gal_hlr
+            # Below is the calculation of the full Sersic n-dependent quantity that goes
+            # into the conversion from surface brightness to flux, which here we're calling
+            # 'prefactor'.  In the n=4 and n=1 cases above, this was precomputed, but here
+            # we have to calculate for each value of n.  Objects that were chosen more than once
+            # share a value of n, so we only do this once per distinct value.
+            unique_n, n_inverse = np.unique(gal_n, return_inverse=True)
+            unique_prefactor = np.zeros(len(unique_n))
+            for i_n, n in enumerate(unique_n):
+                tmp_ser = galsim.Sersic(n, half_light_radius=1.)
+                gal_bn = (1./tmp_ser.getScaleRadius())**(1./n)
+                unique_prefactor[i_n] = n * _gammafn(2.*n) * math.exp(gal_bn) / (gal_bn**(2.*n))
+            prefactor = unique_prefactor[n_inverse]
+            gal_flux = 2.*np.pi*prefactor*(gal_hlr**2)*fit_gal_flux/self.size_rescale**2/0.03**2
+
+            catalog["bulge_n"][use_sersic] = gal_n
+            catalog["bulge_hlr"][use_sersic] = gal_hlr
+            catalog["bulge_q"][use_sersic] = gal_q
+            catalog["bulge_beta_radians"][use_sersic] = gal_beta
+            catalog["bulge_flux"][use_sersic] = gal_flux / n_epochs
+            catalog["disk_hlr"][use_sersic] = 1.0
+            catalog["disk_q"][use_sersic] = 1.0
+            catalog["disk_beta_radians"][use_sersic] = 0.0
+            catalog["disk_flux"][use_sersic] = 0.0
+        self.catalog_store.close()
 
     def makeConfigDict(self):
         """Routine to write the galaxy-related parts of the config file used by GalSim to generate
@@ -843,9 +1059,7 @@ class COSMOSGalaxyBuilder(GalaxyBuilder):
         # generateCatalog isn't run, so the galaxy builder won't have a stored RealGalaxyCatalog
         # attribute.  Check and read it in if necessary, before trying to make a RealGalaxy.
         if not hasattr(self,'rgc'):
-            # Read in RealGalaxyCatalog, fits.
-            self.rgc = galsim.RealGalaxyCatalog(self.rgc_file, dir=self.gal_dir,
-                                                preload=self.preload)
+            self.rgc = self.makeRealGalaxyCatalog()
         noise_pad_size = int(np.ceil(constants.xsize[self.obs_type][self.multiepoch] *
                                      np.sqrt(2.) * 
                                      constants.pixel_scale[self.obs_type][self.multiepoch]))
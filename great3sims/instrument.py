@@ -0,0 +1,176 @@
+# Copyright (c) 2014, the GREAT3 executive committee (http://www.great3challenge.info/?q=contacts)
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification, are permitted
+# provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this list of conditions
+# and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice, this list of
+# conditions and the following disclaimer in the documentation and/or other materials provided with
+# the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors may be used to
+# endorse or promote products derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+# FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER
+# IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT
+# OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+This file contains the RunReport class, which records how long each part of a great3sims.run() takes
+and how much memory it uses, and writes this out as a YAML file at the end of the run.
+
+Each Task (see tasks.py) is measured, as are the main methods of the galaxy, shear, PSF and noise
+builders and the packaging methods of the SimBuilder, which are recorded along with the Task they
+were called from.  The CPU times and memory use are those of the whole process, so they include any
+other branches being packaged by other threads at the same time; the CPU time and memory of the
+processes used to draw images are recorded separately, once those processes have finished.
+"""
+import os
+import sys
+import time
+import threading
+
+# Methods of the builders in a SimBuilder that are measured by RunReport.instrument().  The methods
+# that are called for each galaxy or star (e.g., makeGalSimObject and addNoise) are left alone,
+# since measuring them would take longer than the methods themselves.
+instrumented_methods = {
+    "galaxy_builder": ["generateSubfieldParameters", "generateCatalog"],
+    "shear_builder": ["generateFieldParameters", "generateSubfieldParameters", "generateCatalog"],
+    "psf_builder": ["generateFieldParameters", "generateEpochParameters", "generateCatalog"],
+    "noise_builder": ["generateEpochParameters"],
+    None: ["checkCatalogs", "packagePublic", "packageTruth"],
+    }
+
+def _usage():
+    """Return the CPU time in seconds and peak resident set size in MB so far, of this process and
+    of its finished child processes."""
+    import resource
+    # ru_maxrss is in kB on Linux, but in bytes on OS X.
+    if sys.platform == "darwin":
+        rss_unit = 1024.**2
+    else:
+        rss_unit = 1024.
+    self_usage = resource.getrusage(resource.RUSAGE_SELF)
+    child_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return (self_usage.ru_utime + self_usage.ru_stime, self_usage.ru_maxrss / rss_unit,
+            child_usage.ru_utime + child_usage.ru_stime, child_usage.ru_maxrss / rss_unit)
+
+class RunReport(object):
+    """Class that records the wall time, CPU time, peak memory and number of objects for each part
+    of a run, labelled by branch, step, subfield, epoch and method.
+    """
+    def __init__(self, count_objects=True):
+        """Start a report.
+
+        @param[in] count_objects  Record the number of objects tracked by the garbage collector at
+                                  the end of each measurement, and the change in it?  This takes a
+                                  little while when there are many objects.  [default: True]
+        """
+        self.count_objects = count_objects
+        self.records = []
+        self.start_time = time.time()
+        # The labels of the measurements in progress, which differ between threads.
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def _nObjects(self):
+        import gc
+        if self.count_objects:
+            return len(gc.get_objects())
+        return None
+
+    def measure(self, func, args=(), kwargs=None, **labels):
+        """Call func(*args, **kwargs) and record its use of resources, labelled with the `labels`
+        (e.g., branch, step, subfield_index, epoch_index and method) along with those of the
+        measurement that this is nested within, if any.  Returns whatever func returns.
+        """
+        if kwargs is None:
+            kwargs = {}
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        record = dict(stack[-1]) if stack else {}
+        record.update(labels)
+        record["depth"] = len(stack)
+        stack.append(record)
+        n_objects = self._nObjects()
+        cpu, max_rss, child_cpu, child_max_rss = _usage()
+        t1 = time.time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            t2 = time.time()
+            end_cpu, end_max_rss, end_child_cpu, end_child_max_rss = _usage()
+            stack.pop()
+            record.update({
+                "start": t1 - self.start_time,
+                "wall_time": t2 - t1,
+                "cpu_time": end_cpu - cpu,
+                "child_cpu_time": end_child_cpu - child_cpu,
+                "max_rss_mb": end_max_rss,
+                "max_rss_increase_mb": end_max_rss - max_rss,
+                "child_max_rss_mb": end_child_max_rss,
+                })
+            if n_objects is not None:
+                end_n_objects = self._nObjects()
+                record["n_objects"] = end_n_objects
+                record["n_objects_increase"] = end_n_objects - n_objects
+            with self._lock:
+                self.records.append(record)
+
+    def wrap(self, obj, name, label=None):
+        """Replace the method obj.name with one that measures itself, with method=label.name."""
+        method = getattr(obj, name)
+        if label is None:
+            label = name
+        else:
+            label = label + "." + name
+        def measured(*args, **kwargs):
+            return self.measure(method, args, kwargs, method=label)
+        measured.__name__ = name
+        measured.__doc__ = method.__doc__
+        setattr(obj, name, measured)
+
+    def instrument(self, builder):
+        """Wrap the methods of a SimBuilder and its builders that are listed in
+        instrumented_methods, so they are measured whenever they are called."""
+        for attr, names in instrumented_methods.iteritems():
+            if attr is None:
+                obj = builder
+            else:
+                obj = getattr(builder, attr)
+            for name in names:
+                if hasattr(obj, name):
+                    self.wrap(obj, name, label=attr)
+
+    def summarize(self):
+        """Return a list of dicts with the total wall and CPU time of each step, method and
+        depth, in decreasing order of wall time."""
+        totals = {}
+        for record in self.records:
+            key = (record.get("step"), record.get("method"), record["depth"])
+            total = totals.setdefault(key, {"step": key[0], "method": key[1], "depth": key[2],
+                                            "count": 0, "wall_time": 0., "cpu_time": 0.,
+                                            "child_cpu_time": 0.})
+            total["count"] += 1
+            for field in ("wall_time", "cpu_time", "child_cpu_time"):
+                total[field] += record[field]
+        return sorted(totals.itervalues(), key=lambda total: -total["wall_time"])
+
+    def write(self, filename):
+        """Write the summary and all of the records to a YAML file (written to a temporary file and
+        renamed, so that an existing report is only replaced by a complete one)."""
+        import yaml
+        report = {"wall_time": time.time() - self.start_time,
+                  "summary": self.summarize(),
+                  "records": self.records}
+        with open(filename + ".tmp", "w") as stream:
+            yaml.safe_dump(report, stream, default_flow_style=False)
+        os.rename(filename + ".tmp", filename)
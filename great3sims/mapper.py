@@ -98,20 +98,88 @@ def readCatalog(path, fits_catalog = True):
         with open(path + ".p") as stream:
             return cPickle.load(stream)
 
-def writeCatalog(catalog, path, type = 'fits', comment_pref = '#', format = None):
+def readNpyCatalog(path, mmap_mode = 'r'):
+    """Read a catalog (structured NumPy array) that was saved in NumPy's binary .npy format by
+    writeNpyCatalog().  'path' should not include file extension.
+
+    By default the file is memory-mapped read-only rather than read in, so there is no header parsing
+    or format conversion, and only the parts of the catalog that are actually used get read from
+    disk.  The result can be used like any other structured NumPy array, but cannot be modified.
+
+    @param[in] mmap_mode   Memory-mapping mode passed to numpy.load, or None to read the whole
+                           catalog into memory.  [Default: mmap_mode = 'r']
+    """
+    import numpy as np
+    return np.load(path + ".npy", mmap_mode = mmap_mode)
+
+def writeNpyCatalog(catalog, path, check = True):
+    """Write a catalog (structured NumPy array) to disk in NumPy's binary .npy format; 'path' should
+    not include file extension.  This is equivalent to writeCatalog() with type='npy'.
+    """
+    writeCatalog(catalog, path, type = 'npy', check = check)
+
+def findBadCatalogValues(catalog):
+    """Find NaN and Inf values in a catalog (structured NumPy array or pyfits.FITSrec).
+
+    Each floating-point column is checked with a single vectorized call, including columns that
+    hold arrays.  Columns with integer or string values cannot hold NaN/Inf, so they are skipped.
+
+    @param[in] catalog     The catalog to check.
+    @returns a dict with the names of the columns that have NaN/Inf values as keys, and the sorted
+             row indices with those values as values.  The dict is empty if all values are finite.
+    """
+    import numpy as np
+    bad = {}
+    for name in catalog.dtype.names:
+        column = np.asarray(catalog[name])
+        if not np.issubdtype(column.dtype, np.inexact):
+            continue
+        not_finite = ~np.isfinite(column)
+        if not_finite.ndim > 1:
+            not_finite = not_finite.reshape(len(column), -1).any(axis=1)
+        if not_finite.any():
+            bad[name] = np.flatnonzero(not_finite)
+    return bad
+
+def checkCatalog(catalog, path=None, max_rows=10):
+    """Raise a RuntimeError if there are NaN or Inf values in a catalog.  The error message lists
+    the columns with bad values and the first few rows with bad values in each of them.
+
+    @param[in] catalog     The catalog to check.
+    @param[in] path        The file the catalog is being written to or was read from, if any, to
+                           include in the error message.  [Default: None]
+    @param[in] max_rows    Maximum number of row indices to report per column.  [Default: 10]
+    """
+    bad = findBadCatalogValues(catalog)
+    if bad:
+        report = []
+        for name in sorted(bad):
+            rows = ", ".join([str(row) for row in bad[name][:max_rows]])
+            if len(bad[name]) > max_rows:
+                rows += ", ..."
+            report.append("%s (%d rows: %s)"%(name, len(bad[name]), rows))
+        if path is None:
+            where = "catalog"
+        else:
+            where = "catalog " + path
+        raise RuntimeError("NaN/Inf values found in %s!  Columns: %s"%(where, "; ".join(report)))
+
+def writeCatalog(catalog, path, type = 'fits', comment_pref = '#', format = None, check = True):
     """Write a catalog (structured NumPy array) to disk; 'path' should not include file extension.
 
     This method also does some basic sanity checking for NaN and Inf values in the catalog before
-    writing it to file; it will throw a RuntimeError if it finds any.
-
-    @param[in] type        Type of file to write.  options are 'fits', 'p' (pickle dump), 'txt' 
-                           [Default: 'fits']
+    writing it to file; it will throw a RuntimeError if it finds any (see checkCatalog()).
+
+    @param[in] type        Type of file to write.  options are 'fits', 'p' (pickle dump), 'txt',
+                           'npy' (NumPy binary format, which can be memory-mapped by
+                           readNpyCatalog()).  [Default: 'fits']
+    @param[in] check       Check for NaN and Inf values before writing?  This can be turned off
+                           when the catalogs are going to be checked later, e.g., with
+                           Mapper.checkCatalogs() before packaging.  [Default: True]
     """
     import numpy as np
-    for record in catalog:
-        for val in record:
-            if np.isnan(val) or np.isinf(val):
-                raise RuntimeError("NaN/Inf values found in catalog!")
+    if check:
+        checkCatalog(catalog, path)
     if type == 'fits':
         import pyfits
         pyfits.writeto(path + ".fits", catalog, clobber = True)
@@ -119,6 +187,10 @@ def writeCatalog(catalog, path, type = 'fits', comment_pref = '#', format = None
         import cPickle
         with open(path + ".p", 'w') as stream:
             cPickle.dump(catalog, stream, protocol=2)
+    elif type == 'npy':
+        # Catalogs read from FITS files are pyfits.FITSrec objects, so convert to a plain
+        # structured array first.
+        np.save(path + ".npy", np.asarray(catalog))
     elif type == 'txt':
         import tempfile
         # First print lines with column names.  This goes into a separate file for now.
@@ -146,7 +218,7 @@ def writeCatalog(catalog, path, type = 'fits', comment_pref = '#', format = None
         os.remove(tmp_1)
         os.remove(tmp_2)
     else:
-        raise ValueError("Invalid catalog type requested!  Options are fits, p, txt.")
+        raise ValueError("Invalid catalog type requested!  Options are fits, p, txt, npy.")
 
 def fitsToTextCatalog(path, comment_pref = '#', format = None):
     """Function to copy a catalog that already exists as FITS to a text file with the same name and
@@ -186,24 +258,89 @@ class Mapper(object):
                                   readDict, writeDict)
     }
 
-    def __init__(self, root, experiment, obs_type, shear_type):
+    # The formats in which catalog datasets can be stored: {format-name: (reader, writer)}.  The
+    # format is chosen per dataset with the `catalog_types` argument of the constructor, and is
+    # FITS for any dataset not given there.
+    catalog_formats = {
+        "fits": (readCatalog, writeCatalog),
+        "npy": (readNpyCatalog, writeNpyCatalog),
+    }
+
+    # The catalog datasets that GalSim reads when using the config files written by
+    # SimBuilder.writeConfig(); it can only read them as FITS.
+    config_catalogs = ("epoch_catalog", "star_catalog", "star_test_catalog")
+
+    def __init__(self, root, experiment, obs_type, shear_type, check_catalogs=True,
+                 catalog_types=None):
         """Initialize a Mapper with the given root and experiment parameters.
 
         This will create the directory into which files will be saved, if it does not already
         exist.
 
-        @param[in] root        Root for the entire simulation set.
-        @param[in] experiment  Experiment parameter: "control", "real_galaxy", "variable_psf",
-                               "multiepoch", or "full".
-        @param[in] obs_type    Type of observation to simulate: either "ground" or "space".
-        @param[in] shear_type  Type of shear field: "constant" or "variable".
+        @param[in] root            Root for the entire simulation set.
+        @param[in] experiment      Experiment parameter: "control", "real_galaxy", "variable_psf",
+                                   "multiepoch", or "full".
+        @param[in] obs_type        Type of observation to simulate: either "ground" or "space".
+        @param[in] shear_type      Type of shear field: "constant" or "variable".
+        @param[in] check_catalogs  Check catalogs for NaN and Inf values when writing them?  If
+                                   False, they should be checked with checkCatalogs() later on.
+                                   [Default: True]
+        @param[in] catalog_types   A dict of {dataset-name: format-name} giving the format for some
+                                   catalog datasets, where the format is one of the keys in
+                                   self.catalog_formats.  [Default: None, meaning all catalogs are
+                                   FITS]
         """
         self.root = root
+        self.check_catalogs = check_catalogs
+        if catalog_types is None:
+            catalog_types = {}
+        self.catalog_types = catalog_types
+        self.mappings = dict(Mapper.mappings)
+        for dataset, catalog_type in catalog_types.items():
+            template, reader, writer = self.mappings[dataset]
+            if writer is not writeCatalog:
+                raise ValueError("Dataset %s is not a catalog!"%dataset)
+            if catalog_type not in self.catalog_formats:
+                raise ValueError("Invalid catalog type %s requested for %s!  Options are %s."%
+                                 (catalog_type, dataset, ", ".join(sorted(self.catalog_formats))))
+            self.mappings[dataset] = (template,) + self.catalog_formats[catalog_type]
         self.dir = os.path.join(experiment, obs_type, shear_type)
         self.full_dir = os.path.join(root, experiment, obs_type, shear_type)
         if not os.path.exists(self.full_dir):
             os.makedirs(os.path.abspath(self.full_dir))
 
+    def checkConfigCatalogTypes(self):
+        """Raise ValueError if any of the catalogs that GalSim reads when using the config files
+        (self.config_catalogs) is not stored as FITS."""
+        bad = [dataset for dataset in self.config_catalogs
+               if self.catalog_types.get(dataset, "fits") != "fits"]
+        if bad:
+            raise ValueError("GalSim config files require %s to be written as FITS!"%
+                             ", ".join(bad))
+
+    def getPath(self, dataset, data_id=None, **kwds):
+        """Get the name of the file in which a dataset is stored, including its extension.
+
+        @param[in] dataset    Type of dataset; must be one of the keys in self.mappings.
+        @param[in] data_id    A dict of values with which to expand the path template
+                              (the first value in self.mappings).
+        Additional keyword arguments are included in the `data_id` dict.
+
+        @return the file name.
+        """
+        if data_id is None: data_id = dict()
+        data_id = dict(data_id, **kwds)
+        template, reader, writer = self.mappings[dataset]
+        path = os.path.join(self.full_dir, template % data_id)
+        if writer is writeDict:
+            return path + ".yaml"
+        elif writer is writeCatalog:
+            return path + ".fits"
+        elif writer is writeNpyCatalog:
+            return path + ".npy"
+        # The image templates already include the extension.
+        return path
+
     def read(self, dataset, data_id=None, **kwds):
         """Read a dataset from disk.
 
@@ -231,8 +368,31 @@ class Mapper(object):
         if data_id is None: data_id = dict()
         data_id.update(kwds)
         template, reader, writer = self.mappings[dataset]
+        if writer is writeCatalog or writer is writeNpyCatalog:
+            return writer(obj, os.path.join(self.full_dir, template % data_id),
+                          check=self.check_catalogs)
         return writer(obj, os.path.join(self.full_dir, template % data_id))
 
+    def checkCatalogs(self, dataset, data_ids):
+        """Check a set of catalogs that were already written for NaN and Inf values, raising a
+        single RuntimeError that describes all catalogs with bad values.
+
+        @param[in] dataset    Type of dataset to check; must be one of the catalog keys in
+                              self.mappings.
+        @param[in] data_ids   A list of dicts of values with which to expand the path template
+                              (the first value in self.mappings), one per catalog.
+        """
+        template, reader, writer = self.mappings[dataset]
+        errors = []
+        for data_id in data_ids:
+            path = os.path.join(self.full_dir, template % data_id)
+            try:
+                checkCatalog(reader(path), path)
+            except RuntimeError as err:
+                errors.append(str(err))
+        if errors:
+            raise RuntimeError("\n".join(errors))
+
     def copyTo(self, other_mapper, dataset, data_id, new_template = None):
         """Copy files in the directory structure defined by this mapper to the same location in a
         directory structure defined by some other mapper.
@@ -273,7 +433,7 @@ class Mapper(object):
         # Read in the catalog.
         template, reader, writer = self.mappings[dataset]
         infile = os.path.join(self.full_dir, template % data_id)
-        incat = readCatalog(infile)
+        incat = reader(infile)
 
         # Choose the subset of data to save.
         outcat = numpy.zeros(len(incat),
@@ -315,7 +475,7 @@ class Mapper(object):
         # read in the catalog
         template, reader, writer = self.mappings[dataset]
         infile = os.path.join(self.full_dir, template % data_id)
-        incat = readCatalog(infile)
+        incat = reader(infile)
 
         # choose the subset of data to save, combined across both datasets. Note: this list
         # manipulation is necessary to avoid overwriting use_cols.
@@ -326,7 +486,7 @@ class Mapper(object):
         # read in the second catalog
         template, reader, writer = self.mappings[dataset_2]
         infile = os.path.join(self.full_dir, template % data_id)
-        incat_2 = readCatalog(infile)
+        incat_2 = reader(infile)
 
         # Now make a catalog for everything
         outcat = numpy.zeros(len(incat),
@@ -342,3 +502,107 @@ class Mapper(object):
         outfile = os.path.join(other_mapper.full_dir, new_template % data_id)
         pyfits.writeto(outfile + ".fits", outcat, clobber = True)
         return outfile+'.fits'
+
+class ParameterStore(object):
+    """Class that keeps all of the parameter dicts for a branch in a single file, as an alternative
+    to the one YAML file per dict (and per subfield / epoch) that the Mapper writes.
+
+    The dicts are keyed by the name that the YAML file would have had (without extension), so they
+    are read with the same arguments as Mapper.read(), e.g.,
+
+        >>> store = ParameterStore(mapper.full_dir)
+        >>> epoch_parameters = store.read("epoch_parameters", subfield_index=3, epoch_index=0)
+
+    The whole store is read in with a single unpickling when it is constructed, after which each
+    read is a dict lookup rather than the parsing of a YAML file.
+
+    SimBuilder.packageTruth() includes a store with the dicts in each truth tarball, so it is there
+    when the tarballs are unpacked.  A store can also be made from an existing directory of YAML
+    files (e.g., truth files packaged before the store was added) with makeParameterStore() or
+    convertParameterTree().
+    """
+
+    # Name of the file (without extension) holding the store within a branch directory.
+    file_name = "parameter_store"
+
+    # Path templates for the dict datasets that are written when packaging the public and truth
+    # files, rather than through the Mapper.  The dict datasets in Mapper.mappings can also be used.
+    templates = {
+        "shear_params": "shear_params-%(subfield_index)03d",
+        "subfield_offset": "subfield_offset-%(subfield_index)03d",
+        "deep_subfield_offset": "deep_subfield_offset-%(deep_subfield_index)03d",
+        "epoch_dither": "epoch_dither-%(subfield_index)03d-%(epoch_index)1d",
+        "deep_epoch_dither": "deep_epoch_dither-%(deep_subfield_index)03d-%(epoch_index)1d",
+    }
+
+    def __init__(self, directory, create=False):
+        """Open the store in the given directory.
+
+        @param[in] directory   Directory with the store, usually the `full_dir` of a Mapper.
+        @param[in] create      Start an empty store, instead of reading an existing one?
+                               [Default: False]
+        """
+        self.path = os.path.join(directory, self.file_name)
+        if create:
+            self.dicts = {}
+        else:
+            self.dicts = readDict(self.path, yaml_dict = False)
+
+    @classmethod
+    def exists(cls, directory):
+        """Return True if there is a store in the given directory."""
+        return os.path.isfile(os.path.join(directory, cls.file_name) + ".p")
+
+    def getTemplate(self, dataset):
+        """Return the path template for a dataset."""
+        if dataset in self.templates:
+            return self.templates[dataset]
+        template, reader, writer = Mapper.mappings[dataset]
+        if reader is not readDict:
+            raise ValueError("Dataset %s is not a dict!"%dataset)
+        return template
+
+    def read(self, dataset, data_id=None, **kwds):
+        """Read a dict from the store, taking the same arguments as Mapper.read()."""
+        if data_id is None: data_id = dict()
+        data_id.update(kwds)
+        return self.dicts[self.getTemplate(dataset) % data_id]
+
+    def write(self, obj, dataset, data_id=None, **kwds):
+        """Add a dict to the store, taking the same arguments as Mapper.write().  The store is not
+        written to disk until save() is called."""
+        if data_id is None: data_id = dict()
+        data_id.update(kwds)
+        self.dicts[self.getTemplate(dataset) % data_id] = obj
+
+    def getmtime(self):
+        """Return the time at which the store was last saved to disk."""
+        return os.path.getmtime(self.path + ".p")
+
+    def save(self):
+        """Write the store to disk."""
+        writeDict(self.dicts, self.path, type = 'p')
+
+def makeParameterStore(directory):
+    """Gather all of the YAML dicts in a directory (not including subdirectories) into a
+    ParameterStore in that directory, and return it.  The YAML files are left in place."""
+    import glob
+    store = ParameterStore(directory, create=True)
+    for yaml_file in glob.glob(os.path.join(directory, "*.yaml")):
+        path = os.path.splitext(yaml_file)[0]
+        store.dicts[os.path.basename(path)] = readDict(path)
+    store.save()
+    return store
+
+def convertParameterTree(root):
+    """Make a ParameterStore in each directory under `root` (e.g., the root directory for the
+    simulations, or the directory into which the truth tarballs were unpacked) that has YAML dicts.
+
+    @returns a list of the directories in which stores were made.
+    """
+    directories = []
+    for directory, _, file_names in os.walk(root):
+        if any([file_name.endswith(".yaml") for file_name in file_names]):
+            makeParameterStore(directory)
+            directories.append(directory)
+    return directories
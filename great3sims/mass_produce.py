@@ -26,7 +26,8 @@
 generate the simulations for GREAT3).  Currently it is set up for the Warp and Coma clusters at CMU,
 but hopefully should not be too painful to repurpose elsewhere, particularly on a machine that also
 uses PBS for the queueing system.  At minimum, there are some directories and such that will have to
-be changed to point to the right place on other systems."""
+be changed to point to the right place on other systems.  Alternatively, with `executor = 'local'`,
+all the jobs are run on the machine running this script, without any queueing system."""
 import time
 import os
 import subprocess
@@ -41,8 +42,17 @@ import great3sims
 # Define some basic parameters.  This includes some system-dependent things like directories for
 # output.
 root = '/physics/rmandelb/great3-v11'
-# Number of config files to be run per branch.
+# Number of config files to be run per branch.  With `balance_branches`, this is the average
+# number per branch.
 n_config_per_branch = 10
+# Split the branches into numbers of config files in proportion to how long their galaxy images
+# take to draw, so that all the config files take about the same time?  The costs come from the
+# timing history below if it is available, and otherwise from a model (see
+# mass_produce_utils.branch_costs()).
+balance_branches = True
+# File recording how long the galaxy images took per subfield for each branch, which is updated
+# after each run that uses the local executor.
+timing_history = 'g3_timing.yaml'
 # The total number of subfields is split up into n_config_per_branch config files.
 subfield_min = 0
 subfield_max = 204
@@ -68,6 +78,11 @@ preload = False # preloading for real galaxy branches - irrelevant for others.
 # `queue_nicely` is set to some number, it means that number is the maximum number to have in the
 # queue at once.
 queue_nicely = 13
+# Run the jobs through the PBS queue ('pbs'), or on this machine ('local')?
+executor = 'pbs'
+# For the local executor, how many jobs to run at once (None means one per CPU).  The CPUs are
+# shared out among the jobs when drawing images.
+local_n_jobs = None
 
 # Set which branches to test.
 experiments = [
@@ -92,6 +107,27 @@ branches = [ (experiment, obs_type, shear_type)
 n_branches = len(branches)
 print "Producing images for ",n_branches," branches"
 
+# Estimate how long each branch takes per subfield, and decide how many config files to split each
+# one into.
+costs = mass_produce_utils.branch_costs(
+    branches, mass_produce_utils.read_timing_history(timing_history))
+if balance_branches:
+    n_configs = mass_produce_utils.allocate_chunks(costs, n_config_per_branch*n_branches,
+                                                   subfield_max-subfield_min+1)
+else:
+    n_configs = [n_config_per_branch] * n_branches
+
+if executor == 'local':
+    runner = mass_produce_utils.LocalExecutor(n_jobs=local_n_jobs)
+    import multiprocessing
+    image_nproc = max(1, multiprocessing.cpu_count() / runner.n_jobs)
+elif executor == 'pbs':
+    runner = mass_produce_utils.PBSExecutor(sleep_time=sleep_time, max_jobs=queue_nicely)
+    # Use as many processors as we have on each node.
+    image_nproc = -1
+else:
+    raise ValueError("Unknown executor '%s'" % executor)
+
 if not package_only:
     if do_images:
         # Clean up from previous runs
@@ -101,30 +137,40 @@ if not package_only:
     # the following steps: metaparameters, catalogs, config.  For config, there is some additional
     # juggling to do for config file names / dirs.
     prefix1 = 'g3_step1_'
-    all_config_names = []
-    for experiment, obs_type, shear_type in branches:
+    # Lists of (estimated cost, config file name) for the galaxy and other config files, and a dict
+    # of {config file name: (branch name, number of subfields)} for the galaxy config files.
+    gal_configs = []
+    other_configs = []
+    gal_config_info = {}
+    for (experiment, obs_type, shear_type), cost, n_config in zip(branches, costs, n_configs):
         e = experiment[0]
         o = obs_type[0]
         s = shear_type[0]
 
-        pbs_name = prefix1+e+o+s
-        pbs_file = pbs_name+'.sh'
-        python_file = pbs_name+'.py'
+        job_name = prefix1+e+o+s
+        python_file = job_name+'.py'
 
         # Write out some scripts.
-        mass_produce_utils.pbs_script_python(pbs_file, pbs_name)
         new_config_names, new_psf_config_names, new_star_test_config_names = \
             mass_produce_utils.python_script(python_file, root, subfield_min, subfield_max,
                                              experiment, obs_type, shear_type, gal_dir, ps_dir,
-                                             seed, n_config_per_branch, preload, my_step=1)
+                                             seed, n_config, preload, my_step=1,
+                                             nproc=image_nproc)
+        chunks = mass_produce_utils.split_subfields(subfield_min, subfield_max, n_config)
         if do_gal_images:
-            for config_name in new_config_names:
-                all_config_names.append(config_name)
+            for config_name, (first, last) in zip(new_config_names, chunks):
+                gal_configs.append((cost*(last-first+1), config_name))
+                gal_config_info[config_name] = (e+o+s, last-first+1)
         for psf_config_name in new_psf_config_names:
-            all_config_names.append(psf_config_name)
+            other_configs.append((cost, psf_config_name))
         for star_test_config_name in new_star_test_config_names:
-            all_config_names.append(star_test_config_name)
+            other_configs.append((cost, star_test_config_name))
         seed += delta_seed
+    # The config files are run from a single queue, longest first, so that the workers that finish
+    # early pick up the remaining config files of the slow branches, and the last ones to run are
+    # short.  The PSF and star test config files are much quicker than the galaxy ones.
+    all_config_names = [config_name for cost, config_name in
+                        sorted(gal_configs, reverse=True) + sorted(other_configs, reverse=True)]
 
     print "Wrote files necessary to carry out metaparameters, catalogs, and config steps"
     t1 = time.time()
@@ -133,15 +179,12 @@ if not package_only:
         o = obs_type[0]
         s = shear_type[0]
 
-        pbs_name = prefix1+e+o+s
-        pbs_file = pbs_name+'.sh'
-        command_str = 'qsub '+pbs_file
-        p = subprocess.Popen(command_str,shell=True,close_fds=True)
-    # The above command just submitted all the files to the queue.  We have to periodically poll the
-    # queue to see if they are still running.
-    mass_produce_utils.check_done('g3_step1', sleep_time=sleep_time)
+        runner.submit_python(prefix1+e+o+s)
+    # The above command just submitted all the jobs.  Now wait for them to be done (for PBS, by
+    # periodically polling the queue to see if they are still running).
+    runner.wait('g3_step1')
     t2 = time.time()
-    # Times are approximate since check_done only checks every N seconds for some N
+    # For PBS, times are approximate since the queue is only checked every N seconds for some N
     print
     print "Time for generation of metaparameters, catalogs, and config files = ",t2-t1
     print
@@ -152,19 +195,29 @@ if not package_only:
         prefix2 = 'g3_step2_'
         for config_name in all_config_names:
             file_type, _ = os.path.splitext(config_name)
-            pbs_file = prefix2 + file_type+'.sh'
-            mass_produce_utils.pbs_script_yaml(pbs_file, config_name, root)
-            command_str = 'qsub '+pbs_file
-            if queue_nicely:
-                mass_produce_utils.check_njobs('g3_', sleep_time=sleep_time, n_jobs=queue_nicely)
-            p = subprocess.Popen(command_str, shell=True, close_fds=True)
-        mass_produce_utils.check_done('g3_', sleep_time=sleep_time)
+            runner.submit_config(prefix2 + file_type, config_name, root)
+        runner.wait('g3_')
         t2 = time.time()
-        # Times are approximate since check_done only checks every N seconds for some N
+        # For PBS, times are approximate since the queue is only checked every N seconds for some N
         print
         print "Time for generation of images = ",t2-t1
         print
 
+        # Record how long the galaxy images took per subfield for each branch, if the executor
+        # knows how long the jobs took.
+        branch_times = {}
+        for config_name, (branch_name, n_subfields) in gal_config_info.iteritems():
+            job_name = prefix2 + os.path.splitext(config_name)[0]
+            if job_name in runner.durations:
+                seconds, subfields = branch_times.get(branch_name, (0., 0))
+                branch_times[branch_name] = (seconds + runner.durations[job_name],
+                                             subfields + n_subfields)
+        if branch_times:
+            mass_produce_utils.write_timing_history(
+                timing_history, dict((branch_name, seconds / subfields)
+                                     for branch_name, (seconds, subfields) in
+                                     branch_times.iteritems()))
+
 # Finally, we go back to a process per branch for the final steps: star_params and packages.
 t1 = time.time()
 prefix3 = 'g3_step3_'
@@ -173,23 +226,20 @@ for experiment, obs_type, shear_type in branches:
     o = obs_type[0]
     s = shear_type[0]
 
-    pbs_name = prefix3+e+o+s
-    pbs_file = pbs_name+'.sh'
-    python_file = pbs_name+'.py'
+    job_name = prefix3+e+o+s
+    python_file = job_name+'.py'
 
     # Write out some scripts.
-    mass_produce_utils.pbs_script_python(pbs_file, pbs_name)
     mass_produce_utils.python_script(python_file, root, subfield_min, subfield_max, experiment,
                                      obs_type, shear_type, gal_dir, ps_dir, seed,
                                      n_config_per_branch, preload, my_step=3, public_dir=public_dir)
     # And then submit them
-    command_str = 'qsub '+pbs_file
-    p = subprocess.Popen(command_str,shell=True, close_fds=True)
-# The above command just submitted all the files to the queue.  We have to periodically poll the
-# queue to see if they are still running.
-mass_produce_utils.check_done('g3_step3', sleep_time=sleep_time)
+    runner.submit_python(job_name)
+# The above command just submitted all the jobs.  Now wait for them to be done (for PBS, by
+# periodically polling the queue to see if they are still running).
+runner.wait('g3_step3')
 t2 = time.time()
-# Times are approximate since check_done only checks every N seconds for some N
+# For PBS, times are approximate since the queue is only checked every N seconds for some N
 print
 print 'Time for great3sims.run star_params, packages = ',t2-t1
 print
@@ -22,7 +22,13 @@
 # DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER
 # IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT
 # OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
-"""Utilities needed for mass-production of sims."""
+"""Utilities needed for mass-production of sims.
+
+The jobs that make up a production run (python scripts that call great3sims.run(), and GalSim
+config files) are submitted to an executor, which runs them either on a cluster through the PBS
+queue (PBSExecutor) or directly on the local machine with a pool of processes (LocalExecutor).
+"""
+import sys
 import time
 import subprocess
 import re
@@ -60,13 +66,111 @@ def pbs_script_yaml(filename, configname, rootname):
         f.write("cd "+rootname+"\n")
         f.write("/home/rmandelb/software/bin/galsim "+configname+" -v1\n")
 
+def split_subfields(subfield_min, subfield_max, n_chunks):
+    """Split the range of subfields into n_chunks contiguous chunks of (nearly) equal size,
+    returning a list of (first, last) subfield indices.
+    """
+    import numpy as np
+    x = np.arange(n_chunks).astype(float)
+    x1 = x+1
+    first_arr = (np.round(subfield_min + (subfield_max-subfield_min+1)*x/n_chunks)).astype(int)
+    last_arr = (np.round(subfield_min + (subfield_max-subfield_min+1)*x1/n_chunks)-1).astype(int)
+    return zip(first_arr, last_arr)
+
+# Relative costs of drawing a real galaxy rather than a parametric one, and of drawing a galaxy with
+# a variable rather than constant PSF, in the cost model of subfield_cost().
+real_galaxy_cost = 3.
+variable_psf_cost = 1.5
+
+def subfield_cost(experiment, obs_type, shear_type):
+    """Estimate the relative cost of drawing the galaxy images for one subfield of a branch, from
+    the number of pixels drawn (postage stamp size, grid size and number of epochs) and whether
+    the branch uses real galaxies and a variable PSF.
+    """
+    from great3sims import builders, constants
+    builder = builders[experiment]
+    n_epochs = constants.n_epochs if builder.multiepoch else 1
+    cost = (constants.xsize[obs_type][builder.multiepoch] *
+            constants.ysize[obs_type][builder.multiepoch] *
+            constants.nrows * constants.ncols * n_epochs)
+    if builder.real_galaxy:
+        cost *= real_galaxy_cost
+    if builder.variable_psf:
+        cost *= variable_psf_cost
+    return float(cost)
+
+def branch_costs(branches, history=None):
+    """Estimate the time to draw the galaxy images for one subfield of each of a list of
+    (experiment, obs_type, shear_type) branches.
+
+    @param[in] branches  List of branches.
+    @param[in] history   A dict of {branch name (e.g., 'cgc'): seconds per subfield} measured in
+                         previous runs (see read_timing_history()), which is used where available.
+                         For the other branches, the cost model of subfield_cost() is scaled by the
+                         median ratio of the measured times to the model.
+
+    @return a list of the costs of the branches, in seconds if there is any history.
+    """
+    import numpy as np
+    if history is None:
+        history = {}
+    names = [e[0]+o[0]+s[0] for e, o, s in branches]
+    model = [subfield_cost(*branch) for branch in branches]
+    ratios = [history[name] / cost for name, cost in zip(names, model) if name in history]
+    if ratios:
+        scale = np.median(ratios)
+    else:
+        scale = 1.
+    return [history.get(name, scale * cost) for name, cost in zip(names, model)]
+
+def allocate_chunks(costs, n_chunks, n_subfields):
+    """Decide how many chunks (config files) to split each branch into, in proportion to their
+    costs, so that the chunks take about the same time whatever the branch.  Each branch gets at
+    least one and at most n_subfields chunks, and the numbers add up to n_chunks (or to the nearest
+    total allowed by those limits).  The chunks are shared out by the largest remainder method:
+    each branch first gets the integer part of its share, and the chunks left over go to the
+    branches whose shares are furthest above what they have been given.
+    """
+    n_chunks = min(max(n_chunks, len(costs)), n_subfields * len(costs))
+    total = float(sum(costs))
+    shares = [n_chunks * cost / total for cost in costs]
+    counts = [int(min(n_subfields, max(1, share))) for share in shares]
+    indices = range(len(costs))
+    while sum(counts) < n_chunks:
+        i = max([i for i in indices if counts[i] < n_subfields],
+                key=lambda i: shares[i] - counts[i])
+        counts[i] += 1
+    while sum(counts) > n_chunks:
+        i = min([i for i in indices if counts[i] > 1], key=lambda i: shares[i] - counts[i])
+        counts[i] -= 1
+    return counts
+
+def read_timing_history(filename):
+    """Read the dict of {branch name: seconds per subfield} written by write_timing_history(), or
+    return an empty dict if there is no such file."""
+    import os
+    import yaml
+    if not os.path.exists(filename):
+        return {}
+    with open(filename) as f:
+        return yaml.load(f) or {}
+
+def write_timing_history(filename, timings):
+    """Update the timing history file with a dict of {branch name: seconds per subfield}."""
+    import yaml
+    history = read_timing_history(filename)
+    history.update(timings)
+    with open(filename, 'w') as f:
+        yaml.dump(history, f, default_flow_style=False)
+
 def python_script(filename, root, subfield_min, subfield_max, experiment, obs_type, shear_type,
-                  gal_dir, ps_dir, seed, n_config_per_branch, preload, my_step, public_dir='public'):
+                  gal_dir, ps_dir, seed, n_config_per_branch, preload, my_step, public_dir='public',
+                  nproc=-1):
     """A utility to write a python script that just imports GREAT3 and does some steps of simulation
-    generation.
+    generation.  `nproc` is the number of processes that the config files written in step 1 use to
+    draw images (-1 means one per CPU).
     """
     import os
-    import numpy as np
     if my_step == 1:
         with open(filename, "w") as f:
             f.write("import sys\n")
@@ -93,16 +197,8 @@ def python_script(filename, root, subfield_min, subfield_max, experiment, obs_ty
             new_config_names = []
             new_psf_config_names = []
             new_star_test_config_names = []
-            x = np.arange(n_config_per_branch).astype(float)
-            x1 = x+1
-            first_arr = (np.round(subfield_min + (subfield_max-subfield_min+1)*x/n_config_per_branch)).astype(int)
-            last_arr = (np.round(subfield_min + (subfield_max-subfield_min+1)*x1/n_config_per_branch)-1).astype(int)
-            for i in range(n_config_per_branch):
-                first = first_arr[i]
-                last = last_arr[i]
-                # Could put nproc setting here.  However, for now we just want to use as many 
-                # processors as we have on that node.
-                nproc = -1
+            chunks = split_subfields(subfield_min, subfield_max, n_config_per_branch)
+            for i, (first, last) in enumerate(chunks):
                 command_str = "great3sims.run('" + root + "', subfield_min=" + str(first) + \
                     ", subfield_max=" + str(last) + ", experiments=['" + experiment + \
                     "'], obs_type=['" + obs_type + "'], shear_type=['" + shear_type + \
@@ -182,3 +278,105 @@ def check_njobs(process_str, sleep_time=60, n_jobs=10):
             time.sleep(sleep_time)
         res = re.findall(process_str, subprocess.check_output('qstat'))
         n_found = len(res)
+
+def _run_job(jobname, command, cwd):
+    """Run a job's command, with its output going to jobname.log in the current directory (like
+    the output of a PBS job), and return its exit status and how long it took in seconds.  This is
+    run by the threads of a LocalExecutor; each of them just waits for its subprocess, so the jobs
+    run in parallel.
+    """
+    import os
+    t1 = time.time()
+    with open(os.path.abspath(jobname + '.log'), 'w') as log:
+        status = subprocess.call(command, cwd=cwd, stdout=log, stderr=subprocess.STDOUT,
+                                 close_fds=True)
+    return status, time.time() - t1
+
+class PBSExecutor(object):
+    """Class that runs jobs by submitting PBS scripts to the queue with qsub, and waits for them by
+    polling qstat for their names."""
+    def __init__(self, sleep_time=60, max_jobs=None):
+        """
+        @param[in] sleep_time  Seconds between checks of the queue.
+        @param[in] max_jobs    Maximum number of config jobs to have in the queue at once, to be
+                               nice to other users; if None, they are all submitted at once.
+        """
+        self.sleep_time = sleep_time
+        self.max_jobs = max_jobs
+        # The run times of jobs are not known.
+        self.durations = {}
+
+    def submit_python(self, jobname):
+        """Run the python script jobname.py in the current directory."""
+        pbs_script_python(jobname+'.sh', jobname)
+        subprocess.Popen('qsub '+jobname+'.sh', shell=True, close_fds=True)
+
+    def submit_config(self, jobname, configname, rootname):
+        """Run GalSim on the config file configname in the directory rootname."""
+        pbs_script_yaml(jobname+'.sh', configname, rootname)
+        if self.max_jobs:
+            check_njobs('g3_', sleep_time=self.sleep_time, n_jobs=self.max_jobs)
+        subprocess.Popen('qsub '+jobname+'.sh', shell=True, close_fds=True)
+
+    def wait(self, prefix):
+        """Wait until all jobs whose names contain prefix are done."""
+        check_done(prefix, sleep_time=self.sleep_time)
+
+class LocalExecutor(object):
+    """Class that runs jobs on the local machine, as subprocesses started by a pool of threads, so
+    that a single many-core machine can be kept busy without any batch system.  Each job is tracked
+    by the AsyncResult of its thread, rather than by polling.
+    """
+    # Executables used to run the python scripts and config files.
+    python_exec = sys.executable
+    galsim_exec = 'galsim'
+
+    def __init__(self, n_jobs=None):
+        """
+        @param[in] n_jobs  How many jobs to run at once.  [default: one per CPU]
+        """
+        import multiprocessing
+        import multiprocessing.pool
+        if n_jobs is None:
+            n_jobs = multiprocessing.cpu_count()
+        self.n_jobs = n_jobs
+        self.pool = multiprocessing.pool.ThreadPool(n_jobs)
+        self.results = []
+        # Dict of {jobname: seconds} for the jobs that have finished.
+        self.durations = {}
+
+    def submit(self, jobname, command, cwd=None):
+        """Start running a command (a list of arguments) in the directory cwd.  The jobs are run in
+        the order they were submitted, each as soon as one of the n_jobs workers is free, so
+        submitting the longest ones first keeps all the workers busy until near the end."""
+        result = self.pool.apply_async(_run_job, (jobname, command, cwd))
+        self.results.append((jobname, result))
+
+    def submit_python(self, jobname):
+        """Run the python script jobname.py in the current directory."""
+        self.submit(jobname, [self.python_exec, jobname+'.py'])
+
+    def submit_config(self, jobname, configname, rootname):
+        """Run GalSim on the config file configname in the directory rootname."""
+        self.submit(jobname, [self.galsim_exec, configname, '-v1'], cwd=rootname)
+
+    def wait(self, prefix):
+        """Wait until all jobs whose names contain prefix are done, raising a RuntimeError if any
+        of them failed."""
+        failed = []
+        pending = []
+        for jobname, result in self.results:
+            if prefix not in jobname:
+                pending.append((jobname, result))
+                continue
+            try:
+                status, self.durations[jobname] = result.get()
+            except OSError as err:
+                # The command could not be started at all.
+                failed.append("%s (%s)" % (jobname, err))
+                continue
+            if status != 0:
+                failed.append("%s (exit status %d; see %s.log)" % (jobname, status, jobname))
+        self.results = pending
+        if failed:
+            raise RuntimeError("Jobs failed:\n" + "\n".join(failed))
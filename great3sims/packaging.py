@@ -0,0 +1,160 @@
+# Copyright (c) 2014, the GREAT3 executive committee (http://www.great3challenge.info/?q=contacts)
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification, are permitted
+# provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this list of conditions
+# and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice, this list of
+# conditions and the following disclaimer in the documentation and/or other materials provided with
+# the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors may be used to
+# endorse or promote products derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+# FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER
+# IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT
+# OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+This file contains the classes used to write the public and truth tarballs for a branch.  Files are
+streamed into the tarball straight from where they are, under whatever name they should have in the
+tarball, and the tarball is compressed in blocks by a pool of threads.
+"""
+import os
+import time
+import struct
+import zlib
+
+def _gzipMember(data, compresslevel):
+    """Compress a string into a complete gzip member.  A gzip file may consist of any number of
+    members one after the other, and it decompresses to the concatenation of their contents, so
+    blocks of a file compressed independently in this way can simply be written out in order.
+
+    This is run by the threads in the compression pool; zlib releases the GIL while compressing.
+    """
+    compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, -zlib.MAX_WBITS)
+    body = compressor.compress(data) + compressor.flush()
+    # Header: magic number, deflate, no flags, mtime, extra flags, unknown OS
+    if compresslevel == 9:
+        extra_flags = 2
+    else:
+        extra_flags = 0
+    header = struct.pack("<BBBBIBB", 0x1f, 0x8b, 8, 0, int(time.time()), extra_flags, 255)
+    trailer = struct.pack("<II", zlib.crc32(data) & 0xffffffff, len(data) & 0xffffffff)
+    return header + body + trailer
+
+class ParallelGzipFile(object):
+    """A write-only file object that gzip-compresses what is written to it, in blocks of
+    `blocksize` bytes that are compressed at the same time by a pool of threads.
+
+    The output is a valid gzip file (made of one gzip member per block) that can be read by gzip,
+    tar and the Python gzip and tarfile modules.  It is a few hundredths of a percent larger than
+    that written by gzip itself.
+    """
+    def __init__(self, filename, pool=None, compresslevel=9, blocksize=1<<22, max_pending=8):
+        """Open the file `filename` for writing.
+
+        @param[in] filename       Name of the gzip file to write.
+        @param[in] pool           A multiprocessing.pool.ThreadPool to compress the blocks, which
+                                  may be shared with other ParallelGzipFiles.  If None, blocks are
+                                  compressed in this thread.  [default: None]
+        @param[in] compresslevel  zlib compression level, from 1 to 9.  [default: 9, like tarfile]
+        @param[in] blocksize      Number of bytes compressed at a time.  [default: 4 MB]
+        @param[in] max_pending    Maximum number of blocks handed to the pool that have not been
+                                  written yet, which bounds the memory used.  [default: 8]
+        """
+        self.fileobj = open(filename, "wb")
+        self.pool = pool
+        self.compresslevel = compresslevel
+        self.blocksize = blocksize
+        self.max_pending = max_pending
+        self.buffer = []
+        self.buffer_size = 0
+        self.pending = []
+        self.n_members = 0
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.buffer_size += len(data)
+        if self.buffer_size >= self.blocksize:
+            data = "".join(self.buffer)
+            for start in xrange(0, len(data) - self.blocksize + 1, self.blocksize):
+                self._compress(data[start:start+self.blocksize])
+            leftover = data[start+self.blocksize:]
+            self.buffer = [leftover]
+            self.buffer_size = len(leftover)
+
+    def _compress(self, block):
+        """Compress a block, and write out any blocks that have finished compressing, in order."""
+        if self.pool is None:
+            self.fileobj.write(_gzipMember(block, self.compresslevel))
+        else:
+            self.pending.append(self.pool.apply_async(_gzipMember, (block, self.compresslevel)))
+            while self.pending and (len(self.pending) > self.max_pending or
+                                    self.pending[0].ready()):
+                self.fileobj.write(self.pending.pop(0).get())
+        self.n_members += 1
+
+    def close(self):
+        if self.fileobj is None:
+            return
+        if self.buffer_size > 0 or self.n_members == 0:
+            self._compress("".join(self.buffer))
+        self.buffer = []
+        for result in self.pending:
+            self.fileobj.write(result.get())
+        self.pending = []
+        self.fileobj.close()
+        self.fileobj = None
+
+    def abort(self):
+        """Close the file without writing anything more to it, e.g., after an error.  Blocks that
+        are still being compressed are waited for, so they do not outlive the file."""
+        if self.fileobj is None:
+            return
+        for result in self.pending:
+            result.wait()
+        self.buffer = []
+        self.pending = []
+        self.fileobj.close()
+        self.fileobj = None
+
+class TarballWriter(object):
+    """Class that writes a gzipped tarball, adding files from anywhere on disk under the names they
+    should have in the tarball, so that nothing needs to be copied into place (and no change of
+    working directory is needed) before packaging.
+    """
+    def __init__(self, filename, pool=None, compresslevel=9):
+        """Open the tarball `filename` for writing; `pool` and `compresslevel` are passed on to
+        ParallelGzipFile.
+        """
+        import tarfile
+        self.filename = filename
+        self.gzip_file = ParallelGzipFile(filename, pool=pool, compresslevel=compresslevel)
+        # Stream mode, since the gzip file can only be written in order.
+        self.tar = tarfile.open(fileobj=self.gzip_file, mode="w|")
+
+    def add(self, path, arcname, remove=False):
+        """Add the file `path` to the tarball as `arcname`, and delete it afterwards if `remove`
+        (e.g., for files that were only written in order to be packaged).
+        """
+        self.tar.add(path, arcname=arcname)
+        if remove:
+            os.remove(path)
+
+    def close(self):
+        self.tar.close()
+        self.gzip_file.close()
+
+    def abort(self):
+        """Stop writing the tarball (e.g., after an error), and delete the incomplete file."""
+        self.gzip_file.abort()
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
@@ -30,7 +30,8 @@ import os
 import pyfits
 from . import constants
 
-def makeBuilder(obs_type, variable_psf, draw_psf_src, multiepoch, shear_type, opt_psf_dir, atmos_ps_dir):
+def makeBuilder(obs_type, variable_psf, draw_psf_src, multiepoch, shear_type, opt_psf_dir, atmos_ps_dir,
+                optical_psf_cache_size=None, optical_psf_cache_tol=None):
     """Return a PSFBuilder appropriate for the given options.
 
     @param[in] obs_type     Observation type: either "ground" or "space".
@@ -46,10 +47,19 @@ def makeBuilder(obs_type, variable_psf, draw_psf_src, multiepoch, shear_type, op
     @param[in] opt_psf_dir  Directory with the optical PSF models for ground and space variable PSF
                             simulations.
     @param[in] atmos_ps_dir Directory with tabulated atmospheric PSF anisotropy power spectra.
+    @param[in] optical_psf_cache_size  For variable PSF branches, the size of the cache of
+                            galsim.OpticalPSF objects (see VariablePSFBuilder).  [default: None,
+                            which means to use VariablePSFBuilder.optical_psf_cache_size]
+    @param[in] optical_psf_cache_tol   For variable PSF branches, the tolerance for quantizing the
+                            aberrations before looking them up in the cache (see
+                            VariablePSFBuilder).  [default: None, which means to use
+                            VariablePSFBuilder.optical_psf_cache_tol]
     """
     if obs_type == "space" or obs_type == "ground":
         if variable_psf:
-            return VariablePSFBuilder(obs_type, multiepoch, shear_type, opt_psf_dir, atmos_ps_dir)
+            return VariablePSFBuilder(obs_type, multiepoch, shear_type, opt_psf_dir, atmos_ps_dir,
+                                      optical_psf_cache_size=optical_psf_cache_size,
+                                      optical_psf_cache_tol=optical_psf_cache_tol)
         elif draw_psf_src:
             return DrawPSFBuilder(obs_type, multiepoch, shear_type, draw_psf_src)
         else:
@@ -784,7 +794,30 @@ class VariablePSFBuilder(PSFBuilder):
     dlog_theta_0 = (log_max_theta_0 - log_min_theta_0) / (n_theta_0 - 1)
     theta_0_grid = np.logspace(np.log10(min_theta_0), np.log10(max_theta_0), n_theta_0)
 
-    def __init__(self, obs_type, multiepoch, shear_type, opt_psf_dir, atmos_ps_dir):
+    # When drawing images within this script, building a galsim.OpticalPSF for each object is
+    # expensive (it requires an FFT of the pupil plane).  So makeGalSimObject() keeps a
+    # least-recently-used cache of galsim.OpticalPSF objects, keyed by the optical PSF parameters,
+    # which is shared by all objects that it is asked to make (e.g., the galaxies and then the
+    # stars of an epoch).  Setting optical_psf_cache_size to 0 turns off the cache.
+    optical_psf_cache_size = 200
+    # Tolerance for quantizing the aberrations (in units of wavelength) before using them to build
+    # the galsim.OpticalPSF.  If it is zero, objects can only share an OpticalPSF when their
+    # aberrations are identical, so the images are exactly the same as without the cache.  If it is
+    # positive, each aberration is rounded to the nearest multiple of this tolerance, so nearby
+    # objects on a tile share the same OpticalPSF.  Since the rounded values do not depend on which
+    # object was made first, the results are still independent of the order in which objects are
+    # drawn.  Each aberration then differs from its catalog value by up to half the tolerance.
+    #
+    # Every object on a tile has different aberrations, so with a tolerance of zero the cache only
+    # helps when the same object is drawn more than once.  For the ground model, where the
+    # aberrations vary by 0.1-0.4 waves across a tile, the fraction of objects that reuse a cached
+    # OpticalPSF (with the default cache size) is about 1% for a tolerance of 0.01 waves, 10% for
+    # 0.03, 34% for 0.05 and 65% for 0.1.  These can be set with the `optical_psf_cache_size` and
+    # `optical_psf_cache_tol` arguments of great3sims.run().
+    optical_psf_cache_tol = 0.
+
+    def __init__(self, obs_type, multiepoch, shear_type, opt_psf_dir, atmos_ps_dir,
+                 optical_psf_cache_size=None, optical_psf_cache_tol=None):
         # First, a sanity check: we require nrows == ncols for the GalSim lensing engine (in order
         # to have a square grid), so we check for that before attempting any calculations for
         # variable PSF, ground-based sims.
@@ -798,6 +831,13 @@ class VariablePSFBuilder(PSFBuilder):
         self.shear_type = shear_type
         self.atmos_ps_dir = atmos_ps_dir
         self.opt_psf_dir = opt_psf_dir
+        # Override the class defaults for the cache of galsim.OpticalPSF objects, if requested.
+        if optical_psf_cache_size is not None:
+            self.optical_psf_cache_size = optical_psf_cache_size
+        if optical_psf_cache_tol is not None:
+            if optical_psf_cache_tol < 0.:
+                raise ValueError("optical_psf_cache_tol must be >= 0")
+            self.optical_psf_cache_tol = optical_psf_cache_tol
 
         # Now that we've specified an obs_type, we can figure out the tile structure:
         self.n_tiles = self.n_tile_linear[self.obs_type]**2
@@ -811,6 +851,9 @@ class VariablePSFBuilder(PSFBuilder):
             self.tile_y_min.append((i_tile / self.n_tile_linear[self.obs_type]) *
                                    self.tile_size_deg)
 
+        # Set up the (empty) cache of galsim.OpticalPSF objects for makeGalSimObject().
+        self.clearOpticalPSFCache()
+
     def generateFieldParameters(self, rng, field_index):
         """Generate PSF parameters for this field."""
         # Define some constants that we will need throughout.
@@ -1228,21 +1271,13 @@ class VariablePSFBuilder(PSFBuilder):
                 # Add tile (x_min, ymin) to get position on the tile.
                 tile_x_pos += optical_psf_model.xmin
                 tile_y_pos += optical_psf_model.ymin
-                # Interpolate to get the OpticalPSF parameters.  Have to do this one by one, so
-                # track indices carefully.
+                # Interpolate to get the OpticalPSF parameters for all objects on this tile at
+                # once.  The coefficients come back in the same order as self.use_aber (defocus,
+                # astig1, astig2, coma1, coma2, trefoil1, trefoil2, spher).
                 tile_cat_indices = cat_indices[tile_ind == iter_tile_ind]
-                for ind_on_tile in range(len(tile_cat_indices)):
-                    coefs = optical_psf_model.get_zernike_coefficients(tile_x_pos[ind_on_tile],
-                                                                       tile_y_pos[ind_on_tile])
-                    this_cat_ind = tile_cat_indices[ind_on_tile]
-                    catalog[self.opt_schema_pref+"defocus"][this_cat_ind] = coefs[0]
-                    catalog[self.opt_schema_pref+"astig1"][this_cat_ind] = coefs[1]
-                    catalog[self.opt_schema_pref+"astig2"][this_cat_ind] = coefs[2]
-                    catalog[self.opt_schema_pref+"coma1"][this_cat_ind] = coefs[3]
-                    catalog[self.opt_schema_pref+"coma2"][this_cat_ind] = coefs[4]
-                    catalog[self.opt_schema_pref+"trefoil1"][this_cat_ind] = coefs[5]
-                    catalog[self.opt_schema_pref+"trefoil2"][this_cat_ind] = coefs[6]
-                    catalog[self.opt_schema_pref+"spher"][this_cat_ind] = coefs[7]
+                coefs = optical_psf_model.get_zernike_coefficients_array(tile_x_pos, tile_y_pos)
+                for i_aber, aber in enumerate(self.use_aber):
+                    catalog[self.opt_schema_pref+aber][tile_cat_indices] = coefs[i_aber]
 
         # For ground-based PSFs, we use the cached galsim.PowerSpectrum objects, one per
         # tile.  They each have a saved grid of shears that we can use to make PSF
@@ -1340,16 +1375,52 @@ class VariablePSFBuilder(PSFBuilder):
 
         return d
 
-    def makeGalSimObject(self, record, parameters):
-        # Size is specified in arcsec.
+    def clearOpticalPSFCache(self):
+        """Empty the cache of galsim.OpticalPSF objects used by makeGalSimObject(), and reset its
+        hit / miss statistics."""
+        import collections
+        self.optical_psf_cache = collections.OrderedDict()
+        self.optical_psf_cache_hits = 0
+        self.optical_psf_cache_misses = 0
 
+    def getOpticalPSFCacheStats(self):
+        """Return a dict with the number of hits and misses for the cache of galsim.OpticalPSF
+        objects used by makeGalSimObject(), and its current size.
+
+        Note that when images are drawn by a pool of processes, each process has its own copy of
+        the cache, so these statistics only include the objects made in this process.
+        """
+        return {"hits": self.optical_psf_cache_hits,
+                "misses": self.optical_psf_cache_misses,
+                "size": len(self.optical_psf_cache)}
+
+    def makeOpticalPSF(self, record):
+        """Return the galsim.OpticalPSF for a catalog record, taking it from the cache if possible.
+        See the comments for optical_psf_cache_size and optical_psf_cache_tol above.
+        """
         # Choose which aberrations to use based on what should be in catalog
         # We have to start by making a dict with all aberrations that are nonzero.
         aber_dict = dict()
-        # Then populate those that we use.
+        # Then populate those that we use, quantizing them if requested.
+        tol = self.optical_psf_cache_tol
         for aber in self.use_aber:
-            aber_dict[aber] = record[self.opt_schema_pref+aber]
-
+            aber_val = float(record[self.opt_schema_pref+aber])
+            if tol > 0.:
+                aber_val = tol * round(aber_val / tol)
+            aber_dict[aber] = aber_val
+
+        key = (float(record["opt_psf_lam_over_diam"]), float(record["opt_psf_obscuration"]),
+               int(record["opt_psf_n_struts"]), float(record["opt_psf_strut_angle"]),
+               float(record["opt_psf_pad_factor"])) + \
+               tuple([aber_dict[aber] for aber in self.use_aber])
+        if key in self.optical_psf_cache:
+            self.optical_psf_cache_hits += 1
+            # Move it to the end, so that it is the most recently used entry.
+            optical_psf = self.optical_psf_cache.pop(key)
+            self.optical_psf_cache[key] = optical_psf
+            return optical_psf
+
+        self.optical_psf_cache_misses += 1
         optical_psf = galsim.OpticalPSF(record["opt_psf_lam_over_diam"],
                                         obscuration=record["opt_psf_obscuration"],
                                         nstruts=record["opt_psf_n_struts"],
@@ -1357,6 +1428,18 @@ class VariablePSFBuilder(PSFBuilder):
                                         pad_factor=record["opt_psf_pad_factor"],
                                         suppress_warning=True,
                                         **aber_dict)
+        if self.optical_psf_cache_size > 0:
+            self.optical_psf_cache[key] = optical_psf
+            # Throw out the least recently used entry if the cache is too big.
+            if len(self.optical_psf_cache) > self.optical_psf_cache_size:
+                self.optical_psf_cache.popitem(last=False)
+        return optical_psf
+
+    def makeGalSimObject(self, record, parameters):
+        # Size is specified in arcsec.
+
+        # Get the optical PSF, which is the expensive part, possibly from the cache.
+        optical_psf = self.makeOpticalPSF(record)
         if self.obs_type == "space":
             jitter_psf = galsim.Gaussian(sigma=record["opt_psf_jitter_sigma"])
             e = record["opt_psf_jitter_e"]
@@ -0,0 +1,195 @@
+# Copyright (c) 2014, the GREAT3 executive committee (http://www.great3challenge.info/?q=contacts)
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification, are permitted
+# provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this list of conditions
+# and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice, this list of
+# conditions and the following disclaimer in the documentation and/or other materials provided with
+# the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors may be used to
+# endorse or promote products derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+# FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER
+# IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT
+# OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+This file contains the classes used to keep track of the work done by great3sims.run(), so that a
+run can skip whatever is already up to date and resume where a previous one stopped.
+
+Each step of the run is split into Tasks, one for each subfield and epoch (or for each subfield, or
+for the whole branch, depending on the step), and each Task declares the files that it reads and
+writes.  When a Task is done, the sizes and modification times of those files are recorded in the
+branch's TaskManifest.  A Task is up to date if none of its files has changed since then; in
+particular, if a Task is run again, the Tasks that read its outputs are no longer up to date.
+"""
+import os
+
+def fileSignature(path):
+    """Return the (size, modification time) of a file, or None if it does not exist."""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (stat.st_size, stat.st_mtime)
+
+class Task(object):
+    """A unit of work: one step of great3sims.run() for one branch and one subfield and epoch,
+    either of which may be None for work that is done once per subfield or once per branch.
+    """
+    def __init__(self, step, subfield_index, epoch_index, func, args=(), inputs=(), outputs=(),
+                 params=None):
+        """Define a Task.
+
+        @param[in] step            Name of the step, e.g., 'catalogs'.
+        @param[in] subfield_index  Subfield index, or None.
+        @param[in] epoch_index     Epoch index, or None.
+        @param[in] func            Function that does the work; it is called as func(*args).
+        @param[in] args            Arguments to func.
+        @param[in] inputs          Names of the files that func reads.
+        @param[in] outputs         Names of the files that func writes.
+        @param[in] params          A dict of any other values that affect the outputs, such as the
+                                   random seed; the Task is out of date if they change.
+                                   [default: None]
+        """
+        self.step = step
+        self.subfield_index = subfield_index
+        self.epoch_index = epoch_index
+        self.func = func
+        self.args = args
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        if params is None:
+            params = {}
+        self.params = params
+
+    @property
+    def key(self):
+        return (self.step, self.subfield_index, self.epoch_index)
+
+    def describe(self):
+        """Describe which part of the branch this Task is for, as in the progress messages of
+        great3sims.run(); this is an empty string for Tasks for the whole branch."""
+        if self.subfield_index is None:
+            return ""
+        elif self.epoch_index is None:
+            return "subfield %d" % self.subfield_index
+        else:
+            return "subfield %d / epoch %d" % (self.subfield_index, self.epoch_index)
+
+    def run(self):
+        return self.func(*self.args)
+
+class TaskManifest(object):
+    """Class that records the Tasks that have been done for a branch, in a file in the branch
+    directory.
+
+    Each record is appended to the file (with a single write) as soon as its Task is done, so that
+    the manifest is up to date even if the run is interrupted.  A partly written record at the end
+    of the file, or records for Tasks that have been done more than once, are cleaned up the next
+    time the manifest is read.
+    """
+
+    # Name of the file holding the manifest within a branch directory.
+    file_name = "task_manifest.p"
+
+    def __init__(self, directory):
+        """Read the manifest in the given directory, if there is one."""
+        import cPickle
+        self.directory = directory
+        self.path = os.path.join(directory, self.file_name)
+        self.records = {}
+        n_records = 0
+        truncated = False
+        if os.path.exists(self.path):
+            with open(self.path, "rb") as stream:
+                while True:
+                    try:
+                        key, record = cPickle.load(stream)
+                    except EOFError:
+                        break
+                    except Exception:
+                        truncated = True
+                        break
+                    self.records[key] = record
+                    n_records += 1
+        if truncated or n_records > len(self.records):
+            self._rewrite()
+
+    def _rewrite(self):
+        """Write all of the records to a new file, then rename it to replace the old one."""
+        import cPickle
+        with open(self.path + ".tmp", "wb") as stream:
+            for key, record in self.records.iteritems():
+                cPickle.dump((key, record), stream, protocol=2)
+        os.rename(self.path + ".tmp", self.path)
+
+    def _signatures(self, task):
+        """Return a dict of the signatures of the input and output files of a Task, keyed by their
+        names relative to the manifest directory (so they do not depend on the working directory).
+        """
+        return dict((os.path.relpath(path, self.directory), fileSignature(path))
+                    for path in task.inputs + task.outputs)
+
+    def isDone(self, task):
+        """Return whether a Task is up to date: it has been done with the same params, and none of
+        its input and output files has changed (or gone missing) since then."""
+        record = self.records.get(task.key)
+        if record is None:
+            return False
+        params, signatures = record
+        if params != task.params:
+            return False
+        return signatures == self._signatures(task)
+
+    def record(self, task):
+        """Record that a Task has been done.  Nothing is recorded if any of its outputs are
+        missing, so that the Task will be done again next time."""
+        import cPickle
+        signatures = self._signatures(task)
+        if any(fileSignature(path) is None for path in task.outputs):
+            return
+        self.records[task.key] = (task.params, signatures)
+        data = cPickle.dumps((task.key, self.records[task.key]), protocol=2)
+        with open(self.path, "ab") as stream:
+            stream.write(data)
+
+def runTasks(tasks, manifest, resume=True, report=None, branch=None):
+    """Do each of a list of Tasks in turn, recording it in `manifest` when it is done.  If `resume`,
+    the Tasks that are up to date according to the manifest are skipped.  If `report` is an
+    instrument.RunReport, each Task is measured, labelled with the name of the `branch`.
+
+    @return the number of Tasks that were skipped.
+    """
+    import sys
+    n_skipped = 0
+    for task in tasks:
+        if resume and manifest.isDone(task):
+            n_skipped += 1
+            continue
+        label = task.describe()
+        if label:
+            sys.stdout.write('\r')
+            sys.stdout.write("  " + label)
+            sys.stdout.flush()
+        if report is None:
+            task.run()
+        else:
+            report.measure(task.run, branch=branch, step=task.step,
+                           subfield_index=task.subfield_index, epoch_index=task.epoch_index,
+                           method=task.func.__name__)
+        manifest.record(task)
+    if n_skipped > 0:
+        sys.stdout.write('\r')
+        sys.stdout.write("  skipped %d of %d tasks that were up to date" % (n_skipped, len(tasks)))
+        sys.stdout.flush()
+    return n_skipped
@@ -34,6 +34,7 @@ import os
 import codecs
 import numpy as np
 import galsim
+from optical_psf_interpolation import interpolate_grid
 
 def loadZernikeCoefficients(filename_coeff):
     """
@@ -162,24 +163,24 @@ class OpticalPSFMisalignment:
     def apply(self, x, y):
         """
         Inputs
-        - x: x position on FOV [deg]
-        - y: y position on FOV [deg]
+        - x: x position on FOV [deg], scalar or ndarray
+        - y: y position on FOV [deg], scalar or ndarray
 
         Outputs
         - delta_coefs: ndarray, residual of Zernike coefficients at (x, y) caused by misalignments
-                       [wavelength]
+                       [wavelength].  If x and y are arrays, this has shape (8, len(x)).
         """
-        dzernike = self.zernDelta + self.zernThetax * x + self.zernThetay * y
-        ddefocus = dzernike[0]
-        da1 = dzernike[1]
-        da2 = dzernike[2]
-        dc1 = dzernike[3]
-        dc2 = dzernike[4]
-        dt1 = 0.
-        dt2 = 0.
-        dspher = 0.
-        delta_coefs = np.array([ddefocus, da1, da2, dc1, dc2,
-                                dt1, dt2, dspher])*self.lam_orig/self.lam
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        # Reshape the per-coefficient responses so they broadcast against x and y, which can be
+        # scalars or arrays.
+        shape = (len(self.zernDelta),) + (1,)*x.ndim
+        dzernike = self.zernDelta.reshape(shape) + self.zernThetax.reshape(shape) * x + \
+            self.zernThetay.reshape(shape) * y
+        # Only defocus, a1, a2, c1 and c2 respond to misalignments; t1, t2 and spher do not.
+        delta_coefs = np.zeros((8,) + dzernike.shape[1:])
+        delta_coefs[:len(self.zernDelta)] = dzernike
+        delta_coefs *= self.lam_orig/self.lam
         return delta_coefs
 
 class OpticalPSFModel:
@@ -284,6 +285,14 @@ class OpticalPSFModel:
             # We have to convert Zernike coefficients in units of wavelength we want. 
             coefs[:, n - i_y - 1, n - i_x - 1] = coefs_tmp*wavelength*1e-6/self.lam
         
+        # keep the grid for get_zernike_coefficients_array(), which can only reproduce the default
+        # interpolant
+        self.grid_spacing = d
+        if interpolant2d == None and n % 2 == 1:
+            self.coefficient_grid = coefs
+        else:
+            self.coefficient_grid = None
+
         # get interpolated images
         self.interpolated_coefficients = list()
         for coef in coefs:
@@ -325,6 +334,38 @@ class OpticalPSFModel:
         coefs += delta_coefs
         return coefs
 
+    def get_zernike_coefficients_array(self, x, y):
+        """
+        Inputs
+        - x: ndarray, x positions on FOV [deg]
+        - y: ndarray, y positions on FOV [deg]
+
+        Outputs
+        - coefs: ndarray with shape (8, len(x)), Zernike coefficients at each (x, y) including
+                 effects by misalignments [wavelength].  These are the same as the results of
+                 get_zernike_coefficients() for each position, but all positions are evaluated in
+                 one go with NumPy.
+        """
+        x = np.atleast_1d(np.asarray(x, dtype=float))
+        y = np.atleast_1d(np.asarray(y, dtype=float))
+        if np.any((x < self.xmin) | (x > self.xmax) | (y < self.ymin) | (y > self.ymax)):
+            import warnings
+            warnings.warn(
+                    "Warning: some positions are not within the bounds " +
+                    "of the gridded values.  Min, max x: (%f,%f) "%(self.xmin,self.xmax) +
+                    "and min, max y: (%f, %f) "%(self.ymin,self.ymax))
+        if self.coefficient_grid is None:
+            # A non-default interpolant was used, so fall back to the InterpolatedImage objects.
+            coefs = np.zeros((self.ncoefs, len(x)))
+            for i, (_x, _y) in enumerate(zip(x, y)):
+                for i_coef, interpolated_coefficient in enumerate(self.interpolated_coefficients):
+                    coefs[i_coef, i] = interpolated_coefficient.xValue(galsim.PositionD(_x, _y))
+        else:
+            coefs = interpolate_grid(self.coefficient_grid,
+                                      x / self.grid_spacing, y / self.grid_spacing)
+        coefs += self.optical_psf_misalignment.apply(x, y)
+        return coefs
+
     def get_psf(self, x, y, additional_coefs = None):
         """
         - x: x position on FOV [deg]
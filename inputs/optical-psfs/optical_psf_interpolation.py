@@ -0,0 +1,83 @@
+# Copyright (c) 2014, the GREAT3 executive committee (http://www.great3challenge.info/?q=contacts)
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification, are permitted
+# provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this list of conditions
+# and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice, this list of
+# conditions and the following disclaimer in the documentation and/or other materials provided with
+# the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors may be used to
+# endorse or promote products derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+# FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER
+# IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT
+# OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""This file contains the interpolation of tabulated Zernike coefficients over the field of view that
+is shared by the ground- and space-based optical PSF models in ground_optical_psf.py and
+space_optical_psf.py.
+
+It is imported by those files, so it must be in the same directory as them."""
+
+import numpy as np
+
+def quintic_kernel(x):
+    """The kernel of galsim.Quintic(), evaluated for an array of positions `x` in units of the grid
+    spacing."""
+    x = np.abs(x)
+    kernel = np.zeros_like(x)
+    m = x <= 1.
+    kernel[m] = 1. + (1./12.)*x[m]**3*(-95.+x[m]*(138.-55.*x[m]))
+    m = (x > 1.) & (x <= 2.)
+    kernel[m] = (1./24.)*(x[m]-1.)*(x[m]-2.)*(-138.+x[m]*(348.+x[m]*(-249.+55.*x[m])))
+    m = (x > 2.) & (x < 3.)
+    kernel[m] = (1./24.)*(x[m]-2.)*(x[m]-3.)**2*(-54.+x[m]*(50.-11.*x[m]))
+    return kernel
+
+def interpolate_grid(grid, u, v):
+    """Evaluate the same interpolation as galsim.InterpolatedImage(..., x_interpolant =
+    galsim.InterpolantXY(galsim.Quintic()), normalization = "sb").xValue() for many positions at
+    once.
+
+    Inputs
+    - grid: ndarray with shape (ncoefs, n, n), where grid[:, j, i] is the value at column i, row j.
+            n must be odd, so that the central pixel is at the origin as for InterpolatedImage.
+    - u: ndarray, x positions in units of the grid spacing
+    - v: ndarray, y positions in units of the grid spacing
+
+    Outputs
+    - values: ndarray with shape (ncoefs, len(u))
+    """
+    n_grid = grid.shape[-1]
+    # InterpolatedImage treats everything outside the image as zero, and the Quintic kernel extends
+    # 3 grid points in each direction, so pad the grid with 3 zeros on each side.
+    pad = 3
+    padded = np.zeros((grid.shape[0], n_grid + 2*pad, n_grid + 2*pad))
+    padded[:, pad:n_grid+pad, pad:n_grid+pad] = grid
+    # Convert positions to (fractional) indices in the padded grid.
+    u = np.asarray(u, dtype=float) + (n_grid-1)/2 + pad
+    v = np.asarray(v, dtype=float) + (n_grid-1)/2 + pad
+    i_floor = np.floor(u).astype(int)
+    j_floor = np.floor(v).astype(int)
+    values = np.zeros((grid.shape[0], len(u)))
+    for di in range(-2, 4):
+        i = i_floor + di
+        weight_x = quintic_kernel(u - i)
+        use_x = (i >= 0) & (i < padded.shape[2])
+        i = np.clip(i, 0, padded.shape[2]-1)
+        for dj in range(-2, 4):
+            j = j_floor + dj
+            weight = weight_x * quintic_kernel(v - j)
+            weight[~(use_x & (j >= 0) & (j < padded.shape[1]))] = 0.
+            j = np.clip(j, 0, padded.shape[1]-1)
+            values += padded[:, j, i] * weight
+    return values
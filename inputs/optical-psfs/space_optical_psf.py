@@ -33,6 +33,7 @@ import galsim
 import numpy as np
 import itertools
 import exceptions
+from optical_psf_interpolation import interpolate_grid
 
 class OpticalPSFModel:
     """This class is used for obtaining a space-based optical PSF at an arbitrary position (x,y).
@@ -118,6 +119,13 @@ class OpticalPSFModel:
 
         # interpolate coefficients
         self.n_coefs = 8 # defocus, a1, a2, c1, c2, t1, t2, spher
+        # keep the grid for get_zernike_coefficients_array(), which can only reproduce the default
+        # interpolant
+        if interpolant2d == None and n % 2 == 1:
+            self.coefficient_grid = np.ascontiguousarray(
+                np.rollaxis(mapped_coefs[:, :, 3:3+self.n_coefs], 2))
+        else:
+            self.coefficient_grid = None
         self.interpolated_coefficients = list()
         for i_coefs in range(self.n_coefs):
             im_coef = galsim.ImageViewD(np.ascontiguousarray(mapped_coefs[:, :, i_coefs+3]))
@@ -164,6 +172,37 @@ class OpticalPSFModel:
                          /self.lam + aberration_error)
         return np.array(coefs)
 
+    def get_zernike_coefficients_array(self, x, y):
+        """
+        Inputs
+        - x: ndarray, x positions on FOV [deg]
+        - y: ndarray, y positions on FOV [deg]
+
+        Outputs
+        - coefs: ndarray with shape (8, len(x)), Zernike coefficients at each (x, y) [wavelength].
+                 These are the same as the results of get_zernike_coefficients() for each
+                 position, but all positions are evaluated in one go with NumPy.
+        """
+        x = np.atleast_1d(np.asarray(x, dtype=float))
+        y = np.atleast_1d(np.asarray(y, dtype=float))
+        if np.any((x < self.xmin) | (x > self.xmax) | (y < self.ymin) | (y > self.ymax)):
+            import warnings
+            warnings.warn(
+                    "Warning: some positions are not within the bounds " +
+                    "of the gridded values.  Min, max x: (%f,%f) "%(self.xmin,self.xmax) +
+                    "and min, max y: (%f, %f) "%(self.ymin,self.ymax))
+
+        if self.coefficient_grid is None:
+            # A non-default interpolant was used, so fall back to the InterpolatedImage objects.
+            coefs = np.zeros((self.n_coefs, len(x)))
+            for i, (_x, _y) in enumerate(zip(x, y)):
+                for i_coef, interpolated_coefficient in enumerate(self.interpolated_coefficients):
+                    coefs[i_coef, i] = interpolated_coefficient.xValue(
+                        galsim.PositionD(_x/self.dx, _y/self.dy))
+        else:
+            coefs = interpolate_grid(self.coefficient_grid, x/self.dx, y/self.dy)
+        return coefs/self.lam + self.aberration_errors[:, np.newaxis]
+
     def get_psf(self, x, y, additional_coefs = None):
         """
         - x: x position on FOV [deg]
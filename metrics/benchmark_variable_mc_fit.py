@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+
+# Copyright (c) 2014, the GREAT3 executive committee (http://www.great3challenge.info/?q=contacts)
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification, are permitted
+# provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this list of conditions
+# and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice, this list of
+# conditions and the following disclaimer in the documentation and/or other materials provided with
+# the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors may be used to
+# endorse or promote products derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+# FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER
+"""@file benchmark_variable_mc_fit.py
+Benchmark the closed form, batched fit of the m, c model of variable shear submission biases used by
+evaluate.q_variable_by_mc() against the original per-submission scipy.optimize.leastsq fit.
+
+Simulated map_E submissions are made for NTEST random values of c and m, using smooth, synthetic
+reference and unit c aperture mass dispersions with the shape of the GREAT3 truth, and fitted with
+both methods.  The largest differences between the fitted values, in units of their uncertainties,
+are printed along with the time taken by each method.
+"""
+import os
+import sys
+import time
+import numpy as np
+import g3metrics
+path, module = os.path.split(__file__)
+sys.path.append(os.path.join(path, "..", "server", "great3")) # Appends the folder
+                                                              # great3-private/server/great3 to
+                                                              # sys.path
+import evaluate
+
+NTEST = 1000
+FRACTIONAL_ERROR = 0.05  # Fractional uncertainty on the reference map_E in each bin
+CMAX = 10. * evaluate.CFID
+MMAX = 10. * evaluate.MFID
+
+
+if __name__ == "__main__":
+
+    np.random.seed(12345)
+    theta = np.tile(evaluate.EXPECTED_THETA[:evaluate.NBINS_THETA], evaluate.NFIELDS)
+    # Power-law reference map_E, varying a little from field to field, and a unit c map_E that
+    # rises on large scales, roughly as for the GREAT3 truth
+    amplitude = np.repeat(
+        1. + 0.2 * np.random.randn(evaluate.NFIELDS), evaluate.NBINS_THETA)
+    map_E_ref = 1.e-5 * amplitude * (theta / evaluate.THETA_MIN_DEG)**-0.5
+    maperr_ref = FRACTIONAL_ERROR * map_E_ref
+    map_E_unitc = 1.e-1 * theta / evaluate.THETA_MAX_DEG
+    usebins = evaluate.USEBINS
+    # Build the submissions
+    ctrue = np.random.rand(NTEST) * CMAX
+    mtrue = (2. * np.random.rand(NTEST) - 1.) * MMAX
+    map_E_sub = (
+        map_E_unitc * ctrue[:, np.newaxis]**2 + map_E_ref * (1. + mtrue[:, np.newaxis])**2 +
+        maperr_ref * np.random.randn(NTEST, len(theta)))
+
+    print "Fitting "+str(NTEST)+" simulated submissions using scipy.optimize.leastsq..."
+    t0 = time.time()
+    nonlinear = np.array([
+        evaluate._fit_variable_mc_nonlinear(
+            map_E, map_E_ref, maperr_ref, map_E_unitc, usebins) for map_E in map_E_sub]).T
+    t_nonlinear = time.time() - t0
+    print "Fitting "+str(NTEST)+" simulated submissions in closed form..."
+    t0 = time.time()
+    linear = np.array(
+        evaluate._fit_variable_mc(map_E_sub, map_E_ref, maperr_ref, map_E_unitc, usebins))
+    t_linear = time.time() - t0
+
+    # Compare, noting that leastsq may return either sign of c.  Starting from c = 0, where the
+    # model has no gradient in c, leastsq sometimes stops short of the minimum chi^2, so compare
+    # the fitted values only where both methods reach the same chi^2
+    nonlinear[4] = np.sign(nonlinear[0]) * nonlinear[4]
+    nonlinear[0] = np.abs(nonlinear[0])
+    chi2 = {}
+    for name, fit in (("linear", linear), ("nonlinear", nonlinear)):
+
+        chi2[name] = np.array([
+            np.sum(evaluate.map_diff_func(
+                fit[:2, i], map_E[usebins], maperr_ref[usebins], map_E_ref[usebins],
+                map_E_unitc[usebins])**2) for i, map_E in enumerate(map_E_sub)])
+
+    same = np.abs(chi2["linear"] - chi2["nonlinear"]) <= 1.e-6 * chi2["nonlinear"]
+    same &= (linear[2] > 0.) & (nonlinear[2] > 0.)
+    nfallback = np.sum(~(
+        g3metrics.fittemplates_batch(
+            map_E_sub[:, usebins], map_E_unitc[usebins], map_E_ref[usebins],
+            sigma=maperr_ref[usebins])[0] > 0.))
+    print ""
+    print "Closed form fits using the leastsq fallback (c^2 <= 0) = %d / %d" % (nfallback, NTEST)
+    print "Fits reaching the same chi^2 = %d / %d" % (np.sum(same), NTEST)
+    print "Fits where leastsq stopped at a higher chi^2 = %d / %d" % (
+        np.sum(chi2["nonlinear"] - chi2["linear"] > 1.e-6 * chi2["nonlinear"]), NTEST)
+    print "Max (chi2_linear - chi2_leastsq) / chi2_leastsq = %.2e" % np.max(
+        (chi2["linear"] - chi2["nonlinear"]) / chi2["nonlinear"])
+    print "For the fits reaching the same chi^2:"
+    print "    Max |c_linear - c_leastsq| / sigc = %.2e" % np.max(
+        np.abs(linear[0] - nonlinear[0])[same] / nonlinear[2][same])
+    print "    Max |m_linear - m_leastsq| / sigm = %.2e" % np.max(
+        np.abs(linear[1] - nonlinear[1])[same] / nonlinear[3][same])
+    print "    Median |sigc_linear / sigc_leastsq - 1| = %.2e" % np.median(
+        np.abs(linear[2][same] / nonlinear[2][same] - 1.))
+    print "    Median |sigm_linear / sigm_leastsq - 1| = %.2e" % np.median(
+        np.abs(linear[3][same] / nonlinear[3][same] - 1.))
+    print ""
+    print "leastsq:     %.3f s (%.2e s per submission)" % (t_nonlinear, t_nonlinear / NTEST)
+    print "closed form: %.3f s (%.2e s per submission)" % (t_linear, t_linear / NTEST)
+    print "Speedup = %.1f" % (t_nonlinear / t_linear)
@@ -129,10 +129,14 @@ MFID = 2.e-3
 
 XMAX_GRID_DEG = 10.0 # Maximum image spatial extent in degrees
 DX_GRID_DEG = 0.1    # Grid spacing in degrees
+SUBFIELD_GRID_SUBSAMPLING = 7 # Subfield offsets within a field are multiples of DX_GRID_DEG / this
 
 THETA_MIN_DEG = 0.02 # Minimum and maximum angular scales for logarithmic bins used to calculate the
 THETA_MAX_DEG = 10.0 # aperture mass disp. - MUST match specs given to participants - in degrees
 NBINS_THETA = 15     # Number of logarithmic bins theta for the aperture mass dispersion
+BIN_SLOP = 0.1       # Default bin_slop for calculate_mapsq(), the in-process alternative to corr2
+MAX_GRID_SIZE = 2048 # Default maximum size of the FFT grids used by calculate_mapsq()
+MAX_PAIRS = 1000000  # Number of galaxy pairs compared at a time by calculate_mapsq()
 
 EXPECTED_THETA = np.array([ # Array of theta values expected in submissions, good to 3 d.p.
     0.0246,  0.0372,  0.0563,  0.0853,  0.1290,  0.1953,  0.2955, 0.4472,  0.6768,  1.0242,  1.5499,
@@ -173,6 +177,126 @@ SIGMA2_MIN_VARIABLE_GROUND = 9.e-8  # [2 * 1.e-3]**2
 SIGMA2_MIN_VARIABLE_SPACE = 4.e-8   # [3 * 1.e-3]**2
 
 
+def get_parameter_store(mapper):
+    """Return the great3sims.mapper.ParameterStore in the directory of `mapper`, or None if there
+    isn't one.
+
+    The truth tarballs written by great3sims.run() include a store for each branch.  For older
+    truth trees, one can be made from the YAML files with
+    great3sims.mapper.convertParameterTree(TRUTH_DIR).
+    """
+    if great3sims.mapper.ParameterStore.exists(mapper.full_dir):
+        return great3sims.mapper.ParameterStore(mapper.full_dir)
+    return None
+
+# The truth tables built by the get_generate_* functions are cached in storage_dir as .npz files,
+# alongside a key made from the content hashes of all the files they were built from and the
+# parameters of the build.  A table is rebuilt exactly when that key changes.  TRUTH_CACHE_VERSION
+# should be incremented whenever a change to this module changes the contents of the tables.
+TRUTH_CACHE_VERSION = 1
+INPUT_HASHES_FILE = "input_hashes.p" # Record in storage_dir of the content hashes of input files
+
+def get_input_hashes(paths, storage_dir=STORAGE_DIR):
+    """Return a list of the MD5 content hashes of the files in `paths`.
+
+    Hashing all the truth catalogs would take longer than loading a cached table, so the hashes are
+    recorded in the file INPUT_HASHES_FILE in `storage_dir`, together with the size and
+    modification time of each file.  A file is only read and hashed again if its size or
+    modification time has changed since then.
+
+    @param paths        List of file names
+    @param storage_dir  Directory in which the record of hashes is kept
+    @return A list of hex digests, in the same order as `paths`
+    """
+    import cPickle
+    import hashlib
+    index_file = os.path.join(storage_dir, INPUT_HASHES_FILE)
+    if os.path.isfile(index_file):
+        with open(index_file, "rb") as funit:
+            index = cPickle.load(funit)
+    else:
+        index = {}
+    hashes = []
+    changed = False
+    for path in paths:
+
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        signature = (stat.st_size, stat.st_mtime)
+        if path in index and index[path][0] == signature:
+            hashes.append(index[path][1])
+            continue
+        md5 = hashlib.md5()
+        with open(path, "rb") as funit:
+            for chunk in iter(lambda: funit.read(1 << 20), ""):
+                md5.update(chunk)
+        index[path] = (signature, md5.hexdigest())
+        hashes.append(index[path][1])
+        changed = True
+
+    if changed:
+        if not os.path.isdir(storage_dir):
+            os.mkdir(storage_dir)
+        # Write then rename, so that other processes never see a partly written record
+        with open(index_file+".tmp%d" % os.getpid(), "wb") as fout:
+            cPickle.dump(index, fout, protocol=2)
+        os.rename(index_file+".tmp%d" % os.getpid(), index_file)
+    return hashes
+
+def get_truth_cache_key(paths, parameters, storage_dir=STORAGE_DIR):
+    """Return the key under which a truth table built from the files in `paths` is cached.
+
+    @param paths        List of all the files the table is built from
+    @param parameters   Tuple of any other values on which the table depends, which must have a
+                        stable repr()
+    @param storage_dir  Directory in which the record of input file hashes is kept
+    @return A hex digest combining TRUTH_CACHE_VERSION, `parameters` and the file content hashes
+    """
+    import hashlib
+    md5 = hashlib.md5(repr((TRUTH_CACHE_VERSION, parameters)))
+    for path, file_hash in zip(paths, get_input_hashes(paths, storage_dir=storage_dir)):
+
+        md5.update(os.path.basename(path)+" "+file_hash+"\n")
+
+    return md5.hexdigest()
+
+def load_truth_cache(cachefile, key):
+    """Load a truth table cached by save_truth_cache(), if it exists and was saved with `key`.
+
+    @return The cached array, or None if there is no cached array for this key
+    """
+    if not os.path.isfile(cachefile):
+        return None
+    cache = np.load(cachefile)
+    try:
+        if str(cache["key"]) != key:
+            return None
+        return cache["data"]
+    finally:
+        cache.close()
+
+def save_truth_cache(cachefile, key, data):
+    """Save the array `data` to the .npz file `cachefile`, to be loaded again with
+    load_truth_cache() using the same `key`.
+    """
+    storage_dir = os.path.dirname(cachefile)
+    if storage_dir and not os.path.isdir(storage_dir):
+        os.mkdir(storage_dir)
+    with open(cachefile, "wb") as fout:
+        np.savez(fout, data=data, key=np.array(key))
+
+def _get_parameter_files(mapper, store, dataset, data_ids):
+    """Return the list of files from which the parameters `dataset` are read for each of the
+    `data_ids`: either the branch's ParameterStore or the individual YAML files.
+    """
+    if store is not None:
+        return [store.path + ".p"]
+    if dataset in great3sims.mapper.ParameterStore.templates:
+        template = great3sims.mapper.ParameterStore.templates[dataset]
+    else:
+        template, _, _ = mapper.mappings[dataset]
+    return [os.path.join(mapper.full_dir, template % data_id)+".yaml" for data_id in data_ids]
+
 def get_generate_const_truth(experiment, obs_type, truth_dir=TRUTH_DIR, storage_dir=STORAGE_DIR,
                              logger=None):
     """Get or generate arrays of subfield_index, g1true, g2true, each of length `NSUBFIELDS`.
@@ -180,8 +304,10 @@ def get_generate_const_truth(experiment, obs_type, truth_dir=TRUTH_DIR, storage_
     If the gtruth file has already been built for this constant shear branch, loads and returns the
     saved copies.
 
-    If the array of truth values has not been built, or is older than the first entry in the set of
-    shear_params files, the arrays are built first, saved to file, then returned.
+    If the array of truth values has not been built, or the contents of the shear_params files have
+    changed since it was (see get_truth_cache_key()), the arrays are built first, saved to file,
+    then returned.  If the truth directory for the branch has a great3sims.mapper.ParameterStore,
+    the shear_params are read from that rather than from the individual YAML files.
 
     @param experiment     Experiment for this branch, one of 'control', 'real_galaxy',
                           'variable_psf', 'multiepoch', 'full'
@@ -192,53 +318,50 @@ def get_generate_const_truth(experiment, obs_type, truth_dir=TRUTH_DIR, storage_
     @return subfield_index, g1true, g2true
     """
     gtruefile = os.path.join(storage_dir, GTRUTH_FILE_PREFIX+experiment[0]+obs_type[0]+"c.asc")
+    gtruecache = os.path.splitext(gtruefile)[0]+".npz"
     mapper = great3sims.mapper.Mapper(truth_dir, experiment, obs_type, "constant")
-    use_stored = True
-    if not os.path.isfile(gtruefile):
-        use_stored = False
+    store = get_parameter_store(mapper)
+    # Check to see if this is a variable_psf or full branch, in which case we only need the
+    # first entry from each set of subfields
+    if experiment in ("variable_psf", "full"):
+        subfield_index_targets = range(0, NSUBFIELDS, NSUBFIELDS_PER_FIELD)
+    else:
+        subfield_index_targets = range(NSUBFIELDS)
+    # Look for a cached table built from the current shear_params
+    key = get_truth_cache_key(
+        _get_parameter_files(
+            mapper, store, "shear_params",
+            [{"subfield_index": i} for i in subfield_index_targets]),
+        ("const_truth", experiment, obs_type, NSUBFIELDS, NFIELDS), storage_dir=storage_dir)
+    gtruedata = load_truth_cache(gtruecache, key)
+    if gtruedata is not None:
         if logger is not None:
-            logger.info(
-                "First build of shear truth tables using values from "+
-                os.path.join(mapper.full_dir, "shear_params-*.yaml"))
+            logger.info("Loading shear truth tables from "+gtruecache)
     else:
-        # Compare timestamps for the gtruefile and the first shear_params file
-        # (subfield = 000) for this branch.  If the former is older than the latter, or this file,
-        # force rebuild...
-        gtruemtime = os.path.getmtime(gtruefile)
-        shear_params_file = os.path.join(mapper.full_dir, "shear_params-000.yaml")
-        shear_params_mtime = os.path.getmtime(shear_params_file)
-        if gtruemtime < shear_params_mtime or gtruemtime < os.path.getmtime(__file__):
-            use_stored = False
-            if logger is not None:
+        if logger is not None:
+            if os.path.isfile(gtruecache):
                 logger.info(
-                    "Updating out-of-date shear truth tables using newer values from "+
+                    "Updating out-of-date shear truth tables using changed values from "+
+                    os.path.join(mapper.full_dir, "shear_params-*.yaml"))
+            else:
+                logger.info(
+                    "First build of shear truth tables using values from "+
                     os.path.join(mapper.full_dir, "shear_params-*.yaml"))
-    # Then load or build (and save) the array of truth values per subfield
-    if use_stored:
-        if logger is not None:
-            logger.info("Loading shear truth tables from "+gtruefile) 
-        gtruedata = np.loadtxt(gtruefile)
-    else: 
         params_prefix = os.path.join(mapper.full_dir, "shear_params-")
         import yaml
-        # Check to see if this is a variable_psf or full branch, in which case we only need the
-        # first entry from each set of subfields
-        if experiment in ("variable_psf", "full"):
-            gtruedata = np.empty((NFIELDS, 3))
-            gtruedata[:, 0] = np.arange(NFIELDS)
-            subfield_index_targets = range(0, NSUBFIELDS, NSUBFIELDS_PER_FIELD)
-        else:
-            gtruedata = np.empty((NSUBFIELDS, 3))
-            gtruedata[:, 0] = np.arange(NSUBFIELDS)
-            subfield_index_targets = range(NSUBFIELDS)
+        gtruedata = np.empty((len(subfield_index_targets), 3))
+        gtruedata[:, 0] = np.arange(len(subfield_index_targets))
         # Then loop over the required subfields reading in the shears
         for i, subfield_index in enumerate(subfield_index_targets):
 
-            params_file = params_prefix+("%03d" % subfield_index)+".yaml"
-            with open(params_file, "rb") as funit:
-                gdict = yaml.load(funit)
-                gtruedata[i, 1] = gdict["g1"]
-                gtruedata[i, 2] = gdict["g2"]
+            if store is not None:
+                gdict = store.read("shear_params", subfield_index=subfield_index)
+            else:
+                params_file = params_prefix+("%03d" % subfield_index)+".yaml"
+                with open(params_file, "rb") as funit:
+                    gdict = yaml.load(funit)
+            gtruedata[i, 1] = gdict["g1"]
+            gtruedata[i, 2] = gdict["g2"]
 
         if logger is not None:
             logger.info("Saving shear truth table to "+gtruefile)
@@ -248,6 +371,7 @@ def get_generate_const_truth(experiment, obs_type, truth_dir=TRUTH_DIR, storage_
             fout.write("# True shears for "+experiment+"-"+obs_type+"-constant\n")
             fout.write("# subfield_index  g1true  g2true\n")
             np.savetxt(fout, gtruedata, fmt=" %4d %+.18e %+.18e")
+        save_truth_cache(gtruecache, key, gtruedata)
     return (gtruedata[:, 0]).astype(int), gtruedata[:, 1], gtruedata[:, 2]
 
 def get_generate_const_rotations(experiment, obs_type, storage_dir=STORAGE_DIR, truth_dir=TRUTH_DIR,
@@ -258,8 +382,11 @@ def get_generate_const_rotations(experiment, obs_type, storage_dir=STORAGE_DIR,
     array of rotation angles to align with the PSF.  This array is of shape `(NSUBFIELDS,)`, having
     averaged over the `n_epochs` epochs in the case of multi-epoch branches.
 
-    If the rotation file has not been built, or is older than the first entry in the set of
-    starshape_parameters files, the array of rotations is built, saved to file, then returned.
+    If the rotation file has not been built, or the contents of the starshape_parameters files have
+    changed since it was (see get_truth_cache_key()), the array of rotations is built, saved to
+    file, then returned.  If the truth directory for the branch has a
+    great3sims.mapper.ParameterStore, the starshape_parameters are read from that rather than from
+    the individual YAML files.
 
     @param experiment     Experiment for this branch, one of 'control', 'real_galaxy',
                           'variable_psf', 'multiepoch', 'full'
@@ -271,42 +398,41 @@ def get_generate_const_rotations(experiment, obs_type, storage_dir=STORAGE_DIR,
     """
     import great3sims
     rotfile = os.path.join(storage_dir, ROTATIONS_FILE_PREFIX+experiment[0]+obs_type[0]+"c.asc")
+    rotcache = os.path.splitext(rotfile)[0]+".npz"
     mapper = great3sims.mapper.Mapper(truth_dir, experiment, obs_type, "constant")
-    use_stored = True
-    if not os.path.isfile(rotfile):
-        use_stored = False
+    store = get_parameter_store(mapper)
+    if store is not None:
+        read_parameters = store.read
+    else:
+        read_parameters = mapper.read
+    # Work out if the experiment is multi-exposure and has multiple epochs
+    if experiment in ("multiepoch", "full"):
+        import great3sims.constants
+        n_epochs = great3sims.constants.n_epochs
+    else:
+        n_epochs = 1
+    # Look for a cached array built from the current starshape_parameters
+    key = get_truth_cache_key(
+        _get_parameter_files(
+            mapper, store, "starshape_parameters",
+            [{"epoch_index": epoch_index, "subfield_index": subfield_index}
+             for subfield_index in range(NSUBFIELDS) for epoch_index in range(n_epochs)]),
+        ("const_rotations", experiment, obs_type, NSUBFIELDS, NFIELDS), storage_dir=storage_dir)
+    rotations = load_truth_cache(rotcache, key)
+    if rotations is not None:
         if logger is not None:
-            logger.info(
-                "First build of rotations file using starshape_parameters from "+
-                mapper.full_dir)
+            logger.info("Loading rotations from "+rotcache)
     else:
-        # Then compare timestamps for the rotation file and the first starshape_parameters file
-        # (subfield = 000, epoch =0) for this branch.  If the former is older than the latter, or
-        # this file, force rebuild...
-        rotmtime = os.path.getmtime(rotfile)
-        starshape_file_template, _ ,_ = mapper.mappings['starshape_parameters']  
-        starshape_file = os.path.join(
-            mapper.full_dir, starshape_file_template % {"epoch_index": 0, "subfield_index": 0})
-        starshapemtime = os.path.getmtime(starshape_file+".yaml")
-        if rotmtime < starshapemtime or rotmtime < os.path.getmtime(__file__):
-            use_stored = False
-            if logger is not None:
+        if logger is not None:
+            if os.path.isfile(rotcache):
                 logger.info(
-                    "Updating out-of-date rotations file using newer starshape_parameters from "+
+                    "Updating out-of-date rotations file using changed starshape_parameters from "+
+                    mapper.full_dir)
+            else:
+                logger.info(
+                    "First build of rotations file using starshape_parameters from "+
                     mapper.full_dir)
-    # Then load / build as required 
-    if use_stored is True:
-        if logger is not None:
-            logger.info("Loading rotations from "+rotfile) 
-        rotations = np.loadtxt(rotfile)[:, 1] # First column is just subfield indices
-    else:
         # To build we must loop over all the subfields and epochs
-        # First work out if the experiment is multi-exposure and has multiple epochs
-        if experiment in ("multiepoch", "full"):
-            import great3sims.constants
-            n_epochs = great3sims.constants.n_epochs
-        else:
-            n_epochs = 1
         # Setup the array for storing the PSF values from which rotations are calculated
         psf_g1 = np.empty((NSUBFIELDS, n_epochs))
         psf_g2 = np.empty((NSUBFIELDS, n_epochs))
@@ -317,7 +443,7 @@ def get_generate_const_rotations(experiment, obs_type, storage_dir=STORAGE_DIR,
             n_ignore = 0 # Counter for how many epochs had flagged, bad PSF g1/g2 values
             for epoch_index in range(n_epochs):
 
-                starshape_parameters = mapper.read(
+                starshape_parameters = read_parameters(
                     "starshape_parameters",
                     data_id={"epoch_index": epoch_index, "subfield_index": subfield_index})
                 star_g1 = starshape_parameters["psf_g1"]
@@ -368,8 +494,16 @@ def get_generate_const_rotations(experiment, obs_type, storage_dir=STORAGE_DIR,
             fout.write("# Rotations for "+experiment+"-"+obs_type+"-constant\n")
             fout.write("# subfield_index  rotation [radians]\n")
             np.savetxt(fout, np.array((np.arange(len(rotations)), rotations)).T, fmt=" %4d %+.18f")
+        save_truth_cache(rotcache, key, rotations)
     return rotations
 
+def get_variable_offsets_files(mapper, store):
+    """Return the list of files from which get_generate_variable_offsets() reads the subfield
+    offsets for the branch of `mapper`, given its ParameterStore `store` (or None).
+    """
+    return _get_parameter_files(
+        mapper, store, "subfield_offset", [{"subfield_index": i} for i in range(NSUBFIELDS)])
+
 def get_generate_variable_offsets(experiment, obs_type, storage_dir=STORAGE_DIR,
                                   truth_dir=TRUTH_DIR, logger=None):
     """Get or generate arrays of subfield_index, offset_deg_x, offset_deg_y, each of length
@@ -378,8 +512,11 @@ def get_generate_variable_offsets(experiment, obs_type, storage_dir=STORAGE_DIR,
     If the offsets file has already been built for this variable shear branch, loads and returns the
     saved arrays.
 
-    If the arrays of offset values have not been built, or are older than the first entry in the set
-    of subfield_offset files, the arrays are built first, saved to file, then returned.
+    If the arrays of offset values have not been built, or the contents of the subfield_offset files
+    have changed since they were (see get_truth_cache_key()), the arrays are built first, saved to
+    file, then returned.  If the truth directory for the branch has a
+    great3sims.mapper.ParameterStore, the subfield_offset values are read from that rather than
+    from the individual YAML files.
 
     @param experiment     Experiment for this branch, one of 'control', 'real_galaxy',
                           'variable_psf', 'multiepoch', 'full'
@@ -390,44 +527,41 @@ def get_generate_variable_offsets(experiment, obs_type, storage_dir=STORAGE_DIR,
     @return subfield_index, offset_deg_x, offset_deg_y
     """
     offsetfile = os.path.join(storage_dir, OFFSETS_FILE_PREFIX+experiment[0]+obs_type[0]+"v.asc") 
+    offsetcache = os.path.splitext(offsetfile)[0]+".npz"
     mapper = great3sims.mapper.Mapper(truth_dir, experiment, obs_type, "variable")
-    use_stored = True
-    if not os.path.isfile(offsetfile):
-        use_stored = False
+    store = get_parameter_store(mapper)
+    # Look for cached offsets built from the current subfield_offset files
+    key = get_truth_cache_key(
+        get_variable_offsets_files(mapper, store), ("variable_offsets", experiment, obs_type),
+        storage_dir=storage_dir)
+    offsets = load_truth_cache(offsetcache, key)
+    if offsets is not None:
         if logger is not None:
-            logger.info(
-                "First build of offsets file using subfield_offset files from "+
-                mapper.full_dir)
+            logger.info("Loading offsets from "+offsetcache)
     else:
-        # Then compare timestamps for the offsets file and the first file
-        # (subfield = 000) for this branch.  If the former is older than the latter, or
-        # this file, force rebuild...
-        offsetmtime = os.path.getmtime(offsetfile)
-        subfield_offset_file = os.path.join(mapper.full_dir, "subfield_offset-000.yaml")
-        subfield_offset_mtime = os.path.getmtime(subfield_offset_file)
-        if offsetmtime < subfield_offset_mtime or offsetmtime < os.path.getmtime(__file__):
-            use_stored = False 
-            if logger is not None:
+        if logger is not None:
+            if os.path.isfile(offsetcache):
                 logger.info(
-                    "Updating out-of-date offset file using newer values from "+
+                    "Updating out-of-date offset file using changed values from "+
                     os.path.join(mapper.full_dir, "subfield_offset-*.yaml"))
-    # Then load / build as required 
-    if use_stored is True:
-        if logger is not None:
-            logger.info("Loading offsets from "+offsetfile) 
-        offsets = np.loadtxt(offsetfile)
-    else:
+            else:
+                logger.info(
+                    "First build of offsets file using subfield_offset files from "+
+                    mapper.full_dir)
         offsets_prefix = os.path.join(mapper.full_dir, "subfield_offset-") 
         offsets = np.empty((NSUBFIELDS, 3))
         import yaml
         offsets[:, 0] = np.arange(NSUBFIELDS)
         for i in range(NSUBFIELDS):
 
-            offsets_file = offsets_prefix+("%03d" % i)+".yaml"
-            with open(offsets_file, "rb") as funit:
-                offsetdict = yaml.load(funit)
-                offsets[i, 1] = offsetdict["offset_deg_x"]
-                offsets[i, 2] = offsetdict["offset_deg_y"]
+            if store is not None:
+                offsetdict = store.read("subfield_offset", subfield_index=i)
+            else:
+                offsets_file = offsets_prefix+("%03d" % i)+".yaml"
+                with open(offsets_file, "rb") as funit:
+                    offsetdict = yaml.load(funit)
+            offsets[i, 1] = offsetdict["offset_deg_x"]
+            offsets[i, 2] = offsetdict["offset_deg_y"]
 
         if logger is not None:
             logger.info("Saving offset file to "+offsetfile)
@@ -437,6 +571,7 @@ def get_generate_variable_offsets(experiment, obs_type, storage_dir=STORAGE_DIR,
             fout.write("# Subfield offsets for "+experiment+"-"+obs_type+"-variable\n")
             fout.write("# subfield_index  offset_deg_x  offset_deg_y\n")
             np.savetxt(fout, offsets, fmt=" %4d %.18e %.18e")
+        save_truth_cache(offsetcache, key, offsets)
     return (offsets[:, 0]).astype(int), offsets[:, 1], offsets[:, 2]
 
 def run_corr2(x, y, e1, e2, w, min_sep=THETA_MIN_DEG, max_sep=THETA_MAX_DEG, nbins=NBINS_THETA,
@@ -444,7 +579,16 @@ def run_corr2(x, y, e1, e2, w, min_sep=THETA_MIN_DEG, max_sep=THETA_MAX_DEG, nbi
               m2_file_suffix='_temp.m2', xy_units='degrees', sep_units='degrees',
               corr2_executable='corr2'):
     """Copied from presubmission.py
+
+    `corr2_executable` is the path to Mike Jarvis' corr2 executable, which is run on a temporary
+    catalog.  If it is None, the aperture mass dispersion is instead calculated in this process by
+    calculate_mapsq() (with bin_slop = BIN_SLOP), with no external executable or temporary files.
+    Either way, the output is an array with the columns of the corr2 .m2 file.
     """
+    if corr2_executable is None:
+        return calculate_mapsq(
+            x, y, e1, e2, w, min_sep=min_sep, max_sep=max_sep, nbins=nbins, xy_units=xy_units,
+            sep_units=sep_units)
     import pyfits
     import subprocess
     import tempfile
@@ -526,17 +670,415 @@ def print_basic_corr2_params(outfile, min_sep=THETA_MIN_DEG, max_sep=THETA_MAX_D
         fout.write("verbose = 0\n")
         fout.write("\n")
 
+# Conversion factors from the units understood by corr2 into radians
+ANGLE_UNITS = {
+    "radians": 1., "degrees": np.pi / 180., "arcmin": np.pi / 180. / 60.,
+    "arcsec": np.pi / 180. / 3600.}
+
+def _get_angle_unit(units):
+    """Return the size in radians of the named angular `units`, allowing the same abbreviations as
+    corr2 (e.g. 'deg', 'arcmin', 'rad').
+    """
+    for name, value in ANGLE_UNITS.items():
+        if str(units).lower().startswith(name[:3]):
+            return value
+    raise ValueError("Angular units '"+str(units)+"' not recognised.")
+
+def _correlate_pairs(x, y, w, gc, min_sep, bin_size, nbins, max_pairs=MAX_PAIRS):
+    """Accumulate the shear-shear correlation sums exactly, pair by pair, for all pairs of points
+    with separations in the first `nbins` logarithmic bins of width `bin_size` above `min_sep`.
+
+    The points are sorted into square cells half as large as the largest separation, so that only
+    the pairs of points in cells at most two apart need to be compared.  The occupied cells are
+    found by binary search in the sorted list of their ids, so the memory used does not depend on
+    the area covered, and the pairs are compared in batches of about `max_pairs` at a time.
+
+    @return npairs, xip, xim  Arrays over the bins of the sum of the weights of all pairs, and of
+                              the (complex) weighted sums of g_a g_b^* and of
+                              g_a g_b exp(-4 i phi_ab) over pairs.
+    """
+    r_max = min_sep * np.exp(nbins * bin_size)
+    ix = ((x - x.min()) / (0.5 * r_max)).astype(int)
+    iy = ((y - y.min()) / (0.5 * r_max)).astype(int)
+    nx = ix.max() + 1
+    ny = iy.max() + 1
+    cell = iy * nx + ix
+    order = np.argsort(cell, kind="mergesort")
+    x = x[order]
+    y = y[order]
+    wg = (w * gc)[order]
+    w = w[order]
+    cells, first = np.unique(cell[order], return_index=True)
+    count = np.diff(np.append(first, len(x)))
+    cx = cells % nx
+    cy = cells // nx
+    npairs = np.zeros(nbins)
+    xip = np.zeros(nbins, dtype=complex)
+    xim = np.zeros(nbins, dtype=complex)
+    # Each pair of cells is visited once: a cell with itself, and with the half of the cells up to
+    # two away from it that come after it
+    for dx, dy in [(dx, dy) for dy in range(3) for dx in range(-2, 3) if dy > 0 or dx >= 0]:
+
+        bx = cx + dx
+        by = cy + dy
+        target = by * nx + bx
+        ib = np.minimum(np.searchsorted(cells, target), len(cells) - 1)
+        ia = np.nonzero((bx >= 0) & (bx < nx) & (by < ny) & (cells[ib] == target))[0]
+        ib = ib[ia]
+        ncell_pairs = count[ia] * count[ib]
+        ends = np.cumsum(ncell_pairs)
+        start = 0
+        while start < len(ia):
+
+            # The pairs of cells start:stop have about max_pairs pairs of points between them
+            stop = max(start + 1, np.searchsorted(
+                ends, ends[start] - ncell_pairs[start] + max_pairs, side="right"))
+            na = count[ia[start:stop]]
+            nb = count[ib[start:stop]]
+            n = na * nb
+            # List every pair of points a, b in each pair of cells
+            rep = np.repeat(np.arange(stop - start), n)
+            t = np.arange(n.sum()) - np.repeat(np.cumsum(n) - n, n)
+            a = first[ia[start:stop]][rep] + t // nb[rep]
+            b = first[ib[start:stop]][rep] + t % nb[rep]
+            start = stop
+            if dx == 0 and dy == 0:
+                keep = a < b
+                a = a[keep]
+                b = b[keep]
+            sx = x[b] - x[a]
+            sy = y[b] - y[a]
+            rsq = sx * sx + sy * sy
+            inbin = np.nonzero((rsq >= min_sep**2) & (rsq < r_max**2))[0]
+            if len(inbin) == 0:
+                continue
+            a = a[inbin]
+            b = b[inbin]
+            rc = sx[inbin] - sy[inbin] * 1j
+            rsq = rsq[inbin]
+            kbin = np.clip((np.log(np.sqrt(rsq) / min_sep) / bin_size).astype(int), 0, nbins - 1)
+            npairs += np.bincount(kbin, weights=w[a] * w[b], minlength=nbins)
+            xipd = wg[a] * wg[b].conj()
+            # exp(-4 i phi) for the separation vector of the pair
+            ximd = wg[a] * wg[b] * (rc * rc / rsq)**2
+            xip += (np.bincount(kbin, weights=xipd.real, minlength=nbins) +
+                    np.bincount(kbin, weights=xipd.imag, minlength=nbins) * 1j)
+            xim += (np.bincount(kbin, weights=ximd.real, minlength=nbins) +
+                    np.bincount(kbin, weights=ximd.imag, minlength=nbins) * 1j)
+    return npairs, xip, xim
+
+def _correlate_grid(ix, iy, w, gc, spacing, r_min, r_max, min_sep, bin_size, nbins,
+                    offsets=None):
+    """Accumulate the shear-shear correlation sums for the pairs of points placed in the cells
+    (ix, iy) of a square grid of the given `spacing`, for the separations in [r_min, r_max).  The
+    bins are the `nbins` logarithmic bins of width `bin_size` above `min_sep`, and [r_min, r_max)
+    must be the edges of some of them.
+
+    The sums for every offset between cells are found at once as FFT cross-correlations of a
+    zero-padded copy of the grid, in O(N log N) time.  The FFTs leave round-off of order 1e-14 at
+    offsets with no pairs, which would make empty bins look occupied, so the pairs at each offset
+    are also counted exactly (by rounding the correlation of the number of points in each cell,
+    which is a small integer) and the offsets with none are left out.
+
+    If the points are at the centres of their cells (`offsets` is None), the pairs at each offset
+    are binned by the separation of the cell centres, which is exact.  Otherwise `offsets` gives
+    the position of each point relative to the centre of its cell, x + i y in units of the cell
+    size, and the pairs at each offset are binned by their mean separation, which is found by
+    correlating the grid of the weighted offsets in the same way.
+
+    @return npairs, xip, xim  Arrays over the bins, as returned by _correlate_pairs().
+    """
+    # Pad the grid enough that separations up to r_max do not wrap around, allowing for the points
+    # to be anywhere in their cells
+    dmax = int(np.ceil(r_max / spacing)) + 1
+    nx = ix.max() + 1
+    ny = iy.max() + 1
+    shape = (ny + min(ny, dmax + 1), nx + min(nx, dmax + 1))
+    index = iy * shape[1] + ix
+    size = shape[0] * shape[1]
+    # Correlations sum_x A^*(x) B(x + d) for every offset d, binning each as soon as it is found
+    # to keep as few grids in memory at a time as possible
+    fo = np.fft.fft2(np.bincount(index, minlength=size).astype(float).reshape(shape))
+    occupied = np.rint(np.fft.ifft2(fo.conj() * fo).real) > 0.
+    del fo
+    fw = np.fft.fft2(np.bincount(index, weights=w, minlength=size).reshape(shape))
+    npairs_d = np.fft.ifft2(fw.conj() * fw).real
+    # Offsets between cells of each element of the correlation arrays
+    dx = np.arange(shape[1])
+    dx[dx > shape[1] / 2] -= shape[1]
+    dy = np.arange(shape[0])
+    dy[dy > shape[0] / 2] -= shape[0]
+    dc = dx[np.newaxis, :] + dy[:, np.newaxis] * 1j
+    if offsets is not None:
+        # The sum of w_a w_b (offset_b - offset_a) over the pairs at offset d is c(d) - c(-d), where
+        # c is the correlation of the weights with the weighted offsets
+        fo = np.fft.fft2(
+            (np.bincount(index, weights=w * offsets.real, minlength=size) +
+             np.bincount(index, weights=w * offsets.imag, minlength=size) * 1j).reshape(shape))
+        c = np.fft.ifft2(fw.conj() * fo)
+        del fo
+        c -= np.roll(np.roll(c[::-1, ::-1], 1, axis=0), 1, axis=1)
+        dc[occupied] += c[occupied] / npairs_d[occupied]
+        del c
+    del fw
+    rd = np.abs(dc) * spacing
+    # Bin them, ignoring zero separation and offsets with no pairs
+    use = (rd >= r_min) & (rd < r_max) & occupied
+    kmin = int(np.round(np.log(r_min / min_sep) / bin_size))
+    kmax = int(np.round(np.log(r_max / min_sep) / bin_size)) - 1
+    kbin = (np.log(rd[use] / min_sep) / bin_size).astype(int)
+    kbin = np.clip(kbin, kmin, kmax)
+    expm4iphi = (dc[use].conj() / np.abs(dc[use]))**4
+    del rd, dc, occupied
+    # Every pair appears twice, once for each sign of the separation
+    npairs = 0.5 * np.bincount(kbin, weights=npairs_d[use], minlength=nbins)
+    del npairs_d
+    fg = np.fft.fft2(
+        (np.bincount(index, weights=(w * gc).real, minlength=size) +
+         np.bincount(index, weights=(w * gc).imag, minlength=size) * 1j).reshape(shape))
+    xip_d = np.fft.ifft2(fg.conj() * fg)[use].conj()
+    xip = 0.5 * (np.bincount(kbin, weights=xip_d.real, minlength=nbins) +
+                 np.bincount(kbin, weights=xip_d.imag, minlength=nbins) * 1j)
+    del xip_d
+    # The transform of the conjugate of the grid, from that of the grid
+    fgconj = np.roll(np.roll(fg[::-1, ::-1], 1, axis=0), 1, axis=1).conj()
+    ximd = np.fft.ifft2(fgconj.conj() * fg)[use] * expm4iphi
+    xim = 0.5 * (np.bincount(kbin, weights=ximd.real, minlength=nbins) +
+                 np.bincount(kbin, weights=ximd.imag, minlength=nbins) * 1j)
+    return npairs, xip, xim
+
+def calculate_mapsq(x, y, e1, e2, w, min_sep=THETA_MIN_DEG, max_sep=THETA_MAX_DEG,
+                    nbins=NBINS_THETA, xy_units='degrees', sep_units='degrees',
+                    bin_slop=BIN_SLOP, max_grid_size=MAX_GRID_SIZE):
+    """Calculate the aperture mass dispersion for a shear catalog directly from NumPy arrays,
+    without calling corr2.
+
+    The shear two-point correlation functions xi+ and xi- are estimated in `nbins` logarithmic
+    bins between `min_sep` and `max_sep`, and are then integrated with the Crittenden et al. (2002)
+    aperture mass filter used by corr2.  Galaxies with e1 or e2 >= 10 are ignored, as in
+    run_corr2().
+
+    The larger separations are found by placing the galaxies on a grid and correlating it using
+    FFTs, binning all the pairs at each offset between grid cells by their mean separation (found
+    by also correlating the positions of the galaxies within their cells).  The grid is
+    as fine as `max_grid_size` allows, and is used for the bins whose width is at least
+    sqrt(2) / `bin_slop` times the grid spacing, so that no separation is misplaced by more than
+    `bin_slop` times the bin width (cf. the `bin_slop` parameter of corr2).  The smaller
+    separations, for which the grid would have to be too fine, are binned exactly by comparing all
+    the pairs of nearby galaxies.
+
+    @param x              Array of galaxy x positions
+    @param y              Array of galaxy y positions
+    @param e1             Array of galaxy g1 values
+    @param e2             Array of galaxy g2 values
+    @param w              Array of galaxy weights
+    @param min_sep        Minimum separation for the correlation function bins
+    @param max_sep        Maximum separation for the correlation function bins
+    @param nbins          Number of logarithmic separation bins
+    @param xy_units       Units of x and y, e.g. 'degrees'
+    @param sep_units      Units of min_sep, max_sep and of the output separations, e.g. 'degrees'
+    @param bin_slop       Tolerance on the size of the grid cells used to bin pairs, relative to the
+                          bin width.  The default of corr2 is 1, but that lets pairs near the bin
+                          edges fall into the neighbouring bins, which biases <Map^2> for shear
+                          fields with a steep power spectrum [default = BIN_SLOP]
+    @param max_grid_size  Maximum number of cells along each side of the (padded) grids used for
+                          the FFTs, which sets the memory used [default = MAX_GRID_SIZE]
+    @return An array of shape (nbins, 8) with the same columns as the corr2 .m2 output file:
+            R, <Map^2>, <Mx^2>, <MMx>(real), <MMx>(imag), sig_map, <Gam^2>, sig_gam
+    """
+    x_array = np.asarray(x, dtype=float).flatten()
+    y_array = np.asarray(y, dtype=float).flatten()
+    g1_array = np.asarray(e1, dtype=float).flatten()
+    g2_array = np.asarray(e2, dtype=float).flatten()
+    w_array = np.asarray(w, dtype=float).flatten()
+    # Mask out the >= 10 values, and work in sep_units throughout
+    use_mask = np.logical_and.reduce([g1_array<10.,g2_array<10.])
+    xy_scale = _get_angle_unit(xy_units) / _get_angle_unit(sep_units)
+    x_array = x_array[use_mask] * xy_scale
+    y_array = y_array[use_mask] * xy_scale
+    gc = g1_array[use_mask] + g2_array[use_mask] * 1j
+    w_array = w_array[use_mask]
+    # Bin edges and (logarithmic) bin centres
+    bin_size = np.log(float(max_sep) / float(min_sep)) / nbins
+    r_edges = min_sep * np.exp(np.arange(nbins + 1) * bin_size)
+    r = min_sep * np.exp((np.arange(nbins) + 0.5) * bin_size)
+    npairs = np.zeros(nbins)
+    xip = np.zeros(nbins, dtype=complex)
+    xim = np.zeros(nbins, dtype=complex)
+    # Largest grid spacing that can be used for each bin
+    max_spacing = bin_slop * bin_size * r_edges[:-1] / np.sqrt(2.)
+    extent = max(x_array.max() - x_array.min(), y_array.max() - y_array.min(), min_sep)
+    k = nbins - 1
+    while k >= 0:
+
+        # The finest grid that fits in max_grid_size cells, padded for separations up to the top of
+        # bin k, and the bins kmin to k that it can be used for.  Stop, and compare pairs of
+        # galaxies for the rest of the bins, if the grid would be too coarse for bin k, or if there
+        # are few enough pairs to compare: those in the same or adjacent cells of _correlate_pairs()
+        # (each pair taking about 1/8 of the time per grid cell)
+        spacing = (extent + min(extent, r_edges[k + 1])) / (max_grid_size - 4)
+        npairs_compared = min(4.5 * r_edges[k + 1]**2 / extent**2, 0.5) * len(x_array)**2
+        if spacing > max_spacing[k] or npairs_compared < 8. * max_grid_size**2:
+            break
+        kmin = np.searchsorted(max_spacing, spacing)
+        xl = (x_array - x_array.min()) / spacing
+        yl = (y_array - y_array.min()) / spacing
+        ix = xl.astype(int)
+        iy = yl.astype(int)
+        npairs_k, xip_k, xim_k = _correlate_grid(
+            ix, iy, w_array, gc, spacing, r_edges[kmin], r_edges[k + 1], min_sep, bin_size, nbins,
+            offsets=(xl - ix - 0.5) + (yl - iy - 0.5) * 1j)
+        npairs += npairs_k
+        xip += xip_k
+        xim += xim_k
+        k = kmin - 1
+
+    if k >= 0:
+        npairs[:k + 1], xip[:k + 1], xim[:k + 1] = _correlate_pairs(
+            x_array, y_array, w_array, gc, min_sep, bin_size, k + 1)
+    return _calculate_mapsq_from_xi(r, bin_size, npairs, xip, xim, w_array, gc)
+
+def _calculate_mapsq_from_xi(r, bin_size, npairs, xip, xim, w, gc):
+    """Integrate binned shear correlation sums to get the aperture mass and top-hat shear
+    dispersions, as output by corr2.
+
+    @param r         Array of logarithmic bin centres
+    @param bin_size  Logarithmic width of the bins
+    @param npairs    Array of the sum of pair weights in each bin (counting each pair once)
+    @param xip       Complex array of the weighted sum of g_a g_b^* in each bin
+    @param xim       Complex array of the weighted sum of g_a g_b exp(-4 i phi_ab) in each bin
+    @param w         Array of galaxy weights
+    @param gc        Complex array of galaxy shears g1 + i g2
+    @return An array of shape (nbins, 8) with the same columns as the corr2 .m2 output file
+    """
+    nbins = len(r)
+    nonzero = npairs > 0.
+    xip = xip.copy()
+    xim = xim.copy()
+    xip[nonzero] /= npairs[nonzero]
+    xim[nonzero] /= npairs[nonzero]
+    # Shape noise variance of xi+/- per bin, as estimated by corr2
+    varg = np.sum(w**2 * (gc * gc.conj()).real) / (2. * np.sum(w))
+    varxi = np.zeros(nbins)
+    varxi[nonzero] = 2. * varg**2 / npairs[nonzero]
+    # Aperture mass filters evaluated at s = r / R, including the r^2 / R^2 factor from the integral
+    # over d ln(r)
+    s = np.outer(1. / r, r)
+    ssq = s * s
+    exp_factor = np.exp(-ssq / 4.)
+    tp = (32. + ssq * (-16. + ssq)) / 128. * exp_factor * ssq
+    tm = ssq * ssq / 128. * exp_factor * ssq
+    mapsq = (np.dot(tp, xip.real) + np.dot(tm, xim.real)) * 0.5 * bin_size
+    mxsq = (np.dot(tp, xip.real) - np.dot(tm, xim.real)) * 0.5 * bin_size
+    mmx_re = (np.dot(tp, xip.imag) + np.dot(tm, xim.imag)) * 0.5 * bin_size
+    mmx_im = (np.dot(tp, xip.imag) - np.dot(tm, xim.imag)) * 0.5 * bin_size
+    varmapsq = (np.dot(tp**2, varxi) + np.dot(tm**2, varxi)) * 0.25 * bin_size**2
+    # Top-hat shear dispersion
+    sp = np.zeros_like(s)
+    inside = s < 2.
+    sp[inside] = ssq[inside] / np.pi * (
+        4. * np.arccos(s[inside] / 2.) - s[inside] * np.sqrt(4. - ssq[inside]))
+    gamsq = np.dot(sp, xip.real) * bin_size
+    vargamsq = np.dot(sp**2, varxi) * bin_size**2
+    return np.array(
+        (r, mapsq, mxsq, mmx_re, mmx_im, np.sqrt(varmapsq), gamsq, np.sqrt(vargamsq))).T
+
+def calculate_mapsq_lattice(x, y, e1, e2, w, lattice_spacing, min_sep=THETA_MIN_DEG,
+                            max_sep=THETA_MAX_DEG, nbins=NBINS_THETA, xy_units='degrees',
+                            sep_units='degrees', cross_check=False, cross_check_tol=1.,
+                            cross_check_bin_slop=0.5):
+    """Calculate the aperture mass dispersion for a shear catalog whose positions all lie on a
+    regular square lattice, using FFTs.
+
+    The weights and shears are placed on a zero-padded copy of the lattice, and the shear
+    correlation sums for every lattice separation are then found at once as FFT cross-correlations,
+    in O(N log N) time.  Since the separations of all pairs are known exactly, they are binned
+    exactly (as for corr2 with bin_slop = 0), after which the same filters as calculate_mapsq() are
+    applied.  This suits the variable shear fields, whose galaxies all lie on the grid of spacing
+    DX_GRID_DEG / SUBFIELD_GRID_SUBSAMPLING given by the subfield offsets.  Galaxies with e1 or
+    e2 >= 10 are ignored, as in run_corr2().
+
+    @param x                Array of galaxy x positions
+    @param y                Array of galaxy y positions
+    @param e1               Array of galaxy g1 values
+    @param e2               Array of galaxy g2 values
+    @param w                Array of galaxy weights
+    @param lattice_spacing  Spacing of the lattice, in xy_units
+    @param min_sep          Minimum separation for the correlation function bins
+    @param max_sep          Maximum separation for the correlation function bins
+    @param nbins            Number of logarithmic separation bins
+    @param xy_units         Units of x, y and lattice_spacing, e.g. 'degrees'
+    @param sep_units        Units of min_sep, max_sep and of the output separations, e.g. 'degrees'
+    @param cross_check      If `True`, also run calculate_mapsq() on the same catalog and raise a
+                            RuntimeError if <Map^2> or <Mx^2> differ in any bin by more than
+                            `cross_check_tol` times sig_map [default = `False`]
+    @param cross_check_tol  Tolerance for the cross check, in units of sig_map.  Some difference
+                            is expected, since calculate_mapsq() only bins pairs approximately
+                            [default = 1.]
+    @param cross_check_bin_slop  The bin_slop to use in calculate_mapsq() for the cross check
+                            [default = 0.5]
+    @return An array of shape (nbins, 8) with the same columns as the corr2 .m2 output file:
+            R, <Map^2>, <Mx^2>, <MMx>(real), <MMx>(imag), sig_map, <Gam^2>, sig_gam
+    """
+    x_array = np.asarray(x, dtype=float).flatten()
+    y_array = np.asarray(y, dtype=float).flatten()
+    g1_array = np.asarray(e1, dtype=float).flatten()
+    g2_array = np.asarray(e2, dtype=float).flatten()
+    w_array = np.asarray(w, dtype=float).flatten()
+    use_mask = np.logical_and.reduce([g1_array<10.,g2_array<10.])
+    gc = g1_array[use_mask] + g2_array[use_mask] * 1j
+    w_use = w_array[use_mask]
+    # Find the lattice position of each galaxy, checking that it really is on the lattice
+    xl = (x_array[use_mask] - x_array[use_mask].min()) / lattice_spacing
+    yl = (y_array[use_mask] - y_array[use_mask].min()) / lattice_spacing
+    ix = np.round(xl).astype(int)
+    iy = np.round(yl).astype(int)
+    if np.any(np.abs(xl - ix) > 1.e-3) or np.any(np.abs(yl - iy) > 1.e-3):
+        raise ValueError(
+            "Input positions do not lie on a lattice of spacing "+str(lattice_spacing)+" "+
+            str(xy_units)+".")
+    nx = ix.max() + 1
+    ny = iy.max() + 1
+    if np.bincount(iy * nx + ix).max() > 1:
+        raise ValueError("More than one input position lies on the same lattice point.")
+    spacing = lattice_spacing * _get_angle_unit(xy_units) / _get_angle_unit(sep_units)
+    bin_size = np.log(float(max_sep) / float(min_sep)) / nbins
+    r = min_sep * np.exp((np.arange(nbins) + 0.5) * bin_size)
+    npairs, xip, xim = _correlate_grid(
+        ix, iy, w_use, gc, spacing, min_sep, max_sep, min_sep, bin_size, nbins)
+    results = _calculate_mapsq_from_xi(r, bin_size, npairs, xip, xim, w_use, gc)
+    if cross_check:
+        check = calculate_mapsq(
+            x, y, e1, e2, w, min_sep=min_sep, max_sep=max_sep, nbins=nbins, xy_units=xy_units,
+            sep_units=sep_units, bin_slop=cross_check_bin_slop)
+        diff = np.abs(results[:, 1:3] - check[:, 1:3]) / results[:, 5:6]
+        if np.any(diff > cross_check_tol):
+            raise RuntimeError(
+                "Lattice FFT and pair count aperture mass dispersions differ by up to "+
+                str(diff.max())+" sigma (tolerance "+str(cross_check_tol)+").")
+    return results
+
+def _calculate_mapsq_star(args):
+    """Call one of the functions for calculating the aperture mass dispersion, given a single tuple
+    of (function, args, kwargs), for use with multiprocessing.Pool.map().
+    """
+    func, func_args, func_kwargs = args
+    return func(*func_args, **func_kwargs)
+
 def get_generate_variable_truth(experiment, obs_type, storage_dir=STORAGE_DIR, truth_dir=TRUTH_DIR,
                                 logger=None, corr2_exec="corr2", make_plots=False,
                                 file_prefixes=("galaxy_catalog",), suffixes=("",),
-                                mape_file_prefix=MAPESHEAR_FILE_PREFIX, output_xy_prefix=None):
+                                mape_file_prefix=MAPESHEAR_FILE_PREFIX, output_xy_prefix=None,
+                                nproc=1, use_lattice=False, cross_check=False):
     """Get or generate an array of truth map_E vectors for all the fields in this branch.
 
     If the map_E truth file has already been built for this variable shear branch, loads and returns
     the saved copies.
 
-    If the array of truth values has not been built, or is older than the first entry in the set of
-    galaxy_catalog files, the arrays are built first, saved to file, then returned.
+    If the array of truth values has not been built, or the contents of the catalog files (or of the
+    subfield offsets) have changed since it was, or it was built with a different method of
+    calculating map_E (see get_truth_cache_key()), the arrays are built first, saved to file, then
+    returned.
 
     @param experiment        Experiment for this branch, one of 'control', 'real_galaxy',
                              'variable_psf', 'multiepoch', 'full'
@@ -544,7 +1086,8 @@ def get_generate_variable_truth(experiment, obs_type, storage_dir=STORAGE_DIR, t
     @param storage_dir       Directory from/into which to load/store rotation files
     @param truth_dir         Root directory in which the truth info for the challenge is stored
     @param logger            Python logging.Logger instance, for message logging
-    @param corr2_exec        Path to Mike Jarvis' corr2 exectuable
+    @param corr2_exec        Path to Mike Jarvis' corr2 exectuable, or None to calculate map_E
+                             in this process with calculate_mapsq() [default = `"corr2"`]
     @param make_plots        Generate plotting output
     @param file_prefixes     Tuple containing one or more prefixes for file type in which to load
                              up shears, summing shears when `len(file_prefixes) >= 2`
@@ -555,6 +1098,14 @@ def get_generate_variable_truth(experiment, obs_type, storage_dir=STORAGE_DIR, t
                              `file_prefixes` tuple [default = `("",)`]
     @param mape_file_prefix  Prefix for output filename
     @param output_xy_prefix  Filename prefix (and switch if not None) for x-y position debug output
+    @param nproc             Number of processes over which to spread the map_E calculation for
+                             the different fields; if <= 0, use the number of CPUs [default = 1]
+    @param use_lattice       Use the FFT calculation of calculate_mapsq_lattice(), which relies on
+                             the galaxies in each field lying on a regular lattice, rather than
+                             corr2 or counting pairs (corr2_exec is then ignored)
+                             [default = `False`]
+    @param cross_check       If using the lattice calculation, check it against the pair count
+                             calculation (see calculate_mapsq_lattice()) [default = `False`]
     @return field, theta, map_E, map_B, maperr
     """
     # Sanity check on suffixes & prefixes
@@ -570,43 +1121,46 @@ def get_generate_variable_truth(experiment, obs_type, storage_dir=STORAGE_DIR, t
         raise ValueError(
             "Dimensions of xgrid_deg and ygrid_deg do not match NGALS_PER_SUBFIELD.  Please check "+
             "the values of XMAX_GRID_DEG and DX_GRID_DEG in evaluate.py.")
-    # Define storage file and check for its existence and/or age
+    # Define storage file and look for a cached table built from the current catalogs and offsets
     mapEtruefile = os.path.join(
         storage_dir, mape_file_prefix+experiment[0]+obs_type[0]+"v.asc")
+    mapEtruecache = os.path.splitext(mapEtruefile)[0]+".npz"
     mapper = great3sims.mapper.Mapper(truth_dir, experiment, obs_type, "variable") 
-    use_stored = True
-    if not os.path.isfile(mapEtruefile):
-        use_stored = False
-        if logger is not None:
-            logger.info(
-                "First build of map_E truth file using "+str(file_prefixes)+" files from "+
-                mapper.full_dir)
+    input_files = get_variable_offsets_files(mapper, get_parameter_store(mapper))
+    for prefix in file_prefixes:
+
+        input_files += [
+            os.path.join(mapper.full_dir, (prefix+"-%03d.fits" % i)) for i in range(NSUBFIELDS)]
+
+    if use_lattice:
+        method = "lattice"
+    elif corr2_exec is not None:
+        method = corr2_exec
     else:
-        # Then compare timestamps for the mapE file and the newest file_prefixes[:]-000.fits file
-        # (subfield = 000) for this branch.  If the former is older than the latter, or
-        # this file, force rebuild...
-        mapEmtime = os.path.getmtime(mapEtruefile)
-        catalogmtime = 0 # Set earliest possible T
-        for prefix in file_prefixes:
-
-            catalog_file = os.path.join(mapper.full_dir, prefix+"-000.fits")
-            tmpmtime = os.path.getmtime(catalog_file)
-            if tmpmtime > catalogmtime: catalogmtime = tmpmtime
-
-        if mapEmtime < catalogmtime or mapEmtime < os.path.getmtime(__file__):
-            use_stored = False
-            if logger is not None:
-                logger.info(
-                    "Updating out-of-date map_E file using newer "+str(file_prefixes)+" files "+
-                    "from "+mapper.full_dir)
-    # Then load / build as required 
-    if use_stored is True:
+        method = "pairs_bin_slop%g_grid%d" % (BIN_SLOP, MAX_GRID_SIZE)
+    key = get_truth_cache_key(
+        input_files,
+        ("variable_truth", experiment, obs_type, tuple(file_prefixes), tuple(suffixes), method,
+         THETA_MIN_DEG, THETA_MAX_DEG, NBINS_THETA, XMAX_GRID_DEG, DX_GRID_DEG, NSUBFIELDS,
+         NFIELDS),
+        storage_dir=storage_dir)
+    data = load_truth_cache(mapEtruecache, key)
+    use_stored = data is not None
+    if use_stored:
         if logger is not None:
-            logger.info("Loading truth map_E from "+mapEtruefile)
-        data = np.loadtxt(mapEtruefile)
+            logger.info("Loading truth map_E from "+mapEtruecache)
         field, theta, map_E, map_B, maperr = (
             data[:, 0].astype(int), data[:, 1], data[:, 2], data[:, 3], data[:, 4])
     else:
+        if logger is not None:
+            if os.path.isfile(mapEtruecache):
+                logger.info(
+                    "Updating out-of-date map_E file using changed "+str(file_prefixes)+" files "+
+                    "from "+mapper.full_dir)
+            else:
+                logger.info(
+                    "First build of map_E truth file using "+str(file_prefixes)+" files from "+
+                    mapper.full_dir)
         # Define the field array, then theta and map arrays in which we'll store the results
         field = np.arange(NBINS_THETA * NFIELDS) / NBINS_THETA
         theta = np.empty(NBINS_THETA * NFIELDS)
@@ -619,6 +1173,23 @@ def get_generate_variable_truth(experiment, obs_type, storage_dir=STORAGE_DIR, t
         # Setup some storage arrays into which we'll write
         xfield = np.empty((NGALS_PER_SUBFIELD, NSUBFIELDS_PER_FIELD)) 
         yfield = np.empty((NGALS_PER_SUBFIELD, NSUBFIELDS_PER_FIELD)) 
+        # Choose how to calculate map_E, and store the (function, args, kwargs) for each field so
+        # that the fields can be done in parallel
+        if use_lattice:
+            mapsq_func = calculate_mapsq_lattice
+            mapsq_kwargs = {
+                "lattice_spacing": DX_GRID_DEG / SUBFIELD_GRID_SUBSAMPLING,
+                "cross_check": cross_check}
+        elif corr2_exec is not None:
+            mapsq_func = run_corr2
+            mapsq_kwargs = {"corr2_executable": corr2_exec}
+        else:
+            mapsq_func = calculate_mapsq
+            mapsq_kwargs = {}
+        mapsq_kwargs.update({
+            "min_sep": THETA_MIN_DEG, "max_sep": THETA_MAX_DEG, "nbins": NBINS_THETA,
+            "xy_units": "degrees", "sep_units": "degrees"})
+        mapsq_tasks = []
         # Loop over fields
         import pyfits
         for ifield in range(NFIELDS):
@@ -664,13 +1235,35 @@ def get_generate_variable_truth(experiment, obs_type, storage_dir=STORAGE_DIR, t
                     fout.write("# x  y\n")
                     np.savetxt(fout, np.array((xfield.flatten(), yfield.flatten())).T)
 
-            # Having got the x,y and g1, g2 for all the subfields in this field, flatten and use
-            # to calculate the map_E
-            map_results = run_corr2(
+            # Having got the x,y and g1, g2 for all the subfields in this field, flatten and store
+            # for the calculation of map_E below
+            mapsq_tasks.append((mapsq_func, (
                 xfield.flatten(), yfield.flatten(), g1.flatten(), g2.flatten(),
-                np.ones(NGALS_PER_SUBFIELD * NSUBFIELDS_PER_FIELD), min_sep=THETA_MIN_DEG,
-                max_sep=THETA_MAX_DEG, nbins=NBINS_THETA, corr2_executable=corr2_exec,
-                xy_units="degrees", sep_units="degrees")
+                np.ones(NGALS_PER_SUBFIELD * NSUBFIELDS_PER_FIELD)), mapsq_kwargs))
+
+        # Calculate the map_E for each field, using a pool of processes if requested (only for the
+        # in-process calculations, since corr2 runs in its own process anyway)
+        if nproc <= 0:
+            import multiprocessing
+            try:
+                nproc = multiprocessing.cpu_count()
+            except NotImplementedError:
+                nproc = 1
+        if mapsq_func is not run_corr2 and nproc > 1:
+            import multiprocessing
+            pool = multiprocessing.Pool(min(nproc, NFIELDS))
+            try:
+                all_map_results = pool.map(_calculate_mapsq_star, mapsq_tasks, chunksize=1)
+                pool.close()
+            except:
+                pool.terminate()
+                raise
+            finally:
+                pool.join()
+        else:
+            all_map_results = [_calculate_mapsq_star(task) for task in mapsq_tasks]
+        for ifield, map_results in enumerate(all_map_results):
+
             theta[ifield * NBINS_THETA: (ifield + 1) * NBINS_THETA] = map_results[:, 0] 
             map_E[ifield * NBINS_THETA: (ifield + 1) * NBINS_THETA] = map_results[:, 1]     
             map_B[ifield * NBINS_THETA: (ifield + 1) * NBINS_THETA] = map_results[:, 2]
@@ -685,6 +1278,7 @@ def get_generate_variable_truth(experiment, obs_type, storage_dir=STORAGE_DIR, t
             np.savetxt(
                 fout, np.array((field, theta, map_E, map_B, maperr)).T,
                 fmt=" %2d %.18e %.18e %.18e %.18e")
+        save_truth_cache(mapEtruecache, key, np.array((field, theta, map_E, map_B, maperr)).T)
     if make_plots and not use_stored: # No point plotting if already built!
         import matplotlib.pyplot as plt
         plt.figure(figsize=(10, 8))
@@ -852,7 +1446,8 @@ def q_constant(submission_file, experiment, obs_type, storage_dir=STORAGE_DIR, t
 
 def q_variable(submission_file, experiment, obs_type, normalization=None, truth_dir=TRUTH_DIR,
                storage_dir=STORAGE_DIR, logger=None, corr2_exec="corr2", poisson_weight=False,
-               usebins=USEBINS, fractional_diff=False, squared_diff=False, sigma2_min=None):
+               usebins=USEBINS, fractional_diff=False, squared_diff=False, sigma2_min=None,
+               use_lattice=False):
     """Calculate the Q_v for a variable shear branch submission.
 
     @param submission_file  File containing the user submission.
@@ -865,7 +1460,10 @@ def q_variable(submission_file, experiment, obs_type, normalization=None, truth_
     @param truth_dir        Root directory in which the truth information for the challenge is
                             stored
     @param logger           Python logging.Logger instance, for message logging
-    @param corr2_exec       Path to Mike Jarvis' corr2 exectuable
+    @param corr2_exec       Path to Mike Jarvis' corr2 exectuable, or None to calculate map_E
+                            in this process [default = `"corr2"`]
+    @param use_lattice      Calculate the truth map_E using the FFT lattice calculation (see
+                            get_generate_variable_truth()) [default = `False`]
     @param poisson_weight   If `True`, use the relative Poisson errors in each bin of map_E
                             to form an inverse variance weight for the difference metric
                             [default = `False`]
@@ -911,19 +1509,19 @@ def q_variable(submission_file, experiment, obs_type, normalization=None, truth_
     # Load/generate the truth shear signal
     field_shear, theta_shear, map_E_shear, _, maperr_shear = get_generate_variable_truth(
         experiment, obs_type, truth_dir=truth_dir, storage_dir=storage_dir, logger=logger,
-        corr2_exec=corr2_exec, mape_file_prefix=MAPESHEAR_FILE_PREFIX, suffixes=("",),
-        make_plots=False)
+        corr2_exec=corr2_exec, use_lattice=use_lattice, mape_file_prefix=MAPESHEAR_FILE_PREFIX,
+        suffixes=("",), make_plots=False)
     # Then generate the intrinsic only map_E, useful for examinging plots, including the maperr
     # (a good estimate of the relative Poisson errors per bin) which we will use to provide a weight
     field_int, theta_int, map_E_int, _, maperr_int = get_generate_variable_truth(
         experiment, obs_type, truth_dir=truth_dir, storage_dir=storage_dir, logger=logger,
-        corr2_exec=corr2_exec, mape_file_prefix=MAPEINT_FILE_PREFIX, suffixes=("_intrinsic",),
-        make_plots=False)
+        corr2_exec=corr2_exec, use_lattice=use_lattice, mape_file_prefix=MAPEINT_FILE_PREFIX,
+        suffixes=("_intrinsic",), make_plots=False)
     # Then generate the theory observed = int + shear combined map signals - these are our reference
     # Note this uses the new functionality of get_generate_variable_truth for adding shears
     field_ref, theta_ref, map_E_ref, _, maperr_ref = get_generate_variable_truth(
         experiment, obs_type, truth_dir=truth_dir, storage_dir=storage_dir, logger=logger,
-        corr2_exec=corr2_exec, mape_file_prefix=MAPEOBS_FILE_PREFIX,
+        corr2_exec=corr2_exec, use_lattice=use_lattice, mape_file_prefix=MAPEOBS_FILE_PREFIX,
         file_prefixes=("galaxy_catalog", "galaxy_catalog"), suffixes=("_intrinsic", ""),
         make_plots=False)
     # Set up the weight
@@ -934,37 +1532,11 @@ def q_variable(submission_file, experiment, obs_type, normalization=None, truth_
     # Set up the usebins to use if `usebins == None` (use all bins)
     if usebins is None:
         usebins = np.repeat(True, NBINS_THETA * NFIELDS)
-    # Get the total number of active bins per field
-    nactive = sum(usebins) / NFIELDS
     try: # Put this in a try except block to handle funky submissions better
-        np.testing.assert_array_almost_equal( # Sanity check out truth / expected theta bins
-            theta_shear, EXPECTED_THETA, decimal=3,
-            err_msg="BIG SNAFU! Truth theta does not match the EXPECTED_THETA, failing...")
-        np.testing.assert_array_equal(
-            field_sub, field_ref, err_msg="User field array does not match truth.")
-        np.testing.assert_array_almost_equal(
-            theta_sub, theta_ref, decimal=3, err_msg="User theta array does not match truth.")
-        # The definition of Q_v is so simple there is no need to use the g3metrics version
-        # NOTE WE ARE TRYING A NEW DEFINITION OF Q_v THAT IS NOT SO SIMPLE
-        Q_v_fields = np.zeros(nactive) # To store diffs averaged over fields, per bin
-        if not fractional_diff:
-            for i in range(nactive): # Sum over all fields for each bin, nactive being the stride
-
-                Q_v_fields[i] = np.sum(((weight * (map_E_sub - map_E_ref))[usebins])[i::nactive])
-
-        else:
-            for i in range(nactive): # Sum over all fields for each bin, nactive being the stride
-
-                Q_v_fields[i] = np.sum(
-                    ((weight * (map_E_sub - map_E_ref) / map_E_ref)[usebins])[i::nactive])
-
-        # Then take the weighted average abs(Q_v_fields)
-        if not squared_diff:
-            Q_v = normalization / (
-                sigma2_min + (np.sum(np.abs(Q_v_fields)) / np.sum(weight[usebins])))
-        else:
-            Q_v = normalization / (
-                sigma2_min + (np.sum(Q_v_fields**2) / np.sum(weight[usebins])))
+        _check_variable_submission(field_sub, theta_sub, field_ref, theta_ref, theta_shear)
+        Q_v = _calculate_q_variable(
+            map_E_sub, map_E_ref, weight, usebins, normalization, sigma2_min,
+            fractional_diff=fractional_diff, squared_diff=squared_diff)
     except Exception as err:
         Q_v = 0. # If the theta or field do not match, let's be strict and force Q_v...
         if logger is not None:
@@ -974,6 +1546,48 @@ def q_variable(submission_file, experiment, obs_type, normalization=None, truth_
     # Then return Q_v
     return Q_v
 
+def _check_variable_submission(field_sub, theta_sub, field_ref, theta_ref, theta_shear):
+    """Check that the field and theta arrays of a variable shear submission match the truth, and
+    that the truth theta matches EXPECTED_THETA, raising an AssertionError if not.
+    """
+    np.testing.assert_array_almost_equal( # Sanity check out truth / expected theta bins
+        theta_shear, EXPECTED_THETA, decimal=3,
+        err_msg="BIG SNAFU! Truth theta does not match the EXPECTED_THETA, failing...")
+    np.testing.assert_array_equal(
+        field_sub, field_ref, err_msg="User field array does not match truth.")
+    np.testing.assert_array_almost_equal(
+        theta_sub, theta_ref, decimal=3, err_msg="User theta array does not match truth.")
+
+def _calculate_q_variable(map_E_sub, map_E_ref, weight, usebins, normalization, sigma2_min,
+                          fractional_diff=False, squared_diff=False):
+    """Calculate Q_v from the submitted and reference map_E, as described in q_variable().
+
+    The map_E_sub may also be an array of many submissions with shape
+    `(nsubmissions, NBINS_THETA * NFIELDS)`, in which case an array of Q_v values is returned.
+
+    @return The metric Q_v
+    """
+    usebins = np.asarray(usebins, dtype=bool)
+    # Get the total number of active bins per field
+    nactive = np.sum(usebins) / NFIELDS
+    # The definition of Q_v is so simple there is no need to use the g3metrics version
+    # NOTE WE ARE TRYING A NEW DEFINITION OF Q_v THAT IS NOT SO SIMPLE
+    if not fractional_diff:
+        diffs = (weight * (map_E_sub - map_E_ref))[..., usebins]
+    else:
+        diffs = (weight * (map_E_sub - map_E_ref) / map_E_ref)[..., usebins]
+    # Sum over all fields for each bin, nactive being the stride
+    Q_v_fields = np.sum(
+        np.reshape(diffs, diffs.shape[:-1] + (NFIELDS, nactive)), axis=-2)
+    # Then take the weighted average abs(Q_v_fields)
+    if not squared_diff:
+        Q_v = normalization / (
+            sigma2_min + (np.sum(np.abs(Q_v_fields), axis=-1) / np.sum(weight[usebins])))
+    else:
+        Q_v = normalization / (
+            sigma2_min + (np.sum(Q_v_fields**2, axis=-1) / np.sum(weight[usebins])))
+    return Q_v
+
 def map_diff_func(cm_array, mapEsub, maperrsub, mapEref, mapEunitc):
         """Difference between an m,c model of a biased aperture mass statistic submission and the 
         submission itself, as a vector corresponding to the theta vector.
@@ -996,7 +1610,7 @@ def map_diff_func(cm_array, mapEsub, maperrsub, mapEref, mapEunitc):
 def q_variable_by_mc(submission_file, experiment, obs_type, map_E_unitc, normalization=None,
                      truth_dir=TRUTH_DIR, storage_dir=STORAGE_DIR, logger=None, usebins=None,
                      corr2_exec="corr2", sigma2_min=None, cfid=CFID, mfid=MFID, just_q=False,
-                     pretty_print=False):
+                     pretty_print=False, use_lattice=False, nonlinear_fit=False):
     """Calculate the Q_v for a variable shear branch submission, using a best-fitting m and c model
     of submission biases to evaluate the score.  Experimental metric, not used in the GREAT3
     challenge due to the difficulty of reliably modelling m & c in simulation tests.
@@ -1014,7 +1628,10 @@ def q_variable_by_mc(submission_file, experiment, obs_type, map_E_unitc, normali
     @param usebins          An array the same shape as EXPECTED_THETA specifying which bins to
                             use in the calculation of Q_v [default = `USEBINS`].  If set to `None`,
                             uses all bins
-    @param corr2_exec       Path to Mike Jarvis' corr2 exectuable
+    @param corr2_exec       Path to Mike Jarvis' corr2 exectuable, or None to calculate map_E
+                            in this process [default = `"corr2"`]
+    @param use_lattice      Calculate the truth map_E using the FFT lattice calculation (see
+                            get_generate_variable_truth()) [default = `False`]
     @param sigma2_min       Damping term to put into the denominator of metric (default `None`
                             uses either `SIGMA2_MIN_VARIABLE_GROUND` or `SIGMA2_MIN_VARIABLE_SPACE`
                             depending on `obs_type`)
@@ -1023,6 +1640,10 @@ def q_variable_by_mc(submission_file, experiment, obs_type, map_E_unitc, normali
     @param just_q           Set `just_q = True` (default is `False`) to only return Q_v rather than
                             the default behaviour of returning a tuple including best fitting |c|,
                             m, uncertainties etc.
+    @param nonlinear_fit    Fit m and c using scipy.optimize.leastsq, rather than in closed form
+                            using the linearity of the model in c^2 and (1 + m)^2 (the nonlinear
+                            fit is always used when the closed form solution has c^2 <= 0)
+                            [default = `False`]
     @return The metric Q_v
     """
     if not os.path.isfile(submission_file):
@@ -1057,58 +1678,28 @@ def q_variable_by_mc(submission_file, experiment, obs_type, map_E_unitc, normali
     # Load/generate the truth shear signal
     field_shear, theta_shear, map_E_shear, _, maperr_shear = get_generate_variable_truth(
         experiment, obs_type, truth_dir=truth_dir, storage_dir=storage_dir, logger=logger,
-        corr2_exec=corr2_exec, mape_file_prefix=MAPESHEAR_FILE_PREFIX, suffixes=("",),
-        make_plots=False)
+        corr2_exec=corr2_exec, use_lattice=use_lattice, mape_file_prefix=MAPESHEAR_FILE_PREFIX,
+        suffixes=("",), make_plots=False)
     # Then generate the intrinsic only map_E, useful for examinging plots, including the maperr
     # (a good estimate of the relative Poisson errors per bin) which we will use to provide a weight
     field_int, theta_int, map_E_int, _, maperr_int = get_generate_variable_truth(
         experiment, obs_type, truth_dir=truth_dir, storage_dir=storage_dir, logger=logger,
-        corr2_exec=corr2_exec, mape_file_prefix=MAPEINT_FILE_PREFIX, suffixes=("_intrinsic",),
-        make_plots=False)
+        corr2_exec=corr2_exec, use_lattice=use_lattice, mape_file_prefix=MAPEINT_FILE_PREFIX,
+        suffixes=("_intrinsic",), make_plots=False)
     # Then generate the theory observed = int + shear combined map signals - these are our reference
     # Note this uses the new functionality of get_generate_variable_truth for adding shears
     field_ref, theta_ref, map_E_ref, _, maperr_ref = get_generate_variable_truth(
         experiment, obs_type, truth_dir=truth_dir, storage_dir=storage_dir, logger=logger,
-        corr2_exec=corr2_exec, mape_file_prefix=MAPEOBS_FILE_PREFIX,
+        corr2_exec=corr2_exec, use_lattice=use_lattice, mape_file_prefix=MAPEOBS_FILE_PREFIX,
         file_prefixes=("galaxy_catalog", "galaxy_catalog"), suffixes=("_intrinsic", ""),
         make_plots=False)
     # Set up the usebins to use if `usebins == None` (use all bins)
     if usebins is None:
         usebins = np.repeat(True, NBINS_THETA * NFIELDS)
-    # Get the total number of active bins per field
-    nactive = sum(usebins) / NFIELDS
     if True: # Put this in a try except block to handle funky submissions better
-        np.testing.assert_array_almost_equal( # Sanity check out truth / expected theta bins
-            theta_shear, EXPECTED_THETA, decimal=3,
-            err_msg="BIG SNAFU! Truth theta does not match the EXPECTED_THETA, failing...")
-        np.testing.assert_array_equal(
-            field_sub, field_ref, err_msg="User field array does not match truth.")
-        np.testing.assert_array_almost_equal(
-            theta_sub, theta_ref, decimal=3, err_msg="User theta array does not match truth.")
-        # Use optimize.leastsq to find the best fitting linear bias model params, and covariances
-        import scipy.optimize
-        optimize_results = scipy.optimize.leastsq(
-            map_diff_func, np.array([0., 0.]),
-            args=(
-                map_E_sub[usebins],
-                maperr_ref[usebins],
-                map_E_ref[usebins],  # Note use of ref errors: this will appropriately
-                                              # weight different bins and is not itself noisy
-                map_E_unitc[usebins]), full_output=True)
-        csub = optimize_results[0][0]
-        msub = optimize_results[0][1]
-        map_E_model = map_E_unitc * csub**2 + map_E_ref * (1. + 2. * msub + msub**2)
-        residual_variance = np.var(
-            ((map_E_sub - map_E_model) / maperr_ref)[usebins], ddof=1)
-        if optimize_results[1] is not None:
-            covcm = optimize_results[1] * residual_variance
-            sigcsub = np.sqrt(covcm[0, 0])
-            sigmsub = np.sqrt(covcm[1, 1])
-            covcm = covcm[0, 1]
-        else:
-            sigcsub = 0.
-            sigmsub = 0.
-            covcm = 0.
+        _check_variable_submission(field_sub, theta_sub, field_ref, theta_ref, theta_shear)
+        csub, msub, sigcsub, sigmsub, covcm = _fit_variable_mc(
+            map_E_sub, map_E_ref, maperr_ref, map_E_unitc, usebins, nonlinear=nonlinear_fit)
         # Then we define the Q_v
         Q_v = 2449. * normalization / np.sqrt(
             (csub / cfid)**2 + (msub / mfid)**2 + sigma2_min)
@@ -1136,3 +1727,378 @@ def q_variable_by_mc(submission_file, experiment, obs_type, map_E_unitc, normali
             print "Cov(1, 1) = %+.4e" % sigmsub**2
         ret = (Q_v, csub, msub, sigcsub, sigmsub, covcm)
     return ret
+
+def _fit_variable_mc(map_E_sub, map_E_ref, maperr_ref, map_E_unitc, usebins, nonlinear=False):
+    """Find the best fitting m, c model of the biases in variable shear submissions (see
+    map_diff_func()), and its uncertainties.
+
+    The model is linear in c^2 and (1 + m)^2, so it is fitted in closed form for all the
+    submissions at once, where map_E_sub may have any number of leading axes (e.g. one row per
+    Monte Carlo realization).  The uncertainties are propagated from those of c^2 and (1 + m)^2 and
+    scaled by the residual variance, as for the nonlinear fit.  Submissions for which the linear
+    solution has c^2 <= 0 or (1 + m)^2 <= 0, which the model can only approach at its boundary, are
+    fitted with scipy.optimize.leastsq instead, see _fit_variable_mc_nonlinear().  Set
+    `nonlinear=True` to use leastsq for all submissions.
+
+    @return c, m, sigc, sigm, covcm, each with the shape of the leading axes of map_E_sub
+    """
+    map_E_sub = np.asarray(map_E_sub, dtype=float)
+    ret = np.empty((5,) + map_E_sub.shape[:-1])
+    if nonlinear:
+        use_linear = np.zeros(map_E_sub.shape[:-1], dtype=bool)
+    else:
+        c2, opm2, var_c2, cov_c2opm2, var_opm2 = g3metrics.fittemplates_batch(
+            map_E_sub[..., usebins], map_E_unitc[usebins], map_E_ref[usebins],
+            sigma=maperr_ref[usebins])
+        use_linear = (c2 > 0.) & (opm2 > 0.) & np.isfinite(var_c2) & np.isfinite(var_opm2)
+        c2 = np.where(use_linear, c2, 1.)
+        opm2 = np.where(use_linear, opm2, 1.)
+        csub = np.sqrt(c2)
+        msub = np.sqrt(opm2) - 1.
+        map_E_model = (
+            map_E_unitc * c2[..., np.newaxis] + map_E_ref * opm2[..., np.newaxis])
+        residual_variance = np.var(
+            ((map_E_sub - map_E_model) / maperr_ref)[..., usebins], axis=-1, ddof=1)
+        # Propagate to c, m using dc = dc^2 / 2c and dm = d(1 + m)^2 / 2(1 + m)
+        ret[0] = csub
+        ret[1] = msub
+        ret[2] = np.sqrt(var_c2 * residual_variance) / (2. * csub)
+        ret[3] = np.sqrt(var_opm2 * residual_variance) / (2. * (1. + msub))
+        ret[4] = cov_c2opm2 * residual_variance / (4. * csub * (1. + msub))
+    for index in np.ndindex(*use_linear.shape):
+
+        if not use_linear[index]:
+            ret[(slice(None),) + index] = _fit_variable_mc_nonlinear(
+                map_E_sub[index], map_E_ref, maperr_ref, map_E_unitc, usebins)
+
+    return tuple(ret)
+
+def _fit_variable_mc_nonlinear(map_E_sub, map_E_ref, maperr_ref, map_E_unitc, usebins):
+    """Find the best fitting m, c model of the biases in a single variable shear submission (see
+    map_diff_func()), and its uncertainties, using scipy.optimize.leastsq.
+
+    @return c, m, sigc, sigm, covcm
+    """
+    # Use optimize.leastsq to find the best fitting linear bias model params, and covariances
+    import scipy.optimize
+    optimize_results = scipy.optimize.leastsq(
+        map_diff_func, np.array([0., 0.]),
+        args=(
+            map_E_sub[usebins],
+            maperr_ref[usebins],
+            map_E_ref[usebins],  # Note use of ref errors: this will appropriately
+                                 # weight different bins and is not itself noisy
+            map_E_unitc[usebins]), full_output=True)
+    csub = optimize_results[0][0]
+    msub = optimize_results[0][1]
+    map_E_model = map_E_unitc * csub**2 + map_E_ref * (1. + 2. * msub + msub**2)
+    residual_variance = np.var(
+        ((map_E_sub - map_E_model) / maperr_ref)[usebins], ddof=1)
+    if optimize_results[1] is not None:
+        covcm = optimize_results[1] * residual_variance
+        sigcsub = np.sqrt(covcm[0, 0])
+        sigmsub = np.sqrt(covcm[1, 1])
+        covcm = covcm[0, 1]
+    else:
+        sigcsub = 0.
+        sigmsub = 0.
+        covcm = 0.
+    return csub, msub, sigcsub, sigmsub, covcm
+
+# When a BranchScorer scores submissions with a pool of processes, the worker function below needs
+# the scorer, which holds all the truth arrays.  Rather than pickling it with every task, we store
+# it here before the pool is created and let the forked worker processes inherit it.
+_scorer_state = None
+
+def _scoreSubmissionPool(submission_file):
+    """Worker function for the BranchScorer pool: score one submission file."""
+    return _scorer_state.score(submission_file)
+
+class BranchScorer(object):
+    """A class for scoring any number of submissions to a single branch.
+
+    The truth (and the rotations for constant shear branches) are loaded once, when the
+    BranchScorer is constructed, and kept in memory for all subsequent calls to score() or
+    scoreFiles().  The metrics are calculated as in q_constant() and q_variable(), and the results
+    are returned as a table of Q, m, c and their uncertainties.
+
+    For example:
+
+        >>> scorer = BranchScorer("control", "ground", "constant")
+        >>> results = scorer.scoreFiles(submission_files, nproc=8)
+        >>> print results["Q"], results["m1"]
+    """
+
+    # Names of the result columns for each shear_type.  The m, c for variable shear branches are
+    # calculated only if map_E_unitc is given, as in q_variable_by_mc(), otherwise they are NaN.
+    columns = {
+        "constant": ("Q", "c1", "m1", "c2", "m2", "sigc1", "sigm1", "sigc2", "sigm2"),
+        "variable": ("Q", "c", "m", "sigc", "sigm"),
+    }
+
+    def __init__(self, experiment, obs_type, shear_type, truth_dir=TRUTH_DIR,
+                 storage_dir=STORAGE_DIR, logger=None, normalization=None, sigma2_min=None,
+                 cfid=CFID, mfid=MFID, usebins=USEBINS, poisson_weight=False,
+                 fractional_diff=False, squared_diff=False, map_E_unitc=None, corr2_exec="corr2",
+                 use_lattice=False, nonlinear_fit=False):
+        """Load the truth for a branch, ready for scoring submissions.
+
+        @param experiment       Experiment for this branch, one of 'control', 'real_galaxy',
+                                'variable_psf', 'multiepoch', 'full'
+        @param obs_type         Observation type for this branch, one of 'ground' or 'space'
+        @param shear_type       Shear type for this branch, one of 'constant' or 'variable'
+        @param truth_dir        Root directory in which the truth information for the challenge is
+                                stored
+        @param storage_dir      Directory from/into which to load/store truth files
+        @param logger           Python logging.Logger instance, for message logging.  As in
+                                q_constant() and q_variable(), if a logger is given then a
+                                submission that cannot be scored is given Q = 0 with a warning,
+                                otherwise the exception is raised
+        @param normalization    Normalization factor for the metric (default `None` uses the
+                                defaults of q_constant() or q_variable())
+        @param sigma2_min       Damping term to put into the denominator of the metric (default
+                                `None` uses the defaults of q_constant() or q_variable())
+        @param cfid             Fiducial, target c value
+        @param mfid             Fiducial, target m value
+        @param usebins          For variable shear, an array the same shape as EXPECTED_THETA
+                                specifying which bins to use [default = `USEBINS`].  If set to
+                                `None`, uses all bins
+        @param poisson_weight   For variable shear, see q_variable() [default = `False`]
+        @param fractional_diff  For variable shear, see q_variable() [default = `False`]
+        @param squared_diff     For variable shear, see q_variable() [default = `False`]
+        @param map_E_unitc      For variable shear, the map_E for unit c, used to fit for m and c as
+                                in q_variable_by_mc() [default = `None`, no fit]
+        @param corr2_exec       For variable shear, path to Mike Jarvis' corr2 exectuable, or None
+                                to calculate the truth map_E in this process
+                                [default = `"corr2"`]
+        @param use_lattice      For variable shear, calculate the truth map_E using the FFT lattice
+                                calculation [default = `False`]
+        @param nonlinear_fit    For variable shear with map_E_unitc, fit m and c using
+                                scipy.optimize.leastsq rather than in closed form (see
+                                q_variable_by_mc()) [default = `False`]
+        """
+        if shear_type not in self.columns:
+            raise ValueError("shear_type must be one of "+str(self.columns.keys()))
+        if obs_type not in ("ground", "space"):
+            raise ValueError("Default normalization cannot be set as obs_type not recognised")
+        self.experiment = experiment
+        self.obs_type = obs_type
+        self.shear_type = shear_type
+        self.logger = logger
+        self.cfid = cfid
+        self.mfid = mfid
+        if shear_type == "constant":
+            if normalization is None:
+                normalization = {
+                    "ground": NORMALIZATION_CONSTANT_GROUND,
+                    "space": NORMALIZATION_CONSTANT_SPACE}[obs_type]
+            if sigma2_min is None:
+                sigma2_min = {
+                    "ground": SIGMA2_MIN_CONSTANT_GROUND,
+                    "space": SIGMA2_MIN_CONSTANT_SPACE}[obs_type]
+            # Load the rotations and truth, and rotate the truth just once (see q_constant() for
+            # the sense of the rotation)
+            rotations = get_generate_const_rotations(
+                experiment, obs_type, truth_dir=truth_dir, storage_dir=storage_dir, logger=logger)
+            _, g1truth, g2truth = get_generate_const_truth(
+                experiment, obs_type, truth_dir=truth_dir, storage_dir=storage_dir, logger=logger)
+            self.cos2rot = np.cos(-2. * rotations)
+            self.sin2rot = np.sin(-2. * rotations)
+            self.g1trot = g1truth * self.cos2rot - g2truth * self.sin2rot
+            self.g2trot = g1truth * self.sin2rot + g2truth * self.cos2rot
+        else:
+            if normalization is None:
+                normalization = {
+                    "ground": NORMALIZATION_VARIABLE_GROUND,
+                    "space": NORMALIZATION_VARIABLE_SPACE}[obs_type]
+            if sigma2_min is None:
+                sigma2_min = {
+                    "ground": SIGMA2_MIN_VARIABLE_GROUND,
+                    "space": SIGMA2_MIN_VARIABLE_SPACE}[obs_type]
+            # Load the shear, intrinsic and observed truth map_E, as in q_variable()
+            _, self.theta_shear, _, _, _ = get_generate_variable_truth(
+                experiment, obs_type, truth_dir=truth_dir, storage_dir=storage_dir,
+                logger=logger, corr2_exec=corr2_exec, use_lattice=use_lattice,
+                mape_file_prefix=MAPESHEAR_FILE_PREFIX, suffixes=("",), make_plots=False)
+            _, _, _, _, maperr_int = get_generate_variable_truth(
+                experiment, obs_type, truth_dir=truth_dir, storage_dir=storage_dir,
+                logger=logger, corr2_exec=corr2_exec, use_lattice=use_lattice,
+                mape_file_prefix=MAPEINT_FILE_PREFIX, suffixes=("_intrinsic",), make_plots=False)
+            self.field_ref, self.theta_ref, self.map_E_ref, _, self.maperr_ref = \
+                get_generate_variable_truth(
+                    experiment, obs_type, truth_dir=truth_dir, storage_dir=storage_dir,
+                    logger=logger, corr2_exec=corr2_exec, use_lattice=use_lattice,
+                    mape_file_prefix=MAPEOBS_FILE_PREFIX,
+                    file_prefixes=("galaxy_catalog", "galaxy_catalog"),
+                    suffixes=("_intrinsic", ""), make_plots=False)
+            if poisson_weight:
+                self.weight = max(maperr_int**2) / maperr_int**2 # Inverse variance weight
+            else:
+                self.weight = np.ones_like(self.map_E_ref)
+            if usebins is None:
+                usebins = np.repeat(True, NBINS_THETA * NFIELDS)
+            self.usebins = usebins
+            self.fractional_diff = fractional_diff
+            self.squared_diff = squared_diff
+            self.map_E_unitc = map_E_unitc
+            self.nonlinear_fit = nonlinear_fit
+        self.normalization = normalization
+        self.sigma2_min = sigma2_min
+
+    def score(self, submission_file):
+        """Score a single submission file.
+
+        @param submission_file  File containing the user submission.
+        @return A tuple of the results, in the order given by `columns[shear_type]`
+        """
+        if not os.path.isfile(submission_file):
+            raise ValueError("Supplied submission_file '"+submission_file+"' does not exist.")
+        if self.logger is not None:
+            self.logger.info("Calculating Q metric for "+submission_file)
+        try: # Put this in a try except block to handle funky submissions better
+            if self.shear_type == "constant":
+                ret = self._scoreConstant(submission_file)
+            else:
+                ret = self._scoreVariable(submission_file)
+        except Exception as err:
+            # As for q_constant() and q_variable(), set all outputs to zero but warn the user via
+            # any supplied logger; else raise
+            ret = (0.,) * len(self.columns[self.shear_type])
+            if self.logger is not None:
+                self.logger.warn(str(submission_file)+": "+str(err))
+            else:
+                raise err
+        return ret
+
+    def _scoreConstant(self, submission_file):
+        """Score a constant shear submission, see q_constant()."""
+        data = np.loadtxt(submission_file)
+        g1sub = data[:, 1]
+        g2sub = data[:, 2]
+        g1srot = g1sub * self.cos2rot - g2sub * self.sin2rot
+        g2srot = g1sub * self.sin2rot + g2sub * self.cos2rot
+        Q_c, c1, m1, c2, m2, sigc1, sigm1, sigc2, sigm2 = g3metrics.metricQZ1_const_shear(
+            g1srot, g2srot, self.g1trot, self.g2trot,
+            cfid=self.cfid, mfid=self.mfid, sigma2_min=self.sigma2_min)
+        Q_c *= self.normalization
+        return (Q_c, c1, m1, c2, m2, sigc1, sigm1, sigc2, sigm2)
+
+    def _scoreVariable(self, submission_file):
+        """Score a variable shear submission, see q_variable() and q_variable_by_mc()."""
+        data = np.loadtxt(submission_file)
+        # We are stating that we want at least 4 and up to 5 columns, so check for this
+        if data.shape not in ((NBINS_THETA * NFIELDS, 4), (NBINS_THETA * NFIELDS, 5)):
+            raise ValueError("Submission "+str(submission_file)+" is not the correct shape!")
+        field_sub = data[:, 0].astype(int)
+        theta_sub = data[:, 1]
+        map_E_sub = data[:, 2]
+        _check_variable_submission(
+            field_sub, theta_sub, self.field_ref, self.theta_ref, self.theta_shear)
+        Q_v = _calculate_q_variable(
+            map_E_sub, self.map_E_ref, self.weight, self.usebins, self.normalization,
+            self.sigma2_min, fractional_diff=self.fractional_diff, squared_diff=self.squared_diff)
+        if self.map_E_unitc is not None:
+            csub, msub, sigcsub, sigmsub, _ = _fit_variable_mc(
+                map_E_sub, self.map_E_ref, self.maperr_ref, self.map_E_unitc, self.usebins,
+                nonlinear=self.nonlinear_fit)
+        else:
+            csub, msub, sigcsub, sigmsub = np.nan, np.nan, np.nan, np.nan
+        return (Q_v, csub, msub, sigcsub, sigmsub)
+
+    def scoreConstantBatch(self, g1sub, g2sub):
+        """Score many constant shear submissions, given as arrays rather than files, at once.
+
+        This is much faster than scoring the submissions one at a time, which makes it suitable for
+        Monte Carlo studies with large numbers of simulated submissions (see, e.g.,
+        g3metrics.make_submissions_const_shear_batch()).
+
+        @param g1sub  Array of submitted g1 with shape (nsubmissions, number of truth values)
+        @param g2sub  Array of submitted g2 with shape (nsubmissions, number of truth values)
+        @return A NumPy record array with one row per submission, with the columns given by
+                `columns["constant"]`
+        """
+        if self.shear_type != "constant":
+            raise ValueError("scoreConstantBatch() requires a constant shear BranchScorer")
+        g1sub = np.atleast_2d(g1sub)
+        g2sub = np.atleast_2d(g2sub)
+        g1srot = g1sub * self.cos2rot - g2sub * self.sin2rot
+        g2srot = g1sub * self.sin2rot + g2sub * self.cos2rot
+        results = list(g3metrics.metricQZ1_const_shear_batch(
+            g1srot, g2srot, self.g1trot, self.g2trot,
+            cfid=self.cfid, mfid=self.mfid, sigma2_min=self.sigma2_min))
+        results[0] = results[0] * self.normalization
+        return self._makeTable(results)
+
+    def scoreVariableBatch(self, map_E_sub):
+        """Score many variable shear submissions, given as an array of map_E rather than as files,
+        at once.  The field and theta of the submissions are assumed to match the truth.
+
+        @param map_E_sub  Array of submitted map_E with shape
+                          `(nsubmissions, NBINS_THETA * NFIELDS)`
+        @return A NumPy record array with one row per submission, with the columns given by
+                `columns["variable"]`
+        """
+        if self.shear_type != "variable":
+            raise ValueError("scoreVariableBatch() requires a variable shear BranchScorer")
+        map_E_sub = np.atleast_2d(map_E_sub)
+        Q_v = _calculate_q_variable(
+            map_E_sub, self.map_E_ref, self.weight, self.usebins, self.normalization,
+            self.sigma2_min, fractional_diff=self.fractional_diff, squared_diff=self.squared_diff)
+        if self.map_E_unitc is not None:
+            fits = _fit_variable_mc(
+                map_E_sub, self.map_E_ref, self.maperr_ref, self.map_E_unitc, self.usebins,
+                nonlinear=self.nonlinear_fit)[:4]
+        else:
+            fits = np.empty((4, len(map_E_sub)))
+            fits.fill(np.nan)
+        return self._makeTable([Q_v] + list(fits))
+
+    def _makeTable(self, results):
+        """Make a record array from a list of result arrays, in the order of the columns for this
+        shear_type."""
+        dtype = [(name, float) for name in self.columns[self.shear_type]]
+        table = np.empty(len(results[0]), dtype=dtype).view(np.recarray)
+        for name, values in zip(self.columns[self.shear_type], results):
+
+            table[name] = values
+
+        return table
+
+    def scoreFiles(self, submission_files, nproc=1):
+        """Score a list (or any other iterable) of submission files.
+
+        @param submission_files  Iterable of the files containing the user submissions
+        @param nproc             Number of processes to use; if <= 0, use the number of CPUs
+                                 [default = 1]
+        @return A NumPy record array with one row per submission, with a "submission" column giving
+                the file name followed by the columns given by `columns[shear_type]`
+        """
+        if nproc <= 0:
+            import multiprocessing
+            try:
+                nproc = multiprocessing.cpu_count()
+            except NotImplementedError:
+                nproc = 1
+        submission_files = list(submission_files)
+        if nproc > 1 and len(submission_files) > 1:
+            import multiprocessing
+            global _scorer_state
+            _scorer_state = self
+            pool = multiprocessing.Pool(min(nproc, len(submission_files)))
+            try:
+                results = pool.map(_scoreSubmissionPool, submission_files)
+                pool.close()
+            except:
+                pool.terminate()
+                raise
+            finally:
+                pool.join()
+                _scorer_state = None
+        else:
+            results = [self.score(submission_file) for submission_file in submission_files]
+        dtype = [("submission", "S%d" % max([1] + [len(f) for f in submission_files]))]
+        dtype += [(name, float) for name in self.columns[self.shear_type]]
+        return np.array(
+            [(submission_file,) + tuple(result)
+             for submission_file, result in zip(submission_files, results)],
+            dtype=dtype).view(np.recarray)
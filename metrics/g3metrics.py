@@ -380,6 +380,48 @@ def make_multiple_submissions_const_shear(c1, c2, m1, m2, g1true, g2true, ngals_
 
     return g1sub, g2sub
 
+def make_submissions_const_shear_batch(c1, c2, m1, m2, g1true, g2true, ngals_per_subfield,
+                                       noise_sigma, nsubmissions, rotate_cs=None):
+    """Make a batch of independent fake const shear submissions as arrays, all at once.
+
+    This is equivalent to calling make_submission_const_shear() nsubmissions times, except that the
+    mean of the ngals_per_subfield noisy shears in each subfield is drawn directly from its (normal)
+    distribution, with standard deviation noise_sigma / sqrt(ngals_per_subfield).
+
+    Arguments
+    ---------
+    * Provided c1, c2, m1, m2 shear estimation bias values
+    * Truth tables g1true, g2true
+    * The number of galaxies per subfield, ngals_per_subfield, represented by each truth table
+      element
+    * The noise_sigma standard deviation on the shear estimate for each galaxy due to noise
+    * nsubmissions is the number of submissions to create
+    * rotate_cs should be a vector of rotation angles by which to rotate c additive offsets (useful)
+      for biases defined in PSF frame
+
+    Returns g1sub, g2sub each with shape (nsubmissions, len(g1true))
+    """
+    g1true = np.asarray(g1true)
+    g2true = np.asarray(g2true)
+    nsubfields = len(g1true)
+    if len(g2true) != nsubfields:
+        raise ValueError("Supplied g1true, g2true not matching length.")
+    # Make the c1 and c2 an array for rotation if necessary
+    c1 = c1 * np.ones(nsubfields)
+    c2 = c2 * np.ones(nsubfields)
+    if rotate_cs is not None:
+        c1arr = c1 * np.cos(2. * rotate_cs) - c2 * np.sin(2. * rotate_cs)
+        c2arr = c1 * np.sin(2. * rotate_cs) + c2 * np.cos(2. * rotate_cs)
+    else:
+        c1arr = c1
+        c2arr = c2
+    noise_sigma_subfield = noise_sigma / np.sqrt(ngals_per_subfield)
+    g1sub = (1. + m1) * g1true + c1arr + noise_sigma_subfield * np.random.randn(
+        nsubmissions, nsubfields)
+    g2sub = (1. + m2) * g2true + c2arr + noise_sigma_subfield * np.random.randn(
+        nsubmissions, nsubfields)
+    return g1sub, g2sub
+
 def _calculateSvalues(xarr, yarr, sigma2=1.):
     """Calculates the intermediate S values required for basic linear regression.
 
@@ -484,6 +526,63 @@ def fitline(xarr, yarr):
     var_b  = sigma2 * S / Del
     return (a, b, var_a, cov_ab, var_b)
 
+def fitline_batch(xarr, yarr):
+    """Fit lines y = a + b * x to many sets of x and y values at once, by least squares.
+
+    The fits are made along the last axis of xarr and yarr, which must broadcast against each other
+    (e.g. a single set of x values with shape (n,) and many sets of y values with shape (N, n)).
+    Returns the tuple (a, b, Var(a), Cov(a, b), Var(b)) of arrays, each with the shape of the other
+    axes, as for fitline().
+    """
+    xarr, yarr = np.broadcast_arrays(np.asarray(xarr), np.asarray(yarr))
+    if xarr.shape[-1] <= 1:
+        raise ValueError("Input arrays must have 2 or more values elements.")
+    S = float(xarr.shape[-1])
+    Sx = np.sum(xarr, axis=-1)
+    Sy = np.sum(yarr, axis=-1)
+    Sxx = np.sum(xarr * xarr, axis=-1)
+    Sxy = np.sum(xarr * yarr, axis=-1)
+    Del = S * Sxx - Sx * Sx
+    a = (Sxx * Sy - Sx * Sxy) / Del
+    b = (S * Sxy - Sx * Sy) / Del
+    ymodel = a[..., np.newaxis] + b[..., np.newaxis] * xarr
+    sigma2 = np.mean((yarr - ymodel)**2, axis=-1)
+    var_a  = sigma2 * Sxx / Del
+    cov_ab = - sigma2 * Sx / Del
+    var_b  = sigma2 * S / Del
+    return (a, b, var_a, cov_ab, var_b)
+
+def fittemplates_batch(yarr, t1arr, t2arr, sigma=1., use=True):
+    """Fit models y = a * t1 + b * t2 to many sets of y values at once, by weighted least squares.
+
+    The fits are made in closed form along the last axis of the inputs, which must broadcast against
+    each other, using only the elements for which `use` is `True` and weighting each by
+    1 / sigma**2.  Returns the tuple (a, b, Var(a), Cov(a, b), Var(b)) of arrays, each with the
+    shape of the other axes.  The (co)variances are the inverse of the normal matrix, i.e. they are
+    correct if sigma gives the true errors on y, and need to be scaled by the reduced chi^2
+    otherwise.  Fits for which the normal matrix is singular return NaN or inf values.
+    """
+    yarr, t1arr, t2arr, sigma, use = np.broadcast_arrays(
+        np.asarray(yarr, dtype=float), np.asarray(t1arr, dtype=float),
+        np.asarray(t2arr, dtype=float), np.asarray(sigma, dtype=float), np.asarray(use, dtype=bool))
+    w = np.where(use, 1. / sigma**2, 0.)
+    S11 = np.sum(w * t1arr * t1arr, axis=-1)
+    S12 = np.sum(w * t1arr * t2arr, axis=-1)
+    S22 = np.sum(w * t2arr * t2arr, axis=-1)
+    S1y = np.sum(w * t1arr * yarr, axis=-1)
+    S2y = np.sum(w * t2arr * yarr, axis=-1)
+    Del = S11 * S22 - S12 * S12
+    old_settings = np.seterr(divide="ignore", invalid="ignore")
+    try:
+        a = (S22 * S1y - S12 * S2y) / Del
+        b = (S11 * S2y - S12 * S1y) / Del
+        var_a = S22 / Del
+        cov_ab = - S12 / Del
+        var_b = S11 / Del
+    finally:
+        np.seterr(**old_settings)
+    return (a, b, var_a, cov_ab, var_b)
+
 def metricQ08_const_shear(g1est, g2est, g1true, g2true, nfields):
     """Calculate a GREAT08-style Q value for constant shear branch results.
 
@@ -521,6 +620,20 @@ def metricQZ1_const_shear(g1est, g2est, g1true, g2true, cfid=1.e-4, mfid=1.e-3,
         (c1 / cfid)**2 + (c2 / cfid)**2 + (m1 / mfid)**2 + (m2 / mfid)**2 + sigma2_min)
     return (Q, c1, m1, c2, m2, sig_c1, sig_m1, sig_c2, sig_m2)
 
+def metricQZ1_const_shear_batch(g1est, g2est, g1true, g2true, cfid=1.e-4, mfid=1.e-3,
+                                sigma2_min=0.):
+    """Calculate metricQZ1_const_shear() for many submissions at once.
+
+    g1est and g2est have shape (nsubmissions, nsubfields), and g1true and g2true shape
+    (nsubfields,).  Returns the same tuple as metricQZ1_const_shear(), but with each entry an array
+    of length nsubmissions.
+    """
+    c1, m1, var_c1, cov_c1m1, var_m1 = fitline_batch(g1true, g1est - g1true)
+    c2, m2, var_c2, cov_c2m2, var_m2 = fitline_batch(g2true, g2est - g2true)
+    Q = 2000. / np.sqrt(
+        (c1 / cfid)**2 + (c2 / cfid)**2 + (m1 / mfid)**2 + (m2 / mfid)**2 + sigma2_min)
+    return (Q, c1, m1, c2, m2, np.sqrt(var_c1), np.sqrt(var_m1), np.sqrt(var_c2), np.sqrt(var_m2))
+
 def metricQZ2_const_shear(g1est, g2est, g1true, g2true, cfid=1.e-4, mfid=1.e-3):
     """Calculate a metric along the lines suggested by Joe Zuntz in Pittsburgh (option 2).
     """
@@ -613,80 +726,90 @@ def map_squared_diff_func(cm_array, mapEsub, maperrsub, mapEtrue, mapEunitc):
 def metricMapCF_var_shear_mc(mapEsub_list, maperrsub_list, mapEtrue_list, mapBtrue_list, nfields,
                              ngrid=100, dx_grid=0.1, nbins=8, cfid=1.e-4, mfid=1.e-3, min_sep=0.1,
                              max_sep=10., plot=False, select_by_B_leakage=0.,
-                             correct_B_theory=True, use_errors=True):
+                             correct_B_theory=True, use_errors=True, linear_fit=True):
     """Calculates a metric based on fitting a STEP-like m & c linear bias model to variable shear
     results.
 
     The nfields must be an integer divisor of len(mapEsub_list).
+
+    The model is linear in c^2 and m, so by default the fits for all the fields are made at once, in
+    closed form, by weighted least squares (see fittemplates_batch()).  Set `linear_fit=False` to
+    instead fit each field separately using scipy.optimize.leastsq with map_squared_diff_func, as
+    was done originally (note this minimizes the sum of the fourth powers of the residuals).
     """
-    import scipy.optimize
     # First calculate what an input unit c1=c2=1 looks like
     theta, mapE_unitc, mapB_unitc = calculate_map_unitc(
         ngrid=ngrid, dx_grid=dx_grid, nbins=nbins, min_sep=min_sep, max_sep=max_sep)
     # Calculate the number of subfields of images per fields
     nsubfields = len(mapEsub_list) / nfields
-    c2s = []
-    ms = []
-    for iset in range(nfields):
-        mapEsub_mean = mapEsub_list[iset * nsubfields]
-        maperrsub_mean = maperrsub_list[iset * nsubfields]
-        mapEtrue_mean = mapEtrue_list[iset * nsubfields]
-        mapBtrue_mean = mapBtrue_list[iset * nsubfields]
-        for jimage in range(nsubfields)[1:]:
-            mapEsub_mean += mapEsub_list[iset * nsubfields + jimage]
-            maperrsub_mean += maperrsub_list[iset * nsubfields + jimage]
-            mapEtrue_mean += mapEtrue_list[iset * nsubfields + jimage]
-            mapBtrue_mean += mapBtrue_list[iset * nsubfields + jimage]
-        # Divide by nperset to get the mean mapE etc.
-        mapEsub_mean /= float(nsubfields)
-        maperrsub_mean /= (float(nsubfields) * np.sqrt(nsubfields))
-        mapEtrue_mean /= float(nsubfields)
-        mapBtrue_mean /= float(nsubfields)
-        # Optionally only select the regions where |true B| < select_by_B_leakage * |true E|
-        if select_by_B_leakage > 0.:
-            use_for_fit = (np.abs(mapBtrue_mean) / np.abs(mapEtrue_mean) < select_by_B_leakage)
-        else:
-            use_for_fit = np.array([True,] * len(mapEsub_mean), dtype=bool)
-        # Ready the terms to go to the fitter
-        submission = mapEsub_mean[use_for_fit]
-        if use_errors:
-            errors = maperrsub_mean[use_for_fit]
-        else:
-            errors = np.ones_like(submission)
-        truth = mapEtrue_mean[use_for_fit]
-        unit_contamination = mapE_unitc[use_for_fit]
-        if correct_B_theory:
-            submission -= mapBtrue_mean[use_for_fit]
-            truth -= mapBtrue_mean[use_for_fit]
-            unit_contamination -= mapB_unitc[use_for_fit]
-            #import pdb; pdb.set_trace()
-        # Use scipy.optimize to fit m and c (note should change this to numpy.leastsq since the
-        # model can be made approximately linear 
-        results = scipy.optimize.leastsq(
-            map_squared_diff_func, np.array([0., 0.]),
-            args=(
-                submission,
-                errors,
-                truth,
-                unit_contamination))
-        c2 = results[0][0]
-        m = results[0][1]
-        if plot:
-            import os
-            import matplotlib.pyplot as plt
-            if not os.path.isdir('plots'): os.mkdir('plots')
+    # Take the mean of the mapE etc. over the subfields in each field, giving arrays with shape
+    # (nfields, nbins)
+    shape = (nfields, nsubfields, -1)
+    mapEsub_mean = np.mean(np.reshape(np.asarray(mapEsub_list, dtype=float), shape), axis=1)
+    maperrsub_mean = np.mean(
+        np.reshape(np.asarray(maperrsub_list, dtype=float), shape), axis=1) / np.sqrt(nsubfields)
+    mapEtrue_mean = np.mean(np.reshape(np.asarray(mapEtrue_list, dtype=float), shape), axis=1)
+    mapBtrue_mean = np.mean(np.reshape(np.asarray(mapBtrue_list, dtype=float), shape), axis=1)
+    # Optionally only select the regions where |true B| < select_by_B_leakage * |true E|
+    if select_by_B_leakage > 0.:
+        use_for_fit = (np.abs(mapBtrue_mean) / np.abs(mapEtrue_mean) < select_by_B_leakage)
+    else:
+        use_for_fit = np.ones(mapEsub_mean.shape, dtype=bool)
+    # Ready the terms to go to the fitter
+    submission = mapEsub_mean.copy()
+    if use_errors:
+        errors = maperrsub_mean
+    else:
+        errors = np.ones_like(submission)
+    truth = mapEtrue_mean.copy()
+    unit_contamination = np.tile(mapE_unitc, (nfields, 1))
+    if correct_B_theory:
+        submission -= mapBtrue_mean
+        truth -= mapBtrue_mean
+        unit_contamination -= mapB_unitc
+    if linear_fit:
+        # submission - truth = c^2 * unit_contamination + m * 2 * truth
+        c2s, ms = fittemplates_batch(
+            submission - truth, unit_contamination, 2. * truth, sigma=errors, use=use_for_fit)[:2]
+    else:
+        import scipy.optimize
+        c2s = np.empty(nfields)
+        ms = np.empty(nfields)
+        for iset in range(nfields):
+
+            use = use_for_fit[iset]
+            results = scipy.optimize.leastsq(
+                map_squared_diff_func, np.array([0., 0.]),
+                args=(
+                    submission[iset][use],
+                    errors[iset][use],
+                    truth[iset][use],
+                    unit_contamination[iset][use]))
+            c2s[iset] = results[0][0]
+            ms[iset] = results[0][1]
+
+    if plot:
+        import os
+        import matplotlib.pyplot as plt
+        if not os.path.isdir('plots'): os.mkdir('plots')
+        for iset in range(nfields):
+
+            use = use_for_fit[iset]
+            c2 = c2s[iset]
+            m = ms[iset]
             plt.clf()
             plt.axes([0.16, 0.1, 0.775, 0.85])
             plt.errorbar(
-                theta, submission, yerr=maperrsub_mean, label='E submission', color='k')
+                theta[use], submission[iset][use], yerr=maperrsub_mean[iset][use],
+                label='E submission', color='k')
             if correct_B_theory:
-                plt.plot(theta, truth , 'g--', label='Map truth realizations')
+                plt.plot(theta[use], truth[iset][use], 'g--', label='Map truth realizations')
             else:
-                plt.plot(theta[use_for_fit], mapEtrue_mean[use_for_fit], 'g--', label='E true')
-                plt.plot(theta[use_for_fit], mapBtrue_mean[use_for_fit], 'r--', label='B true')
+                plt.plot(theta[use], mapEtrue_mean[iset][use], 'g--', label='E true')
+                plt.plot(theta[use], mapBtrue_mean[iset][use], 'r--', label='B true')
             plt.plot(
-                theta, truth * (1. + 2. * m) + unit_contamination * c2, 'b',
-                label='Best fitting linear model')
+                theta[use], (truth[iset] * (1. + 2. * m) + unit_contamination[iset] * c2)[use],
+                'b', label='Best fitting linear model')
             plt.axhline(color='k')
             plt.legend()
             plt.title(
@@ -698,10 +821,9 @@ def metricMapCF_var_shear_mc(mapEsub_list, maperrsub_list, mapEtrue_list, mapBtr
             plt.savefig(os.path.join(
                 'plots', 'aperture_mass_metric_set'+str(iset+1)+'of'+str(nfields)+'.png'))
             plt.show()
-        c2s.append(c2)
-        ms.append(m)
-    c2 = np.mean(np.array(c2s))
-    m = np.mean(np.array(ms))
+
+    c2 = np.mean(c2s)
+    m = np.mean(ms)
     Q = np.sqrt(2.) * 1000. / np.sqrt(np.abs(c2 / cfid**2) + (m / mfid)**2)
     return Q, c2, m
 
@@ -31,7 +31,6 @@ See https://github.com/barnabytprowe/great3-public/wiki/The-revised-GREAT3-metri
 
 import sys
 import os
-import tempfile
 import numpy as np
 import g3metrics
 path, module = os.path.split(__file__)
@@ -71,25 +70,14 @@ if __name__ == "__main__":
                 EXPERIMENT, obs_type, truth_dir=TRUTH_DIR)
             rotations = evaluate.get_generate_const_rotations(
                 EXPERIMENT, obs_type, truth_dir=TRUTH_DIR)
+            scorer = evaluate.BranchScorer(EXPERIMENT, obs_type, "constant", truth_dir=TRUTH_DIR)
             for jc, cval in enumerate(CVALS):
 
-                for itest in xrange(NTEST):
-
-                    # Build the submission
-                    g1sub, g2sub = g3metrics.make_submission_const_shear(
-                        cval, 0., evaluate.MFID, evaluate.MFID, g1true, g2true, NGALS_PER_IMAGE,
-                        NOISE_SIGMA[obs_type], rotate_cs=rotations)
-                    fdsub, subfile = tempfile.mkstemp(suffix=".dat")
-                    with os.fdopen(fdsub, "wb") as fsub:
-                        np.savetxt(
-                            fsub, np.array((subfield_index, g1sub, g2sub)).T, fmt="%d %e %e")
-                    # Then evaluate Q_c
-                    qc[obs_type][itest, jc] = evaluate.q_constant(
-                        subfile, EXPERIMENT, obs_type, just_q=True, truth_dir=TRUTH_DIR)
-                    os.remove(subfile)
-                    print "Test %4d / %4d (c+ = %.3e) Q_c = %.4f" % (
-                        itest+1, NTEST, cval, qc[obs_type][itest, jc])
-
+                # Build all NTEST submissions at once, then evaluate Q_c for them all together
+                g1sub, g2sub = g3metrics.make_submissions_const_shear_batch(
+                    cval, 0., evaluate.MFID, evaluate.MFID, g1true, g2true, NGALS_PER_IMAGE,
+                    NOISE_SIGMA[obs_type], NTEST, rotate_cs=rotations)
+                qc[obs_type][:, jc] = scorer.scoreConstantBatch(g1sub, g2sub)["Q"]
                 print "Mean Q_c = "+str(qc[obs_type][:, jc].mean())+" for "+str(NTEST)+\
                         " sims (with c+ = "+str(cval)+", obs_type = "+str(obs_type)+")"
                 print
@@ -113,24 +101,14 @@ if __name__ == "__main__":
                 EXPERIMENT, obs_type, truth_dir=TRUTH_DIR)
             rotations = evaluate.get_generate_const_rotations(
                 EXPERIMENT, obs_type, truth_dir=TRUTH_DIR)
+            scorer = evaluate.BranchScorer(EXPERIMENT, obs_type, "constant", truth_dir=TRUTH_DIR)
             for jm, mval in enumerate(MVALS):
 
-                for itest in xrange(NTEST):
-
-                    # Build the submission
-                    g1sub, g2sub = g3metrics.make_submission_const_shear(
-                        evaluate.CFID, 0., mval, mval, g1true, g2true, NGALS_PER_IMAGE,
-                        NOISE_SIGMA[obs_type], rotate_cs=rotations)
-                    fdsub, subfile = tempfile.mkstemp(suffix=".dat")
-                    with os.fdopen(fdsub, "wb") as fsub:
-                        np.savetxt(fsub, np.array((subfield_index, g1sub, g2sub)).T, fmt="%d %e %e")
-                    # Then evaluate Q_c
-                    qm[obs_type][itest, jm] = evaluate.q_constant(
-                        subfile, EXPERIMENT, obs_type, just_q=True, truth_dir=TRUTH_DIR)
-                    os.remove(subfile)
-                    print "Test %4d / %4d (m = %.3e) Q_c = %.4f" % (
-                        itest+1, NTEST, mval, qm[obs_type][itest, jm])
-
+                # Build all NTEST submissions at once, then evaluate Q_c for them all together
+                g1sub, g2sub = g3metrics.make_submissions_const_shear_batch(
+                    evaluate.CFID, 0., mval, mval, g1true, g2true, NGALS_PER_IMAGE,
+                    NOISE_SIGMA[obs_type], NTEST, rotate_cs=rotations)
+                qm[obs_type][:, jm] = scorer.scoreConstantBatch(g1sub, g2sub)["Q"]
                 print "Mean Q_c = "+str(qm[obs_type][:, jm].mean())+" for "+str(NTEST)+\
                     " sims (with m = "+str(mval)+", obs_type = "+str(obs_type)+")"
                 print
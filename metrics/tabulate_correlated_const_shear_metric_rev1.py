@@ -32,7 +32,6 @@ See https://github.com/barnabytprowe/great3-public/wiki/The-revised-GREAT3-metri
 
 import sys
 import os
-import tempfile
 import numpy as np
 import g3metrics
 path, module = os.path.split(__file__)
@@ -100,23 +99,16 @@ if __name__ == "__main__":
                     EXPERIMENT, obs_type, truth_dir=TRUTH_DIR)
                 rotations = evaluate.get_generate_const_rotations(
                     EXPERIMENT, obs_type, truth_dir=TRUTH_DIR)
+                scorer = evaluate.BranchScorer(
+                    EXPERIMENT, obs_type, "constant", truth_dir=TRUTH_DIR)
                 for jc, cval in enumerate(CVALS):
 
                     # Build the submissions
                     g1sub, g2sub = g3metrics.make_multiple_submissions_const_shear(
                         cval, 0., evaluate.MFID, evaluate.MFID, g1true, g2true, NGALS_PER_IMAGE,
                         NOISE_SIGMA[obs_type], rotate_cs=rotations, nsubmissions=NTEST, rho=RHO)
-                    # Loop over submissions evaluating metric
-                    for itest in xrange(NTEST):
-
-                        fdsub, subfile = tempfile.mkstemp(suffix=".dat")
-                        with os.fdopen(fdsub, "wb") as fsub:
-                            np.savetxt(
-                                fsub, np.array((subfield_index, g1sub[:, itest],
-                                g2sub[:, itest])).T, fmt="%d %e %e")
-                        qc[obs_type][itest, jc] = evaluate.q_constant(
-                            subfile, EXPERIMENT, obs_type, just_q=True, truth_dir=TRUTH_DIR)
-                        os.remove(subfile)
+                    # Evaluate the metric for all the submissions at once
+                    qc[obs_type][:, jc] = scorer.scoreConstantBatch(g1sub.T, g2sub.T)["Q"]
 
                     print "mean(Q_c), std(Q_c) = "+str(qc[obs_type][:, jc].mean())+", "+\
                         str(qc[obs_type][:, jc].std())+" for "+str(NTEST)+" sims (with c+ = "+\
@@ -141,23 +133,16 @@ if __name__ == "__main__":
                     EXPERIMENT, obs_type, truth_dir=TRUTH_DIR)
                 rotations = evaluate.get_generate_const_rotations(
                     EXPERIMENT, obs_type, truth_dir=TRUTH_DIR)
+                scorer = evaluate.BranchScorer(
+                    EXPERIMENT, obs_type, "constant", truth_dir=TRUTH_DIR)
                 for jm, mval in enumerate(MVALS):
 
                     # Build the submissions
                     g1sub, g2sub = g3metrics.make_multiple_submissions_const_shear(
                         evaluate.CFID, 0., mval, mval, g1true, g2true, NGALS_PER_IMAGE,
                         NOISE_SIGMA[obs_type], rotate_cs=rotations, nsubmissions=NTEST, rho=RHO)
-                    # Loop over submissions evaluating the metric
-                    for itest in xrange(NTEST):
-
-                        fdsub, subfile = tempfile.mkstemp(suffix=".dat")
-                        with os.fdopen(fdsub, "wb") as fsub:
-                            np.savetxt(
-                                fsub, np.array((subfield_index, g1sub[:, itest],
-                                g2sub[:, itest],)).T, fmt="%d %e %e")
-                        qm[obs_type][itest, jm] = evaluate.q_constant(
-                            subfile, EXPERIMENT, obs_type, just_q=True, truth_dir=TRUTH_DIR)
-                        os.remove(subfile)
+                    # Evaluate the metric for all the submissions at once
+                    qm[obs_type][:, jm] = scorer.scoreConstantBatch(g1sub.T, g2sub.T)["Q"]
 
                     print "mean(Q_c), std(Q_c) = "+str(qm[obs_type][:, jm].mean())+", "+\
                         str(qm[obs_type][:, jm].std())+" for "+str(NTEST)+" sims (with m = "+\
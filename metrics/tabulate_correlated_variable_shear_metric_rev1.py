@@ -123,7 +123,6 @@ def write_submission(map_E_submission, outfile="test_submission.asc"):
 if __name__ == "__main__":
 
     import cPickle
-    import tempfile
     import pyfits
     import g3metrics
     import calculate_variable_cholesky
@@ -162,6 +161,8 @@ if __name__ == "__main__":
                         mape_file_prefix=evaluate.MAPEOBS_FILE_PREFIX,
                         file_prefixes=("galaxy_catalog", "galaxy_catalog"),
                         suffixes=("_intrinsic", ""), make_plots=False)
+                scorer = evaluate.BranchScorer(
+                    EXPERIMENT, obs_type, "variable", truth_dir=TRUTH_DIR)
                 # Get the unitc term
                 map_E_unitc = 2. * test_evaluate.make_unitc(
                     EXPERIMENT, obs_type, truth_dir=TRUTH_DIR)
@@ -171,15 +172,8 @@ if __name__ == "__main__":
                     # Build the submissions (includes inter-method and inter-bin correlations)
                     map_E_field_subs = make_multiple_variable_submissions(
                         NTEST, map_E_ref, map_E_unitc, cval, evaluate.MFID, cholesky)
-                    # Loop over submissions evaluating metric
-                    for itest in xrange(NTEST):
-
-                        fdsub, subfile = tempfile.mkstemp(suffix=".dat")
-                        os.close(fdsub)
-                        write_submission(map_E_field_subs[:, itest], outfile=subfile)
-                        qc[obs_type][itest, jc] = evaluate.q_variable(
-                            subfile, EXPERIMENT, obs_type, truth_dir=TRUTH_DIR)
-                        os.remove(subfile)
+                    # Evaluate the metric for all the submissions at once
+                    qc[obs_type][:, jc] = scorer.scoreVariableBatch(map_E_field_subs.T)["Q"]
 
                     print "mean(Q_v), std(Q_v) = "+str(qc[obs_type][:, jc].mean())+", "+\
                         str(qc[obs_type][:, jc].std())+" for "+str(NTEST)+" sims (with c = "+\
@@ -209,6 +203,8 @@ if __name__ == "__main__":
                         mape_file_prefix=evaluate.MAPEOBS_FILE_PREFIX,
                         file_prefixes=("galaxy_catalog", "galaxy_catalog"),
                         suffixes=("_intrinsic", ""), make_plots=False)
+                scorer = evaluate.BranchScorer(
+                    EXPERIMENT, obs_type, "variable", truth_dir=TRUTH_DIR)
                 # Get the unitc term
                 map_E_unitc = 2. * test_evaluate.make_unitc(
                     EXPERIMENT, obs_type, truth_dir=TRUTH_DIR)
@@ -218,15 +214,8 @@ if __name__ == "__main__":
                     # Build the submissions (includes inter-method and inter-bin correlations)
                     map_E_field_subs = make_multiple_variable_submissions(
                         NTEST, map_E_ref, map_E_unitc, evaluate.CFID, mval, cholesky)
-                    # Loop over submissions evaluating metric
-                    for itest in xrange(NTEST):
-
-                        fdsub, subfile = tempfile.mkstemp(suffix=".dat")
-                        os.close(fdsub)
-                        write_submission(map_E_field_subs[:, itest], outfile=subfile)
-                        qm[obs_type][itest, jm] = evaluate.q_variable(
-                            subfile, EXPERIMENT, obs_type, truth_dir=TRUTH_DIR)
-                        os.remove(subfile)
+                    # Evaluate the metric for all the submissions at once
+                    qm[obs_type][:, jm] = scorer.scoreVariableBatch(map_E_field_subs.T)["Q"]
 
                     print "mean(Q_v), std(Q_v) = "+str(qm[obs_type][:, jm].mean())+", "+\
                         str(qm[obs_type][:, jm].std())+" for "+str(NTEST)+" sims (with m = "+\
@@ -31,7 +31,6 @@ See https://github.com/barnabytprowe/great3-public/wiki/The-revised-GREAT3-metri
 
 import sys
 import os
-import tempfile
 import numpy as np
 import g3metrics
 path, module = os.path.split(__file__)
@@ -73,24 +72,22 @@ if __name__ == "__main__":
                 EXPERIMENT, obs_type, truth_dir=TRUTH_DIR)
             _, _, _, g1int, g2int = test_evaluate.get_variable_gsuffix(
                 EXPERIMENT, obs_type, truth_dir=TRUTH_DIR)           
+            # Use the FFT lattice calculation of map_E for the truth, as for the submissions below,
+            # so that both are calculated the same way
+            scorer = evaluate.BranchScorer(
+                EXPERIMENT, obs_type, "variable", truth_dir=TRUTH_DIR, usebins=evaluate.USEBINS,
+                use_lattice=True)
             for jc, cval in enumerate(CVALS):
 
+                # Build the map_E of all the submissions, then evaluate Q_v for them all together
+                map_E_subs = np.empty((NTEST, evaluate.NBINS_THETA * evaluate.NFIELDS))
                 for itest in xrange(NTEST):
 
-                    # Build the submission
-                    fdsub, subfile = tempfile.mkstemp(suffix=".dat")
-                    result = test_evaluate.make_variable_submission(
+                    map_E_subs[itest] = test_evaluate.make_variable_map_E(
                         x, y, g1true, g2true, g1int, g2int, cval, cval, evaluate.MFID,
-                        evaluate.MFID, outfile=subfile, noise_sigma=NOISE_SIGMA[obs_type])
-                    os.close(fdsub)
-                    # Then evaluate Q_v
-                    qc[obs_type][itest, jc] = evaluate.q_variable(
-                        subfile, EXPERIMENT, obs_type, usebins=evaluate.USEBINS,
-                        truth_dir=TRUTH_DIR)
-                    os.remove(subfile)
-                    print "Test %4d / %4d (c = %.3e) Q_v = %.4f" % (
-                        itest+1, NTEST, cval, qc[obs_type][itest, jc])
+                        evaluate.MFID, noise_sigma=NOISE_SIGMA[obs_type], use_lattice=True)[2]
 
+                qc[obs_type][:, jc] = scorer.scoreVariableBatch(map_E_subs)["Q"]
                 print "Mean Q_v = "+str(qc[obs_type][:, jc].mean())+" for "+str(NTEST)+\
                         " sims (with c = "+str(cval)+", obs_type = "+str(obs_type)+")"
                 print
@@ -115,24 +112,22 @@ if __name__ == "__main__":
                 EXPERIMENT, obs_type, truth_dir=TRUTH_DIR)
             _, _, _, g1int, g2int = test_evaluate.get_variable_gsuffix(
                 EXPERIMENT, obs_type, truth_dir=TRUTH_DIR)
+            # Use the FFT lattice calculation of map_E for the truth, as for the submissions below,
+            # so that both are calculated the same way
+            scorer = evaluate.BranchScorer(
+                EXPERIMENT, obs_type, "variable", truth_dir=TRUTH_DIR, usebins=evaluate.USEBINS,
+                use_lattice=True)
             for jm, mval in enumerate(MVALS):
 
+                # Build the map_E of all the submissions, then evaluate Q_v for them all together
+                map_E_subs = np.empty((NTEST, evaluate.NBINS_THETA * evaluate.NFIELDS))
                 for itest in xrange(NTEST):
 
-                    # Build the submission
-                    fdsub, subfile = tempfile.mkstemp(suffix=".dat")
-                    result = test_evaluate.make_variable_submission(
+                    map_E_subs[itest] = test_evaluate.make_variable_map_E(
                         x, y, g1true, g2true, g1int, g2int, evaluate.CFID, evaluate.CFID, mval,
-                        mval, outfile=subfile, noise_sigma=NOISE_SIGMA[obs_type])
-                    os.close(fdsub)
-                    # Then evaluate Q_v
-                    qm[obs_type][itest, jm] = evaluate.q_variable(
-                        subfile, EXPERIMENT, obs_type, usebins=evaluate.USEBINS,
-                        truth_dir=TRUTH_DIR)
-                    os.remove(subfile)
-                    print "Test %4d / %4d (m = %.3e) Q_v = %.4f" % (
-                        itest+1, NTEST, mval, qm[obs_type][itest, jm])
+                        mval, noise_sigma=NOISE_SIGMA[obs_type], use_lattice=True)[2]
 
+                qm[obs_type][:, jm] = scorer.scoreVariableBatch(map_E_subs)["Q"]
                 print "Mean Q_v = "+str(qm[obs_type][:, jm].mean())+" for "+str(NTEST)+\
                     " sims (with m = "+str(mval)+", obs_type = "+str(obs_type)+")"
                 print
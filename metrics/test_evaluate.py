@@ -163,6 +163,36 @@ def make_variable_submission(x, y, g1true, g2true, g1int, g2int, c1, c2, m1, m2,
 
     Saves to outfile in the format of Melanie's presubmission.py output.
     """
+    field, theta, map_E, map_B, maperr = make_variable_map_E(
+        x, y, g1true, g2true, g1int, g2int, c1, c2, m1, m2, noise_sigma=noise_sigma)
+    # Finally save in ASCII format
+    with open(outfile, "wb") as fout:
+
+        try:
+            hstring = \
+                "# Simulated aperture mass statistics for "+experiment+"-"+obs_type+"-variable\n"
+            fout.write(hstring)
+        except NameError: # If called externally then experiment and obs_type aren't defined.
+                          # Rather than recode all former uses of this func, simply handle the error
+                          # silently and move along...
+            pass
+        fout.write("# field_index  theta [deg]  map_E  map_B  maperr\n")
+        np.savetxt(
+            fout, np.array((field, theta, map_E, map_B, maperr)).T,
+            fmt=" %2d %.18e %.18e %.18e %.18e")
+    # Job done, return
+    return
+
+def make_variable_map_E(x, y, g1true, g2true, g1int, g2int, c1, c2, m1, m2, noise_sigma=0.05,
+                        use_lattice=False):
+    """Make the aperture mass statistics of a fake submission based on input x, y, true shears,
+    bias and noise parameters, without writing them to file.
+
+    If use_lattice is True the FFT calculation of evaluate.calculate_mapsq_lattice() is used, which
+    is much faster for the gridded variable shear fields.
+
+    Returns field, theta, map_E, map_B, maperr arrays, as written by make_variable_submission().
+    """
     # Some sanity checks to start
     if x.shape != (
         evaluate.NGALS_PER_SUBFIELD, evaluate.NSUBFIELDS_PER_FIELD, evaluate.NFIELDS):
@@ -187,17 +217,24 @@ def make_variable_submission(x, y, g1true, g2true, g1int, g2int, c1, c2, m1, m2,
 
         # Extracting the x, y and g1, g2 for all the subfields in this field, flatten and use
         # to calculate the map_E
-        map_results = evaluate.run_corr2(
+        args = (
             x[:, :, ifield].flatten(),
             y[:, :, ifield].flatten(),
             g1sub[:, :, ifield].flatten(),
             g2sub[:, :, ifield].flatten(),
-            np.ones_like(x[:, :, ifield]).flatten(),
-            min_sep=evaluate.THETA_MIN_DEG,
-            max_sep=evaluate.THETA_MAX_DEG,
-            nbins=evaluate.NBINS_THETA,
-            xy_units="degrees",
-            sep_units="degrees")
+            np.ones_like(x[:, :, ifield]).flatten())
+        kwargs = {
+            "min_sep": evaluate.THETA_MIN_DEG,
+            "max_sep": evaluate.THETA_MAX_DEG,
+            "nbins": evaluate.NBINS_THETA,
+            "xy_units": "degrees",
+            "sep_units": "degrees"}
+        if use_lattice:
+            map_results = evaluate.calculate_mapsq_lattice(
+                *args, lattice_spacing=evaluate.DX_GRID_DEG / evaluate.SUBFIELD_GRID_SUBSAMPLING,
+                **kwargs)
+        else:
+            map_results = evaluate.run_corr2(*args, **kwargs)
         theta[ifield * evaluate.NBINS_THETA: (ifield + 1) * evaluate.NBINS_THETA] = \
             map_results[:, 0]
         map_E[ifield * evaluate.NBINS_THETA: (ifield + 1) * evaluate.NBINS_THETA] = \
@@ -207,23 +244,7 @@ def make_variable_submission(x, y, g1true, g2true, g1int, g2int, c1, c2, m1, m2,
         maperr[ifield * evaluate.NBINS_THETA: (ifield + 1) * evaluate.NBINS_THETA] = \
             map_results[:, 5]
 
-    # Finally save in ASCII format
-    with open(outfile, "wb") as fout:
-
-        try:
-            hstring = \
-                "# Simulated aperture mass statistics for "+experiment+"-"+obs_type+"-variable\n"
-            fout.write(hstring)
-        except NameError: # If called externally then experiment and obs_type aren't defined.
-                          # Rather than recode all former uses of this func, simply handle the error
-                          # silently and move along...
-            pass
-        fout.write("# field_index  theta [deg]  map_E  map_B  maperr\n")
-        np.savetxt(
-            fout, np.array((field, theta, map_E, map_B, maperr)).T,
-            fmt=" %2d %.18e %.18e %.18e %.18e")
-    # Job done, return
-    return
+    return field, theta, map_E, map_B, maperr
 
 def make_unitc(experiment, obs_type, truth_dir=evaluate.TRUTH_DIR):
     """Make a variable submission to learn what a pure c1 or c2 looks like in map^2
@@ -0,0 +1,190 @@
+# Copyright (c) 2014, the GREAT3 executive committee (http://www.great3challenge.info/?q=contacts)
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification, are permitted
+# provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this list of conditions
+# and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice, this list of
+# conditions and the following disclaimer in the documentation and/or other materials provided with
+# the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors may be used to
+# endorse or promote products derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+# FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER
+# IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT
+# OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""@file test_mapsq.py
+
+Regression tests for the in-process calculations of the aperture mass dispersion in evaluate.py,
+calculate_mapsq() and calculate_mapsq_lattice(), against a brute-force count of all pairs.
+
+These can be run with pytest, or as a script.
+"""
+
+import numpy as np
+import evaluate
+
+MIN_SEP = 0.02  # Separation bins used for the tests, in degrees
+MAX_SEP = 1.
+NBINS = 8
+
+def brute_force_mapsq(x, y, e1, e2, w, min_sep=MIN_SEP, max_sep=MAX_SEP, nbins=NBINS):
+    """Calculate the aperture mass dispersion by binning every pair of galaxies exactly, and
+    integrating with the same filters as evaluate.calculate_mapsq().
+    """
+    gc = e1 + e2 * 1j
+    ia, ib = np.triu_indices(len(x), 1)
+    dc = (x[ib] - x[ia]) + (y[ib] - y[ia]) * 1j
+    rd = np.abs(dc)
+    use = (rd >= min_sep) & (rd < max_sep)
+    ia = ia[use]
+    ib = ib[use]
+    dc = dc[use]
+    bin_size = np.log(float(max_sep) / float(min_sep)) / nbins
+    kbin = np.clip((np.log(rd[use] / min_sep) / bin_size).astype(int), 0, nbins - 1)
+    wab = w[ia] * w[ib]
+    xipd = wab * gc[ia] * gc[ib].conj()
+    ximd = wab * gc[ia] * gc[ib] * (dc.conj() / np.abs(dc))**4
+    npairs = np.bincount(kbin, weights=wab, minlength=nbins)
+    xip = (np.bincount(kbin, weights=xipd.real, minlength=nbins) +
+           np.bincount(kbin, weights=xipd.imag, minlength=nbins) * 1j)
+    xim = (np.bincount(kbin, weights=ximd.real, minlength=nbins) +
+           np.bincount(kbin, weights=ximd.imag, minlength=nbins) * 1j)
+    r = min_sep * np.exp((np.arange(nbins) + 0.5) * bin_size)
+    return evaluate._calculate_mapsq_from_xi(r, bin_size, npairs, xip, xim, w, gc)
+
+def make_shears(x, y, rng):
+    """Make a shear catalog with a smooth, correlated component plus shape noise."""
+    n = len(x)
+    e1 = 0.05 * np.sin(6. * x) + rng.normal(0., 0.1, n)
+    e2 = 0.05 * np.cos(5. * y) + rng.normal(0., 0.1, n)
+    w = rng.uniform(0.5, 1.5, n)
+    return e1, e2, w
+
+def test_calculate_mapsq():
+    """Check that calculate_mapsq() agrees with the brute-force pair count for galaxies at random
+    positions: there are few enough of them that it should compare every pair in every bin too.
+    """
+    rng = np.random.RandomState(31415)
+    for trial in range(3):
+
+        x = rng.uniform(0., 1., 500)
+        y = rng.uniform(0., 1., 500)
+        e1, e2, w = make_shears(x, y, rng)
+        # One galaxy flagged as bad, which both calculations should ignore
+        e1[0] = 10.
+        use = e1 < 10.
+        results = evaluate.calculate_mapsq(
+            x, y, e1, e2, w, min_sep=MIN_SEP, max_sep=MAX_SEP, nbins=NBINS)
+        expected = brute_force_mapsq(x[use], y[use], e1[use], e2[use], w[use])
+        np.testing.assert_allclose(results[:, 0], expected[:, 0])
+        diff = np.abs(results[:, 1:3] - expected[:, 1:3]) / expected[:, 5:6]
+        assert diff.max() < 1.e-8, "calculate_mapsq() differs by up to %g sigma" % diff.max()
+
+def test_calculate_mapsq_grid():
+    """Check that calculate_mapsq() agrees with the brute-force pair count to a small fraction of
+    the statistical error when it has to use grids for the larger separations, as it does for the
+    galaxies here when the grids are limited to 256 x 256 cells.
+    """
+    rng = np.random.RandomState(14142)
+    x = rng.uniform(0., 1., 3000)
+    y = rng.uniform(0., 1., 3000)
+    e1, e2, w = make_shears(x, y, rng)
+    results = evaluate.calculate_mapsq(
+        x, y, e1, e2, w, min_sep=MIN_SEP, max_sep=MAX_SEP, nbins=NBINS, max_grid_size=256)
+    expected = brute_force_mapsq(x, y, e1, e2, w)
+    np.testing.assert_allclose(results[:, 0], expected[:, 0])
+    diff = np.abs(results[:, 1:3] - expected[:, 1:3]) / expected[:, 5:6]
+    assert diff.max() < 0.25, "calculate_mapsq() differs by up to %g sigma" % diff.max()
+
+def test_calculate_mapsq_field():
+    """Check that calculate_mapsq() agrees with calculate_mapsq_lattice() to a small fraction of the
+    statistical error for a field the size of those in variable shear branches, with the default
+    separation bins: 20 subfields of 100 x 100 galaxies 0.1 degrees apart, each offset from the
+    first by a different multiple of 1/7 of the spacing, with a power-law shear field plus shape
+    noise.
+    """
+    rng = np.random.RandomState(17320)
+    nsub = 7
+    nfine = 100 * nsub
+    # Positions on the finer lattice that the subfields all lie on
+    offsets = rng.permutation(nsub * nsub)[:20]
+    ix, iy = np.meshgrid(np.arange(0, nfine, nsub), np.arange(0, nfine, nsub))
+    ix = (ix.flatten()[None, :] + (offsets % nsub)[:, None]).flatten()
+    iy = (iy.flatten()[None, :] + (offsets // nsub)[:, None]).flatten()
+    # Shears with a power spectrum P(k) ~ k^-1.5, normalized to an rms of 0.03, plus shape noise
+    kx, ky = np.meshgrid(np.fft.fftfreq(nfine), np.fft.fftfreq(nfine))
+    ksq = kx**2 + ky**2
+    ksq[0, 0] = 1.
+    kappa = np.fft.fft2(rng.normal(size=(nfine, nfine))) * ksq**(-0.375)
+    kappa[0, 0] = 0.
+    g = np.fft.ifft2(kappa * ((kx**2 - ky**2) + 2j * kx * ky) / ksq)
+    g *= 0.03 / g.std()
+    n = len(ix)
+    e1 = g.real[iy, ix] + rng.normal(0., 0.2, n)
+    e2 = g.imag[iy, ix] + rng.normal(0., 0.2, n)
+    w = np.ones(n)
+    spacing = 0.1 / nsub
+    x = 0.05 + spacing * ix
+    y = 0.05 + spacing * iy
+    results = evaluate.calculate_mapsq(x, y, e1, e2, w)
+    expected = evaluate.calculate_mapsq_lattice(x, y, e1, e2, w, spacing)
+    np.testing.assert_allclose(results[:, 0], expected[:, 0])
+    diff = np.abs(results[:, 1:3] - expected[:, 1:3]) / expected[:, 5:6]
+    assert diff.max() < 0.25, "calculate_mapsq() differs by up to %g sigma" % diff.max()
+
+def test_calculate_mapsq_lattice():
+    """Check that calculate_mapsq_lattice() agrees with the brute-force pair count, which it should
+    to within round-off, for a lattice with some bins that have no pairs: the galaxies are in two
+    separate patches, so there are no pairs with separations between the size of a patch and the
+    distance between them, even though the lattice has many such separations.
+    """
+    rng = np.random.RandomState(16180)
+    spacing = 0.021
+    ix, iy = np.meshgrid(np.arange(3), np.arange(3))
+    ix = np.concatenate([ix.flatten(), ix.flatten() + 30])
+    iy = np.concatenate([iy.flatten(), iy.flatten() + 5])
+    # Offset the lattice from the origin, as for the subfields of a field
+    x = 0.3 + spacing * ix
+    y = -0.2 + spacing * iy
+    e1, e2, w = make_shears(x, y, rng)
+    results = evaluate.calculate_mapsq_lattice(
+        x, y, e1, e2, w, spacing, min_sep=MIN_SEP, max_sep=MAX_SEP, nbins=NBINS)
+    # Bins 3 to 5 (separations of 0.087 to 0.38 degrees) have no pairs
+    expected = brute_force_mapsq(x, y, e1, e2, w)
+    # The imaginary part of g_a g_b^* changes sign if a and b are swapped, so <MMx> depends on the
+    # order in which each pair is counted; compare the other columns
+    cols = [0, 1, 2, 5, 6, 7]
+    scale = np.abs(expected[:, cols]).max(axis=0)
+    np.testing.assert_allclose(
+        results[:, cols] / scale, expected[:, cols] / scale, rtol=0., atol=1.e-10)
+
+def test_run_corr2_in_process():
+    """Check that run_corr2() with corr2_executable=None uses calculate_mapsq()."""
+    rng = np.random.RandomState(27182)
+    x = rng.uniform(0., 1., 300)
+    y = rng.uniform(0., 1., 300)
+    e1, e2, w = make_shears(x, y, rng)
+    results = evaluate.run_corr2(
+        x, y, e1, e2, w, min_sep=MIN_SEP, max_sep=MAX_SEP, nbins=NBINS, corr2_executable=None)
+    expected = evaluate.calculate_mapsq(
+        x, y, e1, e2, w, min_sep=MIN_SEP, max_sep=MAX_SEP, nbins=NBINS)
+    np.testing.assert_array_equal(results, expected)
+
+if __name__ == "__main__":
+
+    test_calculate_mapsq()
+    test_calculate_mapsq_grid()
+    test_calculate_mapsq_field()
+    test_calculate_mapsq_lattice()
+    test_run_corr2_in_process()
+    print "All tests passed"
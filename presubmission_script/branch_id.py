@@ -245,7 +245,8 @@ y_offset = {'control-ground-variable':
 def expected_galaxy_ids(branch):
     """
     Builds a list of galaxy IDs to compare user catalogs against, using known offsets if a 
-    variable-shear branch.
+    variable-shear branch.  Note that this is a list of 2 million strings: to check a catalog,
+    unexpected_galaxy_ids() is much faster and uses far less memory.
     """
     if 'constant' in branch:
         expected_galaxy_id = ['%09i'%(1000000*k+1000*j+i) for i in range(100) 
@@ -257,4 +258,83 @@ def expected_galaxy_ids(branch):
                                              for i in range(100) for j in range(100) 
                                              for k in range(200)]                                                           
     return expected_galaxy_id
-    
+
+# Galaxy IDs have the form SSSXXXYYY: the subfield number, followed by the x and y grid indices of
+# the galaxy, which run over 0-99 in the constant shear branches and over the offset positions
+# x_offset + 7*(0-99), y_offset + 7*(0-99) on the 7x finer grid of the variable shear branches.
+nsubfields = 200
+ngrid = 100
+grid_subsampling = 7
+
+def decode_galaxy_id(galaxy_id):
+    """
+    Split an integer galaxy ID (or a NumPy array of them) into its subfield number and x and y grid
+    indices.
+    """
+    return galaxy_id // 1000000, (galaxy_id // 1000) % 1000, galaxy_id % 1000
+
+def is_expected_galaxy_id(branch, galaxy_id):
+    """
+    Return True if the integer galaxy ID is one of the galaxy IDs in the given branch.  The ID is
+    decoded and checked arithmetically, rather than looked up in the list of expected IDs.
+    """
+    subfield, x, y = decode_galaxy_id(galaxy_id)
+    if subfield < 0 or subfield >= nsubfields:
+        return False
+    if 'constant' in branch:
+        return x < ngrid and y < ngrid
+    x -= x_offset[branch][subfield]
+    y -= y_offset[branch][subfield]
+    return (x >= 0 and y >= 0 and x % grid_subsampling == 0 and y % grid_subsampling == 0 and
+            x < ngrid*grid_subsampling and y < ngrid*grid_subsampling)
+
+def expected_galaxy_id_mask(branch, galaxy_ids):
+    """
+    Return a NumPy boolean array which is True where the NumPy array of integer galaxy IDs are
+    galaxy IDs in the given branch, checking them all at once as in is_expected_galaxy_id().
+    """
+    import numpy
+    subfield, x, y = decode_galaxy_id(galaxy_ids)
+    good = (subfield >= 0) & (subfield < nsubfields)
+    if 'constant' in branch:
+        good &= (x < ngrid) & (y < ngrid)
+    else:
+        subfield = numpy.where(good, subfield, 0)
+        x = x - numpy.asarray(x_offset[branch])[subfield]
+        y = y - numpy.asarray(y_offset[branch])[subfield]
+        good &= ((x >= 0) & (y >= 0) & (x % grid_subsampling == 0) & (y % grid_subsampling == 0) &
+                 (x < ngrid*grid_subsampling) & (y < ngrid*grid_subsampling))
+    return good
+
+def unexpected_galaxy_ids(branch, galaxy_ids):
+    """
+    Return a list of those integer galaxy IDs that are not galaxy IDs in the given branch.  If
+    there are no duplicates among the galaxy_ids and there are as many of them as galaxies in the
+    branch, an empty list means that they are exactly the set of expected galaxy IDs.  All the IDs
+    are checked at once using NumPy if it is available.
+    """
+    try:
+        import numpy
+    except ImportError:
+        return [gid for gid in galaxy_ids if not is_expected_galaxy_id(branch, gid)]
+    galaxy_ids = numpy.asarray(galaxy_ids, dtype=numpy.int64)
+    return galaxy_ids[~expected_galaxy_id_mask(branch, galaxy_ids)].tolist()
+
+def galaxy_index(branch, galaxy_id):
+    """
+    Return the position of an expected integer galaxy ID (or a NumPy array of them) in a compact
+    numbering of all the galaxies in the given branch, from 0 to nsubfields*ngrid**2-1, e.g. for
+    keeping track of which galaxies have been seen.
+    """
+    subfield, x, y = decode_galaxy_id(galaxy_id)
+    if 'constant' not in branch:
+        if hasattr(subfield, 'shape'): # NumPy array
+            import numpy
+            x = x - numpy.asarray(x_offset[branch])[subfield]
+            y = y - numpy.asarray(y_offset[branch])[subfield]
+        else:
+            x -= x_offset[branch][subfield]
+            y -= y_offset[branch][subfield]
+        x //= grid_subsampling
+        y //= grid_subsampling
+    return (subfield*ngrid + x)*ngrid + y
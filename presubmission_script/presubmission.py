@@ -36,6 +36,7 @@ import math
 import sys
 import branch_id
 import os
+import itertools
 from collections import defaultdict
 has_fits_handler = False
 try:
@@ -53,6 +54,13 @@ except ImportError as err:
     except ImportError as err:
         # Neither pyfits nor astropy found
         has_fits_handler = False
+# NumPy is not required to read ASCII catalogs, but if it is available it is used to read and check
+# them much faster
+try:
+    import numpy
+    has_numpy = True
+except ImportError as err:
+    has_numpy = False
 
 # Various parameters relating to the size of the input images and structure of the subfields
 image_size_deg = 10. # Image size in degrees
@@ -146,7 +154,7 @@ def get_branch(file_list):
                            
 def get_gridpoint(gid):
     """
-    Given a 3-digit galaxy ID subnumber, return the angular position
+    Given a 3-digit galaxy ID subnumber (as a string or integer), return the angular position
     """
     return int(gid)*image_size_deg / (nrows * subfield_grid_subsampling)
     
@@ -164,9 +172,9 @@ def get_column_number(number=-1,name='',default_index=-1):
     print '  Column containing', name, 'is', number
     return number
  
-def get_list_from_fitsfile(arr,column,filename):
+def get_column_from_fitsfile(arr,column,filename):
     try:
-        return list(arr.field(column))
+        return numpy.asarray(arr.field(column))
     except KeyError:
         raise KeyError('Column %s not found in file %s'%(column,filename))
     except IndexError:
@@ -200,6 +208,244 @@ def readfile(filename, comment_identifier='#'):
     with open(filename) as f:
         return [line.split() for line in f if line[0:lenc]!=comment_identifier]
     
+def count_fields(text, nlines):
+    """
+    Return a NumPy array of the number of whitespace-separated fields on each of the nlines lines of
+    the given text, without splitting the lines one by one.
+    """
+    chars = numpy.frombuffer(text, dtype=numpy.uint8)
+    newline = chars == ord('\n')
+    space = newline | (chars == ord(' ')) | ((chars >= ord('\t')) & (chars <= ord('\r')))
+    # A field starts at each non-space character that follows a space or the start of the text
+    starts = ~space
+    starts[1:] &= space[:-1]
+    line_index = numpy.cumsum(newline) - newline
+    return numpy.bincount(line_index[starts], minlength=nlines)[:nlines]
+
+def read_catalog_chunks(filename, columns, is_fitsfile, comment_identifier='#', hdu_number=1,
+                        chunk_size=100000):
+    """
+    Read the given columns of a shear catalog in chunks of up to chunk_size rows, so that the whole
+    catalog never has to be held in memory as lists of strings.  This is a generator yielding, for
+    each chunk, a list of the requested columns as NumPy float arrays if NumPy is available, or
+    as lists of floats otherwise.  Columns are given by number, or by name for FITS files.  When
+    all the lines of a chunk of an ASCII file have the same number of fields (as counted by
+    count_fields()), which is the usual case, they are parsed all at once by numpy.fromstring.
+    """
+    if is_fitsfile:
+        data = readfitsfile(filename, hdu_number=hdu_number)
+        arrays = [get_column_from_fitsfile(data, column, filename) for column in columns]
+        for start in range(0, len(arrays[0]), chunk_size):
+            yield [array[start:start+chunk_size].astype(float) for array in arrays]
+        return
+    lenc = len(comment_identifier)
+    ncolumns = max(columns)+1
+    with open(filename) as f:
+        while True:
+            lines = list(itertools.islice(f, chunk_size))
+            if not lines:
+                break
+            lines = [line for line in lines if line[0:lenc]!=comment_identifier]
+            if not lines:
+                continue
+            if has_numpy:
+                text = ''.join(lines)
+                nfields = count_fields(text, len(lines))
+                if nfields.min() == nfields.max() >= ncolumns:
+                    data = numpy.fromstring(text, sep=' ')
+                    if data.size == nfields[0]*len(lines):
+                        data = data.reshape(len(lines), nfields[0])
+                        yield [data[:, column] for column in columns]
+                        continue
+            # Lines with differing numbers of fields (or no NumPy): split them one by one, skipping
+            # blank lines
+            rows = [row for row in [line.split() for line in lines] if row]
+            if not rows:
+                continue
+            if min([len(row) for row in rows]) < ncolumns:
+                raise RuntimeError('Requested column %i is greater than the number of columns in '
+                                   'file %s'%(ncolumns-1,filename))
+            chunk = [[float(row[column]) for row in rows] for column in columns]
+            if has_numpy:
+                chunk = [numpy.array(column) for column in chunk]
+            yield chunk
+
+def _read_catalog_file(args):
+    """
+    Read all the chunks of a shear catalog at once, for reading catalogs in parallel.
+    """
+    return list(read_catalog_chunks(*args))
+
+class ShearCatalogAccumulator(object):
+    """
+    Accumulates the galaxies of a branch from chunks of its shear catalogs (see
+    read_catalog_chunks()), keeping only what is needed to check the catalogs and to compute the
+    summary statistics: the number of galaxies per subfield, which of the expected galaxy IDs have
+    been seen, and either per-field sums of the weighted shears (constant-shear branches) or
+    per-field positions, shears and weights (variable-shear branches).  If NumPy is available, each
+    chunk is processed all at once.
+    """
+    def __init__(self, branch):
+        self.branch = branch
+        self.variable = 'constant' not in branch
+        self.ngals = 0
+        self.subfield_counts = defaultdict(int)
+        self.unexpected_ids = []
+        self.nduplicates = 0
+        nexpected = branch_id.nsubfields*branch_id.ngrid**2
+        if has_numpy:
+            self.seen = numpy.zeros(nexpected, dtype=bool)
+        else:
+            self.seen = bytearray(nexpected)
+        # For constant-shear branches, the sums of g1*weight, weight, g2*weight and weight for each
+        # field, excluding shears >= 9.9 (which flag galaxies without shear estimates)
+        self.sums = defaultdict(lambda: [0., 0., 0., 0.])
+        # For variable-shear branches, lists of the x, y, g1, g2 and weight for each field (in
+        # chunks, if using NumPy)
+        self.columns = defaultdict(lambda: ([], [], [], [], []))
+
+    def add(self, galaxy_id, g1, g2, weight=None):
+        """
+        Add a chunk of galaxies, given sequences of their galaxy IDs, g1, g2 and (optionally)
+        weights.
+        """
+        if has_numpy:
+            self._add_arrays(galaxy_id, g1, g2, weight)
+        else:
+            self._add_lists(galaxy_id, g1, g2, weight)
+
+    def _add_arrays(self, galaxy_id, g1, g2, weight):
+        # Turn the IDs into ints (via float and round in case they were read in as floats)
+        galaxy_id = numpy.round(numpy.asarray(galaxy_id, dtype=float)).astype(numpy.int64)
+        g1 = numpy.asarray(g1, dtype=float)
+        g2 = numpy.asarray(g2, dtype=float)
+        if weight is None:
+            weight = numpy.ones_like(g1)
+        else:
+            weight = numpy.asarray(weight, dtype=float)
+        self.ngals += len(galaxy_id)
+        subfield = branch_id.decode_galaxy_id(galaxy_id)[0]
+        for sub, count in zip(*[a.tolist() for a in numpy.unique(subfield, return_counts=True)]):
+            self.subfield_counts[sub] += count
+        # Set aside any unexpected galaxy IDs (which are an error anyway), then check for duplicates
+        good = branch_id.expected_galaxy_id_mask(self.branch, galaxy_id)
+        if not good.all():
+            self.unexpected_ids += galaxy_id[~good].tolist()
+            galaxy_id, g1, g2, weight = [a[good] for a in (galaxy_id, g1, g2, weight)]
+        index = numpy.unique(branch_id.galaxy_index(self.branch, galaxy_id))
+        self.nduplicates += len(galaxy_id)-len(index)+numpy.count_nonzero(self.seen[index])
+        self.seen[index] = True
+        subfield, xnum, ynum = branch_id.decode_galaxy_id(galaxy_id)
+        field = subfield // nsubfields_per_field[self.branch]
+        if self.variable:
+            x = xnum*image_size_deg / (nrows * subfield_grid_subsampling)
+            y = ynum*image_size_deg / (nrows * subfield_grid_subsampling)
+            for f in numpy.unique(field).tolist():
+                in_field = field==f
+                for column, values in zip(self.columns[f], (x, y, g1, g2, weight)):
+                    column.append(values[in_field])
+        else:
+            nfields = nfields_per_branch[self.branch]
+            use1 = g1<9.9
+            use2 = g2<9.9
+            sums = [numpy.bincount(field[use1], weights=(g1*weight)[use1], minlength=nfields),
+                    numpy.bincount(field[use1], weights=weight[use1], minlength=nfields),
+                    numpy.bincount(field[use2], weights=(g2*weight)[use2], minlength=nfields),
+                    numpy.bincount(field[use2], weights=weight[use2], minlength=nfields)]
+            for f in numpy.unique(field).tolist():
+                self.sums[f] = [total+float(s[f]) for total, s in zip(self.sums[f], sums)]
+
+    def _add_lists(self, galaxy_id, g1, g2, weight):
+        if weight is None:
+            weight = [1.]*len(g1)
+        for gid, g1i, g2i, wi in zip(galaxy_id, g1, g2, weight):
+            gid = int(round(float(gid)))
+            subfield, xnum, ynum = branch_id.decode_galaxy_id(gid)
+            self.ngals += 1
+            self.subfield_counts[subfield] += 1
+            if not branch_id.is_expected_galaxy_id(self.branch, gid):
+                self.unexpected_ids.append(gid)
+                continue
+            index = branch_id.galaxy_index(self.branch, gid)
+            if self.seen[index]:
+                self.nduplicates += 1
+            self.seen[index] = 1
+            field = subfield // nsubfields_per_field[self.branch]
+            g1i, g2i, wi = float(g1i), float(g2i), float(wi)
+            if self.variable:
+                for column, value in zip(self.columns[field], 
+                                         (get_gridpoint(xnum), get_gridpoint(ynum), g1i, g2i, wi)):
+                    column.append(value)
+            else:
+                sums = self.sums[field]
+                if g1i<9.9:
+                    sums[0] += g1i*wi
+                    sums[1] += wi
+                if g2i<9.9:
+                    sums[2] += g2i*wi
+                    sums[3] += wi
+
+    def check(self):
+        """
+        Check that the galaxies added are exactly the galaxies in the branch, raising a
+        RuntimeError if not.
+        """
+        # Start by checking that the correct total number of galaxies appears.
+        ngals = (nfields_per_branch[self.branch]*nsubfields_per_field[self.branch]*
+                 ngalaxies_per_subfield)
+        if self.ngals!=ngals:
+            raise RuntimeError('Incorrect number of galaxies: %i instead of the expected %i.  '
+                               'Please check your shear catalogs for completeness and make sure '
+                               "you have only included one branch's worth of galaxies, then run "
+                               'this script again.'%(self.ngals,ngals))
+        # Check that the correct number of fields was found.  (These intermediate steps are to help
+        # pin down the problem for people who have the correct number of galaxies, but they're
+        # distributed in some odd way.)
+        field_counts = defaultdict(int)
+        for subfield in self.subfield_counts:
+            field_counts[subfield // nsubfields_per_field[self.branch]] += \
+                self.subfield_counts[subfield]
+        if len(field_counts)!=nfields_per_branch[self.branch]:
+            raise RuntimeError('Incorrect number of fields--please check your shear catalogs and '
+                               'try again.')
+        for field in field_counts:
+            # Check that each field has the correct number of galaxies
+            if field_counts[field]!=nsubfields_per_field[self.branch]*ngalaxies_per_subfield:
+                raise RuntimeError('Incorrect number of subfields in field %s--please check your '
+                                   'shear catalogs and try again.'%field)
+        # Check that each subfield has the correct number of galaxies
+        for subfield in self.subfield_counts:
+            if self.subfield_counts[subfield]!=ngalaxies_per_subfield:
+                raise RuntimeError('Incorrect number of galaxies in subfield %s--please check your '
+                                   'shear catalogs and try again.'%subfield)
+        # Now, check uniqueness of galaxy IDs
+        if self.nduplicates or len(set(self.unexpected_ids))!=len(self.unexpected_ids):
+            raise RuntimeError('Duplicate galaxy IDs found.  Please check your catalog for '
+                               'uniqueness of galaxy IDs.')
+        # and, finally, check that the set of galaxy IDs is the expected set of galaxy IDs.  Since
+        # we have the right number of unique IDs, it is enough that every one of them is expected.
+        if self.unexpected_ids:
+            raise RuntimeError('%i unexpected galaxy IDs found (e.g. %09i).  Please check that '
+                               'your galaxy IDS are the same as the catalogs distributed with the '
+                               'Great3 simulations, and that you have passed the correct '
+                               'branch name.'%(len(self.unexpected_ids),self.unexpected_ids[0]))
+
+    def fields(self):
+        """
+        Return a sorted list of the fields with galaxies.
+        """
+        if self.variable:
+            return sorted(self.columns)
+        return sorted(self.sums)
+
+    def field_columns(self, field):
+        """
+        Return the x, y, g1, g2 and weight of the galaxies in a field of a variable-shear branch.
+        """
+        if has_numpy:
+            return [numpy.concatenate(column) for column in self.columns[field]]
+        return self.columns[field]
+
 def count_items(items):
     """
     Given a list of items, return a dict whose keys are the elements of the list and whose values
@@ -366,15 +612,24 @@ def print_constant_summary(file_object,field,g1,g2,weight):
     sumg1weight = sum([a[1] for a in zip(g1,weight) if a[0]<9.9])
     g2_weight = [a[0]*a[1] for a in zip(g2,weight) if a[0]<9.9]
     sumg2weight = sum([a[1] for a in zip(g2,weight) if a[0]<9.9])
+    print_constant_summary_from_sums(
+        file_object,field,sum(g1_weight),sumg1weight,sum(g2_weight),sumg2weight)
+
+def print_constant_summary_from_sums(file_object,field,g1_weight,sumg1weight,g2_weight,
+                                     sumg2weight):
+    """
+    Print the average g1 and g2 shears for the field to the given file_object, given the sums of
+    the weighted shears and of the weights.
+    """
     file_object.write(str(field)+' '+
-                      str(sum(g1_weight)/sumg1weight)+' '+
-                      str(sum(g2_weight)/sumg2weight)+'\n')    
+                      str(float(g1_weight)/sumg1weight)+' '+
+                      str(float(g2_weight)/sumg2weight)+'\n')    
     
 def generate_submission_files(args):
     """
     Take command-line input parsed into the object 'args' and generate a submission file for the
     branch covered by the input shear file(s).  This function performs the following tasks:
-        - Read in the given file(s)
+        - Read in the given file(s), a chunk at a time (several files at once if args.nproc > 1)
         - Determine which field each galaxy belongs to based on the subfield it comes from
         - Determine the nearest gridpoint/fiducial galaxy position based on the given galaxy ID,
           if the branch type is variable shear
@@ -439,12 +694,6 @@ def generate_submission_files(args):
             g2_column-=1
         if weight_column and not isinstance(weight_column,str):
             weight_column-=1
-    # Determine the largest column we'll be requesting, to check the files for proper size later.
-    max_column = 0
-    for col in (id_column,g1_column,g1_column,weight_column):
-        if col and not isinstance(col,str):
-            max_column = max(max_column,col)
-
     # Check if all of the files are fits files--due to differences in column-index handling,
     # it's not possible to mix the two.
     if args.use_fits:
@@ -463,8 +712,9 @@ def generate_submission_files(args):
         else:
             raise RuntimeError('Some, but not all, requested shear catalogs are FITS files.  '
                                'Please call this script with only ASCII or only FITS files.')
-    # Read in all the shear information
-    shear_info = []
+    columns = [id_column,g1_column,g2_column]
+    if weight_column:
+        columns.append(weight_column)
     if is_fitsfile:
         if nfiles==1:
             print 'Catalog file determined to be FITS file...'
@@ -473,126 +723,47 @@ def generate_submission_files(args):
         if not has_fits_handler:
             raise IOError('No FITS handler found.  Please install pyfits or astropy and rerun, or '
                             'convert catalogs to ASCII format.')
-        for ifn, filename in enumerate(args.file_list):
-            # So that we don't have to deal with processing issues later with NumPy arrays vs
-            # lists of lists, read the FITS file(s) and then convert the data we want into
-            # a list of lists.  Once this is done, rewrite the column numbers so the rest of
-            # the program works properly.  (This is why the script can't handle both FITS
-            # and ASCII files at once.)
-            if ifn%20==0 or ifn==nfiles-1:
-                print 'Reading file', str(ifn+1)+'/'+str(nfiles), '...'
-            newdata = readfitsfile(filename)
-            gid = get_list_from_fitsfile(newdata, id_column, filename)
-            g1 = get_list_from_fitsfile(newdata, g1_column, filename)
-            g2 = get_list_from_fitsfile(newdata, g2_column, filename)
-            if weight_column:
-                w = get_list_from_fitsfile(newdata, weight_column, filename)
-            if weight_column:
-                shear_info+=zip(gid,g1,g2,w)
-            else:
-                shear_info+=zip(gid,g1,g2)
-        id_column = 0
-        g1_column = 1
-        g2_column = 2
-        if weight_column:
-            weight_column = 3
     else:
-        if (isinstance(id_column,str) or isinstance(g1_column,str) or 
-            isinstance(g2_column,str) or isinstance(weight_column,str)):
+        if [col for col in columns if isinstance(col,str)]:
             raise RuntimeError('Some column IDs given as strings, which is not allowed for ASCII '
                                'catalog files.  Please use integer column numbers.')
-        for ifn,filename in enumerate(args.file_list):
-            if ifn%20==0 or ifn==nfiles-1:
-                print 'Reading file', str(ifn+1)+'/'+str(nfiles), '...'
-            newdata = readfile(filename, comment_identifier=args.comment_identifier)
-            shear_info+=newdata
-            min_column = min([len(si) for si in shear_info]) # Returns shortest row in the table
-            if max_column >= min_column:
-                raise RuntimeError('Requested column %i is greater than the number of columns in '
-                                   'file %s'%(max_column+fmod,filename))
-    print 'All files read.'
-    print 'Checking for correct galaxy IDs... (this may take a while)'
-    # Check that each submitted branch has all its galaxies submitted.
-    # Start by checking that the correct total numbre of galaxies appears.
-    ngals = nfields_per_branch[args.branch]*nsubfields_per_field[args.branch]*ngalaxies_per_subfield
-    if len(shear_info)!=ngals:
-        raise RuntimeError('Incorrect number of galaxies: %i instead of the expected %i.  Please '
-                           'check your shear catalogs for completeness and make sure you have '
-                           "only included one branch's worth of galaxies, then run this script "
-                           'again.'%(len(shear_info),ngals))
-    # To parse the next line: take the id_column of shear_info, turn it into an int (via float and
-    # round in case it was read in as a float from a FITS file), zero-pad it, take the first 3 
-    # characters of the resulting string, and turn those into an int.  (Just in case the catalog 
-    # formatting has stripped the leading 0s!)
-    galaxy_id = ['%09i'%int(round(float(si[id_column]))) for si in shear_info]
-    subfield_id = [int(gid[:3]) for gid in galaxy_id]
-    field_id = get_field_id(subfield_id,branch=args.branch)
-    nitems = count_items(field_id)       # count_items returns a defaultdict of the count of each
-    fields = [field for field in nitems] # item in the list that gets passed to it
-    # Check that the correct number of fields was found in count_items.
-    # (These intermediate steps are to help pin down the problem for people who have the correct
-    # number of galaxies, but they're distributed in some odd way.)
-    if len(fields)!=nfields_per_branch[args.branch]:
-        raise RuntimeError('Incorrect number of fields--please check your shear catalogs and '
-                           'try again.')
-    for field in nitems: # remember, nitems is currently the dict of ngalaxies per field      
-        # Check that each field has the correct number of galaxies
-        if nitems[field]!=nsubfields_per_field[args.branch]*ngalaxies_per_subfield:
-            raise RuntimeError('Incorrect number of subfields in field %s--please check your '
-                               'shear catalogs and try again.'%field)
-    nitems = count_items(subfield_id) 
-    # Check that each subfield has the correct number of galaxies
-    for subfield in nitems:           
-        if nitems[subfield]!=ngalaxies_per_subfield:
-            raise RuntimeError('Incorrect number of galaxies in subfield %s--please check your '
-                               'shear catalogs and try again.'%subfield)
-    # Now, check uniqueness of galaxy IDs                               
-    if len(set(galaxy_id))!=len(galaxy_id):
-        raise RuntimeError('Duplicate galaxy IDs found.  Please check your catalog for uniqueness '
-                           'of galaxy IDs.')
-    # and, finally, check that the set of galaxy IDs is the expected set of galaxy IDs.
-    if set(galaxy_id)!=set(branch_id.expected_galaxy_ids(args.branch)):
-        raise RuntimeError('Unexpected galaxy IDs found.  Please check that your galaxy IDS are '
-                           'the same as the catalogs distributed with the Great3 simulations, '
-                           'and that you have passed the correct branch name.')
-
-    # See the comments in count_items for a description of what defaultdict does
-    # This makes a set of dicts x, y, etc.; the keys are the field IDs, and the values are a list of
-    # the quantity x, y, etc for the galaxies in that field. 
-    x = defaultdict(list)
-    y = defaultdict(list)
-    g1 = defaultdict(list)
-    g2 = defaultdict(list)
-    weight = defaultdict(list)
-
-    for i,si in enumerate(shear_info):
-        g1[field_id[i]].append(float(si[g1_column]))
-        g2[field_id[i]].append(float(si[g2_column]))
-    if 'constant' not in args.branch: # Only need x and y positions for variable-shear branches
-        for i,si in enumerate(shear_info):
-            idnum = galaxy_id[i]
-            x[field_id[i]].append(get_gridpoint(idnum[3:6]))
-            y[field_id[i]].append(get_gridpoint(idnum[-3:]))
-    if weight_column:
-        for i,si in enumerate(shear_info):
-            weight[field_id[i]].append(float(si[weight_column]))
+    # Read in all the shear information, a chunk at a time, keeping only what we need to check the
+    # catalogs and compute the summary statistics.  Many catalog files can be read in parallel.
+    accumulator = ShearCatalogAccumulator(args.branch)
+    tasks = [(filename,columns,is_fitsfile,args.comment_identifier,args.hdu_number)
+             for filename in args.file_list]
+    pool = None
+    if args.nproc>1 and nfiles>1:
+        import multiprocessing
+        pool = multiprocessing.Pool(min(args.nproc,nfiles))
+        file_chunks = pool.imap(_read_catalog_file,tasks)
     else:
-        for field in g1:
-            weight[field] = [1.]*len(g1[field])
+        file_chunks = (read_catalog_chunks(*task) for task in tasks)
+    for ifn,chunks in enumerate(file_chunks):
+        if ifn%20==0 or ifn==nfiles-1:
+            print 'Reading file', str(ifn+1)+'/'+str(nfiles), '...'
+        for chunk in chunks:
+            accumulator.add(*chunk)
+    if pool is not None:
+        pool.close()
+        pool.join()
+    print 'All files read.'
+    print 'Checking for correct galaxy IDs...'
+    accumulator.check()
+    fields = accumulator.fields()
     # Finally, compute the summary statistics.
     with open(args.outfile,'w') as file_object:
         if 'constant' in args.branch:
             for field in fields:
                 print 'Computing summary statistics for field', field, '...'
-                print_constant_summary(file_object,field,g1[field],g2[field],weight[field])
+                print_constant_summary_from_sums(file_object,field,*accumulator.sums[field])
         # Check if "variable" is in the branch name, apart from where it appears in "variable_psf"
         # if that is part of the branch name
         elif 'variable' in args.branch.replace('variable_psf',''):
             for field in fields:
                 print 'Computing summary statistics for field', field, '...'
-                print_variable_summary(file_object,field,x[field],y[field],
-                                       g1[field],g2[field],weight[field],
-                                       corr2=args.corr2)
+                x,y,g1,g2,weight = accumulator.field_columns(field)
+                print_variable_summary(file_object,field,x,y,g1,g2,weight,corr2=args.corr2)
         else:
             # This should never happen, but just in case...
             raise RuntimeError('Could not determine analysis type from branch name %s!  Please '
@@ -661,6 +832,9 @@ if __name__=='__main__':
                           help="The location of the executable for Mike Jarvis's corr2 code "
                                '(default: corr2)',
                           default='corr2', type=str, dest='corr2')
+        parser.add_argument('-j','--nproc', 
+                          help='Number of shear catalog files to read in parallel (default: 1)',
+                          default=1, type=int, dest='nproc')
         # Finally, collect any filenames given
         parser.add_argument('file_list',nargs='*',help='One or more names of files containing '
                                                        'shear catalogs')
@@ -716,6 +890,9 @@ if __name__=='__main__':
                           help="The location of the executable for Mike Jarvis's corr2 code "
                                '(default: corr2)',
                           default='corr2', type=str, dest='corr2')
+        parser.add_option('-j','--nproc', 
+                          help='Number of shear catalog files to read in parallel (default: 1)',
+                          default=1, type=int, dest='nproc')
         parser.add_option('--filexyz123',default=[],dest='file_list') # to create args.file_list
         args = parser.parse_args()
         # optparse gives a tuple (named_stuff, positional_stuff), so hack it to include
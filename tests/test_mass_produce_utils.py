@@ -0,0 +1,67 @@
+# Copyright (c) 2014, the GREAT3 executive committee (http://www.great3challenge.info/?q=contacts)
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification, are permitted
+# provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this list of conditions
+# and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice, this list of
+# conditions and the following disclaimer in the documentation and/or other materials provided with
+# the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors may be used to
+# endorse or promote products derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+# FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER
+# IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT
+# OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""@file test_mass_produce_utils.py
+
+Tests of the way mass_produce.py shares out the config files (chunks) among the branches, with
+allocate_chunks().
+
+These can be run with pytest, or as a script.
+"""
+
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'great3sims'))
+import mass_produce_utils
+
+def test_allocate_chunks_total():
+    """Check that the chunks add up to the number asked for, within the limits for each branch."""
+    import random
+    rng = random.Random(31415)
+    for n_branches, n_chunks, n_subfields in [(20, 200, 200), (20, 23, 200), (7, 30, 10),
+                                              (3, 10, 4), (5, 3, 10), (4, 50, 10)]:
+        for trial in range(20):
+            costs = [rng.uniform(0.1, 10.) for i in range(n_branches)]
+            counts = mass_produce_utils.allocate_chunks(costs, n_chunks, n_subfields)
+            assert len(counts) == n_branches
+            assert min(counts) >= 1 and max(counts) <= n_subfields
+            assert sum(counts) == min(max(n_chunks, n_branches), n_branches * n_subfields)
+
+def test_allocate_chunks_proportional():
+    """Check that the chunks follow the costs when no limits apply."""
+    counts = mass_produce_utils.allocate_chunks([1., 2., 3., 4.], 20, 100)
+    assert counts == [2, 4, 6, 8]
+    # Shares of 10/3 each: the one left over goes to the first of the branches.
+    counts = mass_produce_utils.allocate_chunks([1., 1., 1.], 10, 100)
+    assert counts == [4, 3, 3]
+    # The branch that is limited to one chunk leaves the rest to the others.
+    counts = mass_produce_utils.allocate_chunks([0.01, 1., 1.], 10, 100)
+    assert counts == [1, 5, 4]
+
+if __name__ == "__main__":
+
+    test_allocate_chunks_total()
+    test_allocate_chunks_proportional()
+    print "All tests passed"
@@ -26,20 +26,67 @@
 # OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 """Compare two md5sums files output by get_md5sums.py, checking consistency.
 
-Reads in two full md5sum output files each with entries in the format
+Reads in two manifests output by get_md5sums.py, each with entries in the format
+
+    <MD5 checksum> <size> <mtime> <path>
+
+and compares the checksums of the files with the same path, relative to the root directory of each
+release.  Files found in only one of the manifests are also reported.
+
+Plain md5sum output files with entries in the format
 
     <MD5 checksum> <filename>
 
-and compares the MD5 column for consistency. The filenames column, which may be different on
-different systems, is ignored for the purpose of this comparison.
+can also be compared, in which case the MD5 column is compared line by line for consistency. The
+filenames column, which may be different on different systems, is ignored for the purpose of this
+comparison.
 """
 
 import os
 
+def compare_manifests(file1, file2, manifest1, manifest2):
+    """Check two get_md5sums.py manifests, already read in by get_md5sums.read_manifest(), for
+    consistency, comparing the checksums of files with the same path.
+    """
+    import sys
+    failed = False
+    for path in sorted(set(manifest1) | set(manifest2)):
+
+        if path not in manifest2:
+            print "FAIL: "+path+" is in "+str(file1)+" but not in "+str(file2)
+            failed = True
+        elif path not in manifest1:
+            print "FAIL: "+path+" is in "+str(file2)+" but not in "+str(file1)
+            failed = True
+        elif manifest1[path][0] != manifest2[path][0]:
+            print "FAIL: md5sums differ!"
+            print "Mismatch:"
+            print path+" ("+manifest1[path][0]+")"
+            print path+" ("+manifest2[path][0]+")"
+            print
+            failed = True
+
+    if failed:
+        sys.exit(1)
+    else:
+        print "All md5sums in "+file1+" and "+file2+" check out"
+    return
+
 def compare_md5sum_files(file1, file2):
     """Check two get_md5sum.py output files for consistency.
+
+    Manifests are compared by path, using compare_manifests(); plain md5sum output is compared line
+    by line.
     """
-    import numpy as np
+    from get_md5sums import read_manifest
+    manifest1 = read_manifest(file1)
+    manifest2 = read_manifest(file2)
+    if manifest1 is not None and manifest2 is not None:
+        compare_manifests(file1, file2, manifest1, manifest2)
+        return
+    elif manifest1 is not None or manifest2 is not None:
+        print "FAIL: only one of "+str(file1)+" and "+str(file2)+" is a get_md5sums.py manifest"
+        exit(1)
     # Load the data
     with open(file1, "rb") as funit1:
         data1 = funit1.readlines()
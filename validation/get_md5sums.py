@@ -29,18 +29,49 @@ description="""
 Get all the md5sums for all the branches in the experiments, obs_types, shear_types lists in
 validation/constants.py.
 
-Writes a full md5sum output file with each entry in the format <MD5 checksum> <filename> to the
-specified outfile.
+Writes a manifest to the specified outfile, with each entry in the format
+
+    <MD5 checksum> <size> <mtime> <path>
+
+where <path> is relative to the root directory, so that manifests made on different systems can be
+compared file by file using compare_md5sums.py.  The checksums are calculated with hashlib using a
+pool of threads.  If a previous manifest is given, files whose size and modification time match
+their entry in it are not read again.
 """
  
 import os
 import constants
 
-def get_md5sum(filename, md5sum_exec="md5sum", silent=True):
-    """Run md5sum on the given filename.
+# Number of bytes read from each file at a time when calculating checksums
+md5_blocksize = 1 << 22
+# Number of threads used to calculate checksums
+nthreads = 8
+# First line of manifest files, used to tell them apart from plain md5sum output
+manifest_header = "# GREAT3 md5sum manifest: <MD5 checksum> <size> <mtime> <path>\n"
+
+def md5_hexdigest(filename, blocksize=md5_blocksize):
+    """Calculate the MD5 checksum of the given filename with hashlib.
+
+    @return The checksum as a string of hex digits
+    """
+    import hashlib
+    md5 = hashlib.md5()
+    with open(filename, "rb") as funit:
+        for chunk in iter(lambda: funit.read(blocksize), ""):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+def get_md5sum(filename, md5sum_exec=None, silent=True):
+    """Get the md5sum of the given filename, using hashlib or, if `md5sum_exec` is given, by running
+    that md5sum executable.
 
     @return A string containing "<MD5 checksum> experiment/obs_type/shear_type/"
     """
+    if md5sum_exec is None:
+        retstring = md5_hexdigest(filename)+"  "+filename+"\n"
+        if not silent:
+            print retstring
+        return retstring
     import subprocess
     import tempfile
     tmpfile = tempfile.mktemp()
@@ -54,43 +85,112 @@ def get_md5sum(filename, md5sum_exec="md5sum", silent=True):
         print retstring
     return retstring
 
+def read_manifest(filename):
+    """Read a manifest written by collate_all().
+
+    @return A dict of (<MD5 checksum>, <size>, <mtime>) tuples keyed by <path>, or None if the file
+            is not a manifest (e.g. plain md5sum output).
+    """
+    with open(filename, "rb") as funit:
+        if funit.readline() != manifest_header:
+            return None
+        entries = {}
+        for line in funit:
+
+            md5, size, mtime, path = line.rstrip("\n").split(" ", 3)
+            entries[path] = (md5, int(size), float(mtime))
+    return entries
+
+def write_manifest(filename, entries):
+    """Write a dict of (<MD5 checksum>, <size>, <mtime>) tuples keyed by <path> to a manifest,
+    sorted by path.
+    """
+    # Write then rename, so the previous manifest can safely be the same file
+    with open(filename+".tmp", "wb") as fout:
+        fout.write(manifest_header)
+        for path in sorted(entries):
+
+            md5, size, mtime = entries[path]
+            fout.write(md5+" "+str(size)+" "+repr(mtime)+" "+path+"\n")
+    os.rename(filename+".tmp", filename)
+    return
+
 def collate_all(root_dir, outfile, experiments=constants.experiments, obs_types=constants.obs_types,
-                shear_types=constants.shear_types, md5sum_exec="md5sum"):
-    """Put together a file containing an <MD5 checksum> <filename> entry for every file in the
-    all the experiment/obs_type/shear_type folders specified.
+                shear_types=constants.shear_types, md5sum_exec=None, previous_manifest=None,
+                nthreads=nthreads):
+    """Put together a manifest containing an <MD5 checksum> <size> <mtime> <path> entry for every
+    file in the all the experiment/obs_type/shear_type folders specified.
+
+    The checksums are calculated using a pool of `nthreads` threads.  If `previous_manifest` is
+    given, files whose size and modification time match their entry in it are not read again; it
+    may be the same file as `outfile`.
     """
     import sys
     import glob
     sys.path.append("..")
     import great3sims.mapper
+    previous = {}
+    if previous_manifest is not None and os.path.isfile(previous_manifest):
+        previous = read_manifest(previous_manifest)
+        if previous is None:
+            raise ValueError(
+                str(previous_manifest)+" is not a manifest written by get_md5sums.py")
     # Save the folders in which files were found
     found_exps = []
     found_obs = []
     found_shears = []
-    with open(outfile, "wb") as fout:
-        for experiment in experiments:
-
-            for obs_type in obs_types:
-
-                for shear_type in shear_types:
-
-                    # Get *all* the files in this folder
-                    mapper = great3sims.mapper.Mapper(root_dir, experiment, obs_type, shear_type) 
-                    allfiles = glob.glob(os.path.join(mapper.full_dir, "*"))
-                    if len(allfiles) > 0:
-                        if experiment not in found_exps: found_exps.append(experiment)
-                        if obs_type not in found_obs: found_obs.append(obs_type)
-                        if shear_type not in found_shears: found_shears.append(shear_type)
-                        print "Getting md5sum for all files in "+str(mapper.full_dir)
-                        for checkfile in allfiles:
-
-                            fout.write(get_md5sum(checkfile, silent=True))
+    entries = {}
+    tasks = []
+    for experiment in experiments:
+
+        for obs_type in obs_types:
+
+            for shear_type in shear_types:
+
+                # Get *all* the files in this folder
+                mapper = great3sims.mapper.Mapper(root_dir, experiment, obs_type, shear_type) 
+                allfiles = [checkfile for checkfile in glob.glob(os.path.join(mapper.full_dir, "*"))
+                            if os.path.isfile(checkfile)]
+                if len(allfiles) > 0:
+                    if experiment not in found_exps: found_exps.append(experiment)
+                    if obs_type not in found_obs: found_obs.append(obs_type)
+                    if shear_type not in found_shears: found_shears.append(shear_type)
+                    print "Found "+str(len(allfiles))+" files in "+str(mapper.full_dir)
+                    for checkfile in allfiles:
+
+                        path = os.path.relpath(checkfile, root_dir)
+                        stat = os.stat(checkfile)
+                        if path in previous and previous[path][1:] == (stat.st_size,
+                                                                       stat.st_mtime):
+                            entries[path] = previous[path]
+                        else:
+                            tasks.append((path, checkfile, stat.st_size, stat.st_mtime))
+
+    print "Getting md5sum for "+str(len(tasks))+" files ("+str(len(entries))+" unchanged)"
+    if md5sum_exec is None:
+        hash_function = md5_hexdigest
+    else:
+        hash_function = lambda checkfile: get_md5sum(checkfile, md5sum_exec=md5sum_exec).split()[0]
+    checkfiles = [checkfile for path, checkfile, size, mtime in tasks]
+    if nthreads > 1 and len(tasks) > 1:
+        # hashlib and file reads release the GIL, so threads hash files in parallel
+        import multiprocessing.pool
+        pool = multiprocessing.pool.ThreadPool(min(nthreads, len(tasks)))
+        checksums = pool.map(hash_function, checkfiles, chunksize=1)
+        pool.close()
+        pool.join()
+    else:
+        checksums = [hash_function(checkfile) for checkfile in checkfiles]
+    for (path, checkfile, size, mtime), checksum in zip(tasks, checksums):
+
+        entries[path] = (checksum, size, mtime)
+    write_manifest(outfile, entries)
 
     print "Ran md5sum on all files in "+root_dir
     print "Found files for experiments "+str(found_exps)
     print "Found files for obs_types "+str(found_obs)
     print "Found files for shear_types "+str(found_shears)
-    print "Full md5sum list written to "+str(outfile)
+    print "Full md5sum manifest written to "+str(outfile)
     return
 
 
@@ -104,13 +204,21 @@ if __name__ == "__main__":
         help="Root directory for the GREAT3 release for which you want to calculate md5sums "+
         "[default = "+str(constants.public_dir)+"]")
     parser.add_option(
-        "--md5sum", default="md5sum",
-        help="Path to md5sum executable [default = md5sum]") 
+        "--md5sum", default=None,
+        help="Path to an md5sum executable to use instead of hashlib [default = None]") 
+    parser.add_option(
+        "--previous", default=None,
+        help="Previous manifest, whose checksums are reused for files with unchanged size and "+
+        "modification time (may be the same as outfile) [default = None]")
+    parser.add_option(
+        "--nthreads", type="int", default=nthreads,
+        help="Number of threads used to calculate checksums [default = "+str(nthreads)+"]")
     args, outfile = parser.parse_args()
     if len(outfile) == 0 or len(outfile) > 1:
         print outfile
         print "Please supply one outfile, and place it *before* optional inputs!"
-        print "usage: get_md5sums.py outfile [--root_dir=ROOT_DIR] [--md5sum=MD5SUM] [-h]"
+        print ("usage: get_md5sums.py outfile [--root_dir=ROOT_DIR] [--md5sum=MD5SUM] "+
+               "[--previous=PREVIOUS] [--nthreads=NTHREADS] [-h]")
         exit(1)
-    collate_all(args.root_dir, outfile[0], md5sum_exec=args.md5sum)
-
+    collate_all(args.root_dir, outfile[0], md5sum_exec=args.md5sum,
+                previous_manifest=args.previous, nthreads=args.nthreads)
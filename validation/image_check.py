@@ -59,6 +59,10 @@ except:
     n_deep_subfields = 20
 
 nproc = 8
+use_threads = False # Use a pool of threads rather than processes when nproc > 1
+progress_interval = 50 # Report progress every this many images
+block_rows = 256 # Number of image rows to read from the memory-mapped file at a time
+fine_bin_width = 1.e-4 # Width in log(1+pixel value) of the bins used for the median and MAD
 threshold = 3 # Report deviations >= this many sigma for the means, medians, etc
 n_histogram_bins = 40
 n_curves_per_histogram_plot = 20 
@@ -72,6 +76,7 @@ if nproc>1:
     # See if we can import the multiprocessing module
     try:
         import multiprocessing
+        import multiprocessing.pool
     except:
         print "Cannot import multiprocessing; setting nproc = 1 and running serially."
         nproc = 1
@@ -100,16 +105,114 @@ def draw_histogram(x,cnum=0):
     numpy.seterr(all='warn')
     return
 
-# So we can pool.map without worrying about kwargs--kind of a hack, but easy
-expected_size = 4800
+def _merge_counts(counts, offset, new_counts, new_offset):
+    """Add the histogram `new_counts`, whose first bin has index `new_offset`, to the histogram
+    `counts` whose first bin has index `offset`, growing `counts` as necessary.
 
-def image_good_sizeonly(filename):
+    @return the merged counts and the index of their first bin.
+    """
+    if counts is None:
+        return new_counts, new_offset
+    lo = min(offset, new_offset)
+    hi = max(offset+len(counts), new_offset+len(new_counts))
+    if lo != offset or hi != offset+len(counts):
+        merged = numpy.zeros(hi-lo, dtype=counts.dtype)
+        merged[offset-lo:offset-lo+len(counts)] = counts
+        counts = merged
+        offset = lo
+    counts[new_offset-offset:new_offset-offset+len(new_counts)] += new_counts
+    return counts, offset
+
+def image_statistics(image, full_stats=True):
+    """Compute the pixel checks and statistics for a (possibly memory-mapped) `image` in a single
+    pass, reading `block_rows` rows at a time so that no full-size temporary arrays are made.
+
+    The mean and standard deviation are accumulated exactly.  The histogram of log(1+pixel value)
+    is accumulated on a fine grid with bins of width `fine_bin_width`, which is then rebinned to
+    `n_histogram_bins` bins spanning the full range of the data, as numpy.histogram() would do;
+    only pixels within one fine bin of a coarse bin edge can land in a different bin.  The median
+    and MAD are found by interpolating the cumulative distribution given by the fine histogram, so
+    they are approximate, to well within a fine bin.  NaN or infinite pixels are left out of the
+    statistics, and pixels <= -1 are counted in the lowest fine bin.
+
+    @return a tuple of 7 values: 2 logical values for no NaNs and no zero-valued pixels; the mean,
+    standard deviation, median, and median absolute deviation; and a tuple of histogram values and
+    bin edges like the one returned by numpy.histogram().  If `full_stats` is False the last five
+    are all zero.
+    """
+    good_pixels = True
+    no_zero_pixels = True
+    npix = 0
+    mean = 0.
+    m2 = 0.
+    counts = None
+    offset = 0
+    log_min = numpy.inf
+    log_max = -numpy.inf
+    log_floor = -1.+fine_bin_width
+    for start in range(0, image.shape[0], block_rows):
+        block = numpy.asarray(image[start:start+block_rows], dtype=numpy.float64).ravel()
+        if good_pixels and numpy.any(numpy.isnan(block)):
+            good_pixels = False
+        if no_zero_pixels and numpy.any(block==0):
+            no_zero_pixels = False
+        if not full_stats:
+            continue
+        finite = numpy.isfinite(block)
+        if not numpy.all(finite):
+            block = block[finite]
+        if len(block)==0:
+            continue
+        # Combine the mean and sum of squared deviations of this block with those so far
+        block_mean = numpy.mean(block)
+        block_m2 = numpy.sum((block-block_mean)**2)
+        delta = block_mean-mean
+        new_npix = npix+len(block)
+        mean += delta*len(block)/new_npix
+        m2 += block_m2+delta**2*npix*len(block)/new_npix
+        npix = new_npix
+        # Do a histogram.  So many of the values are near 0 that doing log(pixel value) is more
+        # easily readable; since some values are <1, do log(1+pixel value).
+        log_block = numpy.log1p(numpy.maximum(block, log_floor))
+        log_min = min(log_min, log_block.min())
+        log_max = max(log_max, log_block.max())
+        index = numpy.floor(log_block/fine_bin_width).astype(numpy.int64)
+        index_min = index.min()
+        counts, offset = _merge_counts(counts, offset, numpy.bincount(index-index_min),
+                                       index_min)
+    if not full_stats or npix==0:
+        return good_pixels, no_zero_pixels, 0, 0, 0, 0, 0
+    stddev = numpy.sqrt(m2/npix)
+    # Piecewise-linear cumulative distribution of the pixel values at the fine bin edges
+    edges = numpy.expm1((offset+numpy.arange(len(counts)+1))*fine_bin_width)
+    cumulative = numpy.concatenate(([0], numpy.cumsum(counts))).astype(numpy.float64)
+    median = numpy.interp(0.5*npix, cumulative, edges)
+    # The fraction of pixels within d of the median is piecewise linear in d between the distances
+    # of the fine bin edges from the median, so interpolate it at those distances.
+    distances = numpy.sort(numpy.abs(edges-median))
+    within = (numpy.interp(median+distances, edges, cumulative) -
+              numpy.interp(median-distances, edges, cumulative))
+    mad = numpy.interp(0.5*npix, within, distances)
+    # Rebin the fine histogram onto the coarse bins used for the plots, using the bin centres
+    bin_edges = numpy.linspace(log_min, log_max, n_histogram_bins+1)
+    if log_max>log_min:
+        centres = (offset+numpy.arange(len(counts))+0.5)*fine_bin_width
+        coarse = numpy.floor((centres-log_min)/(log_max-log_min)*n_histogram_bins)
+        coarse = numpy.clip(coarse, 0, n_histogram_bins-1).astype(int)
+        frequencies = numpy.bincount(coarse, weights=counts, minlength=n_histogram_bins)
+    else:
+        frequencies = numpy.zeros(n_histogram_bins)
+        frequencies[n_histogram_bins//2] = npix
+    histogram = (frequencies.astype(numpy.int64), bin_edges)
+    return good_pixels, no_zero_pixels, mean, stddev, median, mad, histogram
+
+def image_good_sizeonly(filename, expected_size=4800):
     """Run an image check on the given `filename`.
 
     @return a tuple of 8 values: 3 logical values for correct size, no NaNs, and no zero-valued
     pixels; then zeros to fill out the array so the return signature is the same as image_good_full.
     """
-    image_file = pyfits.open(filename)
+    image_file = pyfits.open(filename, memmap=True)
     image = image_file[0].data
     size = image.shape
     # Do basic FITS-file pixel level checks
@@ -117,26 +220,22 @@ def image_good_sizeonly(filename):
         good_size = True
     else:
         good_size = False
-    if numpy.any(numpy.isnan(image)):
-        good_pixels = False
-    else:
-        good_pixels = True
-    if numpy.any(image==0):
-        no_zero_pixels = False
-    else:
-        no_zero_pixels = True
+    good_pixels, no_zero_pixels = image_statistics(image, full_stats=False)[:2]
+    del image
     image_file.close()
     return good_size, good_pixels, no_zero_pixels, 0, 0, 0, 0, 0
      
 
-def image_good_full(filename):
+def image_good_full(filename, expected_size=4800):
     """Run an image check on the given `filename` and make pixel histograms.
 
+    The median and MAD are approximate; see image_statistics().
+
     @return a tuple of 8 values: 3 logical values for correct size, no NaNs, and no zero-valued
     pixels; the mean, standard deviation, median, and median absolute deviation; and a Numpy array
     of histogram values.
     """
-    image_file = pyfits.open(filename)
+    image_file = pyfits.open(filename, memmap=True)
     image = image_file[0].data
     size = image.shape
     # Do basic FITS-file pixel level checks
@@ -144,27 +243,85 @@ def image_good_full(filename):
         good_size = True
     else:
         good_size = False
-    if numpy.any(numpy.isnan(image)):
-        good_pixels = False
+    stats = image_statistics(image, full_stats=True)
+    del image
+    image_file.close()
+    return (good_size,)+stats
+
+def _check_image(args):
+    """Run image_good_full() or image_good_sizeonly() on a (filename, expected_size, full_stats)
+    tuple, so the checks can be handed to pool.imap().
+    """
+    filename, expected_size, full_stats = args
+    if full_stats:
+        return image_good_full(filename, expected_size=expected_size)
     else:
-        good_pixels = True
-    if numpy.any(image==0):
-        no_zero_pixels = False
+        return image_good_sizeonly(filename, expected_size=expected_size)
+
+def find_image_files(root_dir, experiments=constants.experiments, obs_types=constants.obs_types,
+                     shear_types=constants.shear_types):
+    """Find the image files in branches for the experiments, obs_types and shear_types specified,
+    within the specified root directory.
+
+    @return a list of (experiment, obs_type, shear_type, fitsfiles) tuples for every branch in
+    which any files matching image*.fits were found, with fitsfiles sorted.
+    """
+    branches = []
+    for experiment in experiments:
+        
+        for obs_type in obs_types:
+            
+            for shear_type in shear_types:
+
+                # Check for all files matching image*.fits.
+                # The try-except structure is here because msimet was using rmandelb's files,
+                # rather than untarring everything, and didn't have permission to make new 
+                # directories, which caused the mapper to fail when branches didn't exist.
+                try:
+                    mapper = great3sims.mapper.Mapper(root_dir, experiment, obs_type, shear_type)
+                    fitsfiles = glob.glob(os.path.join(mapper.full_dir, "image*.fits"))
+                except:
+                    fitsfiles = glob.glob(os.path.join(root_dir, experiment, obs_type, shear_type, "image*.fits"))
+                fitsfiles.sort() # So they're in numerical order
+                if len(fitsfiles) > 0:
+                    branches.append((experiment, obs_type, shear_type, fitsfiles))
+    return branches
+
+def run_image_checks(tasks, nproc=nproc, use_threads=use_threads):
+    """Run _check_image() on every (filename, expected_size, full_stats) tuple in `tasks`, spread
+    over a pool of `nproc` processes (or threads, if `use_threads`), printing a progress report
+    every `progress_interval` images.
+
+    @return a list of the results of the checks, in the same order as `tasks`.
+    """
+    import time
+    if nproc>1:
+        if use_threads:
+            pool = multiprocessing.pool.ThreadPool(nproc)
+        else:
+            pool = multiprocessing.Pool(nproc)
+        result_iter = pool.imap(_check_image, tasks)
     else:
-        no_zero_pixels = True
-    # Do a histogram.  So many of the values are near 0 that doing log(pixel value) is more
-    # easily readable; since some values are <1, do log(1+pixel value).
-    histogram = numpy.histogram(numpy.log(1.+image),bins=n_histogram_bins)
-    # Compute some summary statistics.
-    mean = numpy.mean(image)
-    stddev = numpy.std(image)
-    median = numpy.median(image)
-    mad = numpy.median(numpy.abs(image-median))
-    image_file.close()
-    return good_size, good_pixels, no_zero_pixels, mean, stddev, median, mad, histogram
+        pool = None
+        result_iter = (_check_image(task) for task in tasks)
+    results = []
+    t0 = time.time()
+    for result in result_iter:
+        results.append(result)
+        if len(results)%progress_interval==0 or len(results)==len(tasks):
+            elapsed = time.time()-t0
+            remaining = elapsed*(len(tasks)-len(results))/len(results)
+            print "Checked %d of %d images (%.0f s elapsed, about %.0f s remaining)"%(
+                len(results), len(tasks), elapsed, remaining)
+            sys.stdout.flush()
+    if pool is not None:
+        pool.close()
+        pool.join()
+    return results
 
 def check_all(root_dir, experiments=constants.experiments, obs_types=constants.obs_types,
-              shear_types=constants.shear_types, full_stats = True, full_stats_filename = None):
+              shear_types=constants.shear_types, full_stats = True, full_stats_filename = None,
+              nproc=nproc, use_threads=use_threads):
     """Check all image files are good in branches for the experiments, obs_types and shear_types
     specified,  within the specified root directory.
 
@@ -172,17 +329,16 @@ def check_all(root_dir, experiments=constants.experiments, obs_types=constants.o
     
     full_stats = True computes mean, stddev, median, and MAD.  If you want that information written
     to a file, give the kwarg full_stats_filename; if full_stats = False this kwarg is ignored.
+
+    The images in all the branches are checked together, spread over a pool of nproc processes, or
+    threads if use_threads = True.
     
     @return good  If all checks pass, returns a list of all the filenames that were found by
                   this check and passed the correct-size checks.  If any checks failed, prints all
                   failed filenames and raises a TypeError exception.
     """
-    if full_stats:
-        image_function = image_good_full
-        if full_stats_filename:
-            fsf = open(full_stats_filename,'w')
-    else:
-        image_function = image_good_sizeonly
+    if full_stats and full_stats_filename:
+        fsf = open(full_stats_filename,'w')
     # Set storage lists
     good_sizes = []
     bad_sizes = []
@@ -193,112 +349,91 @@ def check_all(root_dir, experiments=constants.experiments, obs_types=constants.o
     found_exps = []
     found_obs = []
     found_shears = []
-    for experiment in experiments:
-        
-        for obs_type in obs_types:
-            
-            for shear_type in shear_types:
-
-                # Check for all files matching image*.fits.
-                # The try-except structure is here because msimet was using rmandelb's files,
-                # rather than untarring everything, and didn't have permission to make new 
-                # directories, which caused the mapper to fail when branches didn't exist.
-                try:
-                    mapper = great3sims.mapper.Mapper(root_dir, experiment, obs_type, shear_type)
-                    fitsfiles = glob.glob(os.path.join(mapper.full_dir, "image*.fits"))
-                except:
-                    fitsfiles = glob.glob(os.path.join(root_dir, experiment, obs_type, shear_type, "image*.fits"))
-                fitsfiles.sort() # So they're in numerical order
-                # If any fits files found, check
-                if len(fitsfiles) > 0:
-                    # Reset for every branch since these may be different branch to branch.
-                    means = [] 
-                    stddevs = []
-                    medians = []
-                    mads = []
-                    histograms = []
-                    if experiment not in found_exps: found_exps.append(experiment)
-                    if obs_type not in found_obs: found_obs.append(obs_type)
-                    if shear_type not in found_shears: found_shears.append(shear_type)
-                    # Expected image size for the different branches
-                    global expected_size
-                    if obs_type=="space" and not (experiment=="multiepoch" or experiment=="full"):
-                        expected_size=9600
-                    else:
-                        expected_size=4800
-                    if nproc>1:
-                        pool = multiprocessing.Pool(nproc)  
-                        results = pool.map(image_function,fitsfiles)
-                    else:
-                        results = [image_function(fitsfile) for fitsfile in fitsfiles]
-                    # Turn the list of results into usefully-named quantities by
-                    # transposing the list of tuples
-                    (query_sizes, query_NaNs, query_zeros, 
-                        means, stddevs, medians, mads, histograms) = zip(*results)
-                    for i,good_size in enumerate(query_sizes):
-                        if good_size:
-                            good_sizes.append(fitsfiles[i])
-                        else:
-                            bad_sizes.append(fitsfiles[i])
-                    for i,good_NaN in enumerate(query_NaNs):
-                        if good_NaN:
-                            good_NaNs.append(fitsfiles[i])
-                        else:
-                            bad_NaNs.append(fitsfiles[i])
-                    for i,no_zero_pixels in enumerate(query_zeros):
-                        if no_zero_pixels:
-                            good_zeros.append(fitsfiles[i])
-                        else:
-                            bad_zeros.append(fitsfiles[i])
-                            
-                    if full_stats:
-                        # Now check for outliers in the mean, stddev, median, or MAD
-                        # and print a warning (but keep analyzing) for any found
-                        qlist = [(means,"mean"),(stddevs,"stddev"),(medians,"median"),(mads,"MAD")]
-                        for long_quantity, qname in qlist:
-                            # Cut to just the main files--the deep subfields are often different,
-                            # and too few to make good outlier calculations; make sure to examine
-                            # the histograms for any weirdness.
-                            quantity = long_quantity[:n_main_fields]
-                            mean = numpy.mean(quantity)
-                            stddev = numpy.std(quantity)
-                            # [0] since numpy.where returns a tuple with an element for each
-                            # dimension, but we only have (and care about) one.
-                            outliers = numpy.where(
-                                numpy.abs((quantity-mean)/stddev)>threshold)[0]
-                            if len(outliers)>0:
-                                for outlier in outliers:
-                                    print "WARNING: Outlier (>"+str(threshold)+' sigma) for',
-                                    print 'quantity', qname,':', fitsfiles[outlier],
-                                    print 'value =', quantity[outlier], 'for mean',mean,
-                                    print 'and standard deviation', stddev
-                        histogram_filename_base = (histogram_root_filename+'.'+experiment+'.'+
-                                                   obs_type+'.'+shear_type)
-                        # Draw some png files with a huge number of histograms...
-                        nhists=0
-                        for i,hist in enumerate(histograms):
-                            draw_histogram(hist,cnum=i)
-                            if (i+1)%n_curves_per_histogram_plot==0:
-                                plt.title('Pixel histogram for'+experiment+'-'+obs_type+
-                                          '-'+shear_type)
-                                plt.xlabel('log(1+pixel value)')
-                                plt.ylabel('log(Number of pixels)')
-                                plt.savefig(histogram_filename_base+'-'+str(nhists)+'.png')
-                                plt.clf()
-                                nhists+=1
-                        # In case len(histograms) doesn't divide evenly into n_curves_per
-                        if (i+1)%n_curves_per_histogram_plot!=0:
-                            plt.title('Pixel histogram for '+experiment+'-'+obs_type+'-'+shear_type)
-                            plt.xlabel('log(1+pixel value)')
-                            plt.ylabel('log(Number of pixels)')
-                            plt.savefig(histogram_filename_base+'-'+str(nhists)+'.png')
-                            plt.clf()
-                        if full_stats_filename:
-                            fsf.write('# '+experiment+'-'+obs_type+'-'+shear_type+'\n')
-                            fsf.write('# mean stddev median MAD\n')
-                            for i in range(len(fitsfiles)):
-                                fsf.write(fitsfiles[i]+' '+str(means[i])+' '+str(stddevs[i])+' '+
-                                          str(medians[i])+' '+str(mads[i])+'\n')
+    branches = find_image_files(root_dir, experiments, obs_types, shear_types)
+    tasks = []
+    for experiment, obs_type, shear_type, fitsfiles in branches:
+        # Expected image size for the different branches
+        if obs_type=="space" and not (experiment=="multiepoch" or experiment=="full"):
+            expected_size=9600
+        else:
+            expected_size=4800
+        tasks += [(fitsfile, expected_size, full_stats) for fitsfile in fitsfiles]
+    all_results = run_image_checks(tasks, nproc=nproc, use_threads=use_threads)
+    nchecked = 0
+    for experiment, obs_type, shear_type, fitsfiles in branches:
+        if experiment not in found_exps: found_exps.append(experiment)
+        if obs_type not in found_obs: found_obs.append(obs_type)
+        if shear_type not in found_shears: found_shears.append(shear_type)
+        results = all_results[nchecked:nchecked+len(fitsfiles)]
+        nchecked += len(fitsfiles)
+        # Turn the list of results into usefully-named quantities by
+        # transposing the list of tuples
+        (query_sizes, query_NaNs, query_zeros, 
+            means, stddevs, medians, mads, histograms) = zip(*results)
+        for i,good_size in enumerate(query_sizes):
+            if good_size:
+                good_sizes.append(fitsfiles[i])
+            else:
+                bad_sizes.append(fitsfiles[i])
+        for i,good_NaN in enumerate(query_NaNs):
+            if good_NaN:
+                good_NaNs.append(fitsfiles[i])
+            else:
+                bad_NaNs.append(fitsfiles[i])
+        for i,no_zero_pixels in enumerate(query_zeros):
+            if no_zero_pixels:
+                good_zeros.append(fitsfiles[i])
+            else:
+                bad_zeros.append(fitsfiles[i])
+                
+        if full_stats:
+            # Now check for outliers in the mean, stddev, median, or MAD
+            # and print a warning (but keep analyzing) for any found
+            qlist = [(means,"mean"),(stddevs,"stddev"),(medians,"median"),(mads,"MAD")]
+            for long_quantity, qname in qlist:
+                # Cut to just the main files--the deep subfields are often different,
+                # and too few to make good outlier calculations; make sure to examine
+                # the histograms for any weirdness.
+                quantity = long_quantity[:n_main_fields]
+                mean = numpy.mean(quantity)
+                stddev = numpy.std(quantity)
+                # [0] since numpy.where returns a tuple with an element for each
+                # dimension, but we only have (and care about) one.
+                outliers = numpy.where(
+                    numpy.abs((quantity-mean)/stddev)>threshold)[0]
+                if len(outliers)>0:
+                    for outlier in outliers:
+                        print "WARNING: Outlier (>"+str(threshold)+' sigma) for',
+                        print 'quantity', qname,':', fitsfiles[outlier],
+                        print 'value =', quantity[outlier], 'for mean',mean,
+                        print 'and standard deviation', stddev
+            histogram_filename_base = (histogram_root_filename+'.'+experiment+'.'+
+                                       obs_type+'.'+shear_type)
+            # Draw some png files with a huge number of histograms...
+            nhists=0
+            for i,hist in enumerate(histograms):
+                draw_histogram(hist,cnum=i)
+                if (i+1)%n_curves_per_histogram_plot==0:
+                    plt.title('Pixel histogram for'+experiment+'-'+obs_type+
+                              '-'+shear_type)
+                    plt.xlabel('log(1+pixel value)')
+                    plt.ylabel('log(Number of pixels)')
+                    plt.savefig(histogram_filename_base+'-'+str(nhists)+'.png')
+                    plt.clf()
+                    nhists+=1
+            # In case len(histograms) doesn't divide evenly into n_curves_per
+            if (i+1)%n_curves_per_histogram_plot!=0:
+                plt.title('Pixel histogram for '+experiment+'-'+obs_type+'-'+shear_type)
+                plt.xlabel('log(1+pixel value)')
+                plt.ylabel('log(Number of pixels)')
+                plt.savefig(histogram_filename_base+'-'+str(nhists)+'.png')
+                plt.clf()
+            if full_stats_filename:
+                fsf.write('# '+experiment+'-'+obs_type+'-'+shear_type+'\n')
+                fsf.write('# mean stddev median MAD\n')
+                for i in range(len(fitsfiles)):
+                    fsf.write(fitsfiles[i]+' '+str(means[i])+' '+str(stddevs[i])+' '+
+                              str(medians[i])+' '+str(mads[i])+'\n')
 
     if full_stats and full_stats_filename:
         fsf.close()